@@ -0,0 +1,300 @@
+"""
+公会战状态图渲染基准测试
+
+使用随机生成的公会数据(成员 预约 挂树 出刀中 补偿)离线测量 image_engine 各阶段的耗时与内存
+结果可以保存为基准文件  之后的测试与基准比较  用于验证渲染优化的效果以及发现性能退化
+
+用法:
+    python scripts/bench_image_engine.py --font msyh.ttf --save baseline.json
+    python scripts/bench_image_engine.py --font msyh.ttf --compare baseline.json
+    python scripts/bench_image_engine.py --compare  # 与仓库中的基准文件 bench_image_engine.baseline.json 比较
+
+仓库中的基准文件使用默认参数生成  记录了生成时使用的字体和环境  在其他机器上只适合比较相对变化
+
+注意: 内存统计基于tracemalloc  只包含Python对象的分配  PIL的像素缓冲区不在统计范围内
+     峰值(peak)为单次调用期间的分配峰值  残留(retained)为调用结束后仍未释放的分配(主要是各级缓存)
+     进程峰值内存(max_rss)包含所有分配  但不区分阶段
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src", "client")))
+
+from PIL import Image  # noqa: E402
+
+from ybplugins.clan_battle.components import image_engine  # noqa: E402
+from ybplugins.clan_battle.components.font_pool import font_pool  # noqa: E402
+
+BOSS_ICON_IDS = ["302000", "302100", "300600", "301300", "300100"]
+DEFAULT_BASELINE = Path(__file__).resolve().with_name("bench_image_engine.baseline.json")
+
+
+class SyntheticClan:
+    """
+    随机生成的公会数据  相同的参数和随机种子生成相同的数据
+
+    :param members: 成员数量
+    :param subscriptions: 每个boss的预约人数
+    :param trees: 挂树人数  分散在各个boss上
+    :param challengers: 每个boss正在出刀的人数(不含挂树)
+    :param half: 有补偿刀的人数
+    """
+
+    def __init__(self, members: int, subscriptions: int, trees: int, challengers: int, half: int, seed: int) -> None:
+        rand = random.Random(seed)
+        self.members = [str(100000 + i) for i in range(members)]
+        self.nicknames = {qqid: "".join(rand.choice("公会战出刀预约挂树补偿ABCxyz") for _ in range(rand.randint(2, 8))) for qqid in self.members}
+        self.half = rand.sample(self.members, min(half, members))
+        self.bosses = []
+        tree_members = rand.sample(self.members, min(trees, members))
+        for boss_num in range(5):
+            self.bosses.append(
+                {
+                    "cycle": rand.randint(1, 40),
+                    "health": rand.randint(1, 6000000),
+                    "subscribe": rand.sample(self.members, min(subscriptions, members)),
+                    "challenge": rand.sample(self.members, min(challengers, members)),
+                    "tree": tree_members[boss_num::5],
+                }
+            )
+
+    def chips(self, qqids: List[str], color: Tuple[int, int, int], suffix: str = "") -> Dict[str, Any]:
+        result: Dict[str, Any] = {"style-background-color": color}
+        for qqid in qqids:
+            result[qqid] = self.nicknames[qqid][:4] + suffix
+        return result
+
+    def process_image(self) -> "image_engine.ProcessImageCore":
+        return image_engine.ProcessImageCore(
+            [
+                image_engine.GroupStateBlock("完整刀", str(len(self.members) * 2), (0, 0, 0), (255, 0, 0), (255, 205, 210)),
+                image_engine.GroupStateBlock("阶段", "C", (255, 255, 255), (255, 255, 255), (3, 169, 244)),
+            ],
+            {"补偿": self.chips(self.half, (240, 240, 240), " x 1")},
+        )
+
+    def boss_images(self) -> List["image_engine.BossStatusImageCore"]:
+        result = []
+        for boss_num, boss in enumerate(self.bosses):
+            extra_info = {
+                "预约": self.chips(boss["subscribe"], (179, 229, 252), ":留言"),
+                "挑战": self.chips(boss["challenge"] + boss["tree"], (255, 249, 196), "@30s,500w"),
+            }
+            if boss["tree"]:
+                extra_info["挂树"] = self.chips(boss["tree"], (255, 205, 210))
+            result.append(
+                image_engine.BossStatusImageCore(
+                    boss["cycle"],
+                    boss["health"],
+                    6000000,
+                    f"Boss{boss_num + 1}",
+                    BOSS_ICON_IDS[boss_num],
+                    extra_info,
+                )
+            )
+        return result
+
+    def image_list(self) -> list:
+        return [self.process_image(), *self.boss_images()]
+
+    def write_avatars(self, path: Path) -> None:
+        rand = random.Random(len(self.members))
+        for qqid in self.members:
+            color = (rand.randrange(256), rand.randrange(256), rand.randrange(256))
+            with Image.new("RGB", (100, 100), color) as avatar:
+                avatar.save(path.joinpath(qqid + ".jpg"), format="JPEG")
+
+
+def clear_caches() -> None:
+    for name in ("text_image_cache", "mask_cache", "shadow_cache", "avatar_cache"):
+        cache = getattr(image_engine, name, None)
+        if cache is not None:
+            cache.clear()
+
+
+def bench_stages(clan: SyntheticClan) -> Dict[str, Callable[[], Any]]:
+    """
+    各阶段的测试函数  函数内部自行准备输入  每次调用互不影响
+    """
+    chip_widths = sorted((random.Random(1).randint(60, 300) for _ in range(len(clan.members))), reverse=True)
+    subscribe_chips = clan.bosses[0]["subscribe"] or clan.members[:1]
+
+    def background_generator():
+        background = image_engine.BackGroundGenerator(color=(255, 255, 255), padding=(5, 5, 5, 5))
+        for i in range(30):
+            background.alpha_composite(Image.new("RGBA", (80, 30), (i * 8, 0, 0, 255)), (i % 5 * 85, i // 5 * 35))
+        background.generate().close()
+
+    def chips_list_sort():
+        image_engine.chips_list_sort(chip_widths[:], 361, 5)
+
+    def chips_list():
+        image_engine.chips_list(clan.chips(subscribe_chips, (179, 229, 252), ":留言"), "预约").close()
+
+    def boss_generate():
+        clan.boss_images()[0].generate().close()
+
+    def combined():
+        image_engine.generate_combind_boss_state_image(clan.image_list()).close()
+
+    status_cache = image_engine.StatusImageCache()
+
+    def combined_cached_one_change():
+        # 模拟一次报刀: 只有一个boss的血量变化
+        clan.bosses[0]["health"] = clan.bosses[0]["health"] % 6000000 + 1
+        status_cache.render(clan.image_list()).close()
+
+    return {
+        "background_generator": background_generator,
+        "chips_list_sort": chips_list_sort,
+        "chips_list": chips_list,
+        "boss_generate": boss_generate,
+        "combined": combined,
+        "combined_cached_one_change": combined_cached_one_change,
+    }
+
+
+def measure(func: Callable[[], Any], repeat: int, cold: bool) -> Dict[str, float]:
+    # 计时与内存统计分开进行  避免tracemalloc影响计时
+    func()  # 预热
+    timings = []
+    for _ in range(repeat):
+        if cold:
+            clear_caches()
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    if cold:
+        clear_caches()
+    tracemalloc.start()
+    try:
+        func()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "mean_ms": round(statistics.mean(timings), 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "min_ms": round(min(timings), 3),
+        "stdev_ms": round(statistics.stdev(timings), 3) if len(timings) > 1 else 0.0,
+        "peak_kib": round(peak / 1024, 1),
+        "retained_kib": round(retained / 1024, 1),
+    }
+
+
+def max_rss_kib() -> int:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> bool:
+    """
+    与基准比较  中位数耗时超过基准的(1 + tolerance)倍视为退化
+
+    :return: 是否没有退化
+    """
+    ok = True
+    print(f"\n{'阶段':<28}{'基准(ms)':>12}{'本次(ms)':>12}{'变化':>10}")
+    for name, stage in result["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            print(f"{name:<28}{'-':>12}{stage['median_ms']:>12.3f}{'新增':>10}")
+            continue
+        ratio = stage["median_ms"] / base["median_ms"] if base["median_ms"] else 1.0
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  退化"
+            ok = False
+        print(f"{name:<28}{base['median_ms']:>12.3f}{stage['median_ms']:>12.3f}{(ratio - 1) * 100:>9.1f}%{flag}")
+    if baseline.get("params") != result["params"]:
+        print("警告: 测试参数与基准不同  结果不可直接比较")
+    if baseline.get("environment", {}).get("font") != result["environment"]["font"]:
+        print("警告: 使用的字体与基准不同  文字绘制的耗时不可直接比较")
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="公会战状态图渲染基准测试")
+    parser.add_argument("--members", type=int, default=30, help="成员数量")
+    parser.add_argument("--subscriptions", type=int, default=6, help="每个boss的预约人数")
+    parser.add_argument("--trees", type=int, default=3, help="挂树人数")
+    parser.add_argument("--challengers", type=int, default=3, help="每个boss正在出刀的人数")
+    parser.add_argument("--half", type=int, default=5, help="有补偿刀的人数")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--repeat", type=int, default=20, help="每个阶段的重复次数")
+    parser.add_argument("--stage", action="append", help="只测试指定的阶段  可重复指定")
+    parser.add_argument("--cold", action="store_true", help="每次测试前清空渲染缓存")
+    parser.add_argument("--font", help="字体文件路径  默认使用 fonts/msyh.ttf")
+    parser.add_argument("--save", metavar="FILE", help="保存结果为基准文件")
+    parser.add_argument("--compare", metavar="FILE", nargs="?", const=str(DEFAULT_BASELINE), help=f"与基准文件比较  不指定文件时使用 {DEFAULT_BASELINE.name}")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="允许的耗时增长比例")
+    args = parser.parse_args()
+
+    if args.font:
+        font_pool.path = os.path.abspath(args.font)
+        font_pool.set_fallbacks([])
+    if not os.path.isfile(font_pool.font_path):
+        parser.error(f"字体文件不存在: {font_pool.font_path}  请使用 --font 指定")
+
+    clan = SyntheticClan(args.members, args.subscriptions, args.trees, args.challengers, args.half, args.seed)
+    params = {k: getattr(args, k) for k in ("members", "subscriptions", "trees", "challengers", "half", "seed", "cold")}
+
+    with tempfile.TemporaryDirectory() as avatar_path:
+        image_engine.USER_HEADERS_PATH = Path(avatar_path)
+        clan.write_avatars(Path(avatar_path))
+
+        stages = bench_stages(clan)
+        if args.stage:
+            unknown = set(args.stage) - set(stages)
+            if unknown:
+                parser.error(f"未知的阶段: {', '.join(sorted(unknown))}  可选: {', '.join(stages)}")
+            stages = {k: v for k, v in stages.items() if k in args.stage}
+
+        result: Dict[str, Any] = {
+            "params": params,
+            "environment": {
+                "python": platform.python_version(),
+                "pillow": Image.__version__,
+                "font": os.path.basename(font_pool.font_path),
+                "platform": platform.platform(),
+            },
+            "stages": {},
+        }
+        print(f"{'阶段':<28}{'中位数(ms)':>12}{'平均(ms)':>12}{'峰值(KiB)':>12}{'残留(KiB)':>12}")
+        for name, func in stages.items():
+            stage = result["stages"][name] = measure(func, args.repeat, args.cold)
+            print(f"{name:<28}{stage['median_ms']:>12.3f}{stage['mean_ms']:>12.3f}{stage['peak_kib']:>12.1f}{stage['retained_kib']:>12.1f}")
+        result["max_rss_kib"] = max_rss_kib()
+        print(f"进程峰值内存: {result['max_rss_kib']} KiB")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"已保存基准: {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(result, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -38,6 +38,7 @@ from aiocqhttp import CQHttp
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import yobot
+from ybplugins import ybdata
 
 
 def insert_seq(seq, x):
@@ -106,7 +107,11 @@ def main():
     @cqbot.on_message
     async def handle_msg(context):
         if context["message_type"] == "group" or context["message_type"] == "private":
-            reply = await bot.proc_async(context)
+            try:
+                reply = await bot.proc_async(context)
+            finally:
+                # 使用连接池时每条消息处理完毕后归还数据库连接
+                ybdata.release_connection()
         else:
             reply = None
         if isinstance(reply, str) and reply != "":
@@ -116,10 +121,13 @@ def main():
             return None
 
     async def send_it(func):
-        if asyncio.iscoroutinefunction(func):
-            to_sends = await func()
-        else:
-            to_sends = func()
+        try:
+            if asyncio.iscoroutinefunction(func):
+                to_sends = await func()
+            else:
+                to_sends = func()
+        finally:
+            ybdata.release_connection()
         if to_sends is None:
             return
         for kwargs in to_sends:
@@ -19,6 +19,7 @@ var vm = new Vue({
         boxShow:{1:false,2:false,3:false,4:false,5:false},  //手机版面板抽屉显示
 
         base_cycle: 1,  //当前基础周目
+        boss_version: null,     //当前boss数据的版本号
 
         //代x
         behalf: null,               //报刀
@@ -61,8 +62,7 @@ var vm = new Vue({
         }).then(function (res) {
             if (res.data.code == 0) {
                 thisvue.groupData = res.data.groupData;
-                thisvue.bossData = res.data.bossData;
-                thisvue.base_cycle = res.data.groupData.cycle;
+                thisvue.apply_boss_data(res.data);
                 thisvue.is_admin = res.data.selfData.is_admin;
                 thisvue.self_id = res.data.selfData.user_id;
                 thisvue.boss_num = 1;
@@ -85,7 +85,11 @@ var vm = new Vue({
         }).catch(function (error) {
             thisvue.$alert(error, '获取成员失败');
         });
-        this.status_long_polling();
+        if (window.EventSource) {
+            this.status_stream();
+        } else {
+            this.status_long_polling();
+        }
     },
     beforeMount () {
         var userAgentInfo = navigator.userAgent;
@@ -99,6 +103,9 @@ var vm = new Vue({
     },
     destroyed: function () {
         this.leavePage = true;
+        if (this.eventSource) {
+            this.eventSource.close();
+        }
     },
     computed: {
         damageHint: function () {
@@ -126,6 +133,50 @@ var vm = new Vue({
             };
             return qqid;
         },
+        show_notice: function (notice) {
+            this.$notify({
+                title: '通知',
+                message: '(' + (new Date()).toLocaleTimeString('chinese', { hour12: false }) + ') ' + notice,
+                duration: 60000,
+            });
+        },
+        apply_boss_data: function (data) {
+            // 版本号格式为 纪元-序号，忽略比当前数据更旧的数据
+            if (this.boss_version && data.version) {
+                var now = this.boss_version.split('-'), next = data.version.split('-');
+                if (now[0] == next[0] && Number(next[1]) < Number(now[1])) {
+                    return;
+                }
+            }
+            // partial为true时bossData只包含变化的boss
+            if (data.partial) {
+                this.bossData = Object.assign({}, this.bossData, data.bossData);
+            } else {
+                this.bossData = data.bossData;
+            }
+            this.base_cycle = data.base_cycle;
+            this.boss_version = data.version;
+        },
+        status_stream: function () {
+            // 服务器推送boss状态，断线后浏览器会携带最后的事件编号自动重连
+            var thisvue = this;
+            var source = new EventSource('./api/stream/');
+            this.eventSource = source;
+            source.addEventListener('sync', function (e) {
+                var data = JSON.parse(e.data);
+                data.version = e.lastEventId;
+                thisvue.apply_boss_data(data);
+            });
+            source.addEventListener('update', function (e) {
+                var data = JSON.parse(e.data);
+                data.version = e.lastEventId;
+                data.partial = true;
+                thisvue.apply_boss_data(data);
+                if (data.notice) {
+                    thisvue.show_notice(data.notice);
+                }
+            });
+        },
         status_long_polling: function () {
             var thisvue = this;
             axios.post("./api/", {
@@ -140,11 +191,7 @@ var vm = new Vue({
                     thisvue.base_cycle = res.data.base_cycle,
                     thisvue.status_long_polling();
                     if (res.data.notice) {
-                        thisvue.$notify({
-                            title: '通知',
-                            message: '(' + (new Date()).toLocaleTimeString('chinese', { hour12: false }) + ') ' + res.data.notice,
-                            duration: 60000,
-                        });
+                        thisvue.show_notice(res.data.notice);
                     }
                 } else if (res.data.code == 1) {
                     thisvue.status_long_polling();
@@ -177,13 +224,11 @@ var vm = new Vue({
         callapi: function (payload) {
             var thisvue = this;
             payload.csrf_token = csrf_token;
+            payload.since_version = this.boss_version;
             axios.post("./api/", payload).then(function (res) {
                 if (res.data.code == 0) {
                     if (res.data.bossData) {
-                        thisvue.bossData = res.data.bossData;
-                    }
-                    if (res.data.base_cycle) {
-                        thisvue.base_cycle = res.data.base_cycle;
+                        thisvue.apply_boss_data(res.data);
                     }
                     if (res.data.notice) {
                         thisvue.$notify({
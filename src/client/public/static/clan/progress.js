@@ -18,6 +18,10 @@ var vm = new Vue({
         today: 0,
         isMobile: false,
         tempList:[0,1,2,3,4,5],
+        challenges: [],     //当前日期的出刀记录，按记录id排序
+        last_cid: 0,        //增量同步的位置
+        sync_token: null,   //增量同步的删除记录标记
+        syncTimer: null,
     },
     mounted() {
         var thisvue = this;
@@ -26,6 +30,7 @@ var vm = new Vue({
                 action: 'get_challenge',
                 csrf_token: csrf_token,
                 ts: (thisvue.get_today() / 1000) + 43200,
+                since_cid: 0,
             }),
             axios.post('../api/', {
                 action: 'get_member_list',
@@ -47,11 +52,15 @@ var vm = new Vue({
             }
             thisvue.today = res.data.today;
             thisvue.reportDate = thisvue.get_today();
-            thisvue.refresh(res.data.challenges);
+            thisvue.apply_delta(res.data);
+            thisvue.syncTimer = setInterval(thisvue.sync_challenges, 60000);
         })).catch(function (error) {
             thisvue.$alert(error, '获取数据失败');
         });
     },
+    destroyed: function () {
+        clearInterval(this.syncTimer);
+    },
     beforeMount () {
         var userAgentInfo = navigator.userAgent;
         var Agents = ['Android', 'iPhone', 'SymbianOS', 'Windows Phone', 'iPad', 'iPod'];
@@ -127,17 +136,56 @@ var vm = new Vue({
                 action: 'get_challenge',
                 csrf_token: csrf_token,
                 ts: (thisvue.reportDate ? (thisvue.reportDate.getTime() / 1000) + 43200 : null),
+                since_cid: 0,
             }).then(function (res) {
                 if (res.data.code != 0) {
                     thisvue.$alert(res.data.message, '获取记录失败');
                 } else {
-                    thisvue.refresh(res.data.challenges);
+                    thisvue.apply_delta(res.data);
                 }
             }).catch(function (error) {
                 thisvue.$alert(error, '获取记录失败');
             })
             this.today = -1;
         },
+        sync_challenges: function () {
+            // 定时增量同步当前日期的出刀记录
+            var thisvue = this;
+            axios.post('../api/', {
+                action: 'get_challenge',
+                csrf_token: csrf_token,
+                ts: (thisvue.reportDate ? (thisvue.reportDate.getTime() / 1000) + 43200 : null),
+                since_cid: thisvue.last_cid,
+                sync_token: thisvue.sync_token,
+            }).then(function (res) {
+                if (res.data.code == 0) {
+                    thisvue.apply_delta(res.data);
+                }
+            }).catch(function (error) {
+                console.error(error);
+            });
+        },
+        apply_delta: function (data) {
+            if (data.full) {
+                this.challenges = data.challenges;
+            } else {
+                if (data.tombstones.length == 0 && data.challenges.length == 0) {
+                    this.last_cid = data.last_cid;
+                    this.sync_token = data.sync_token;
+                    return;
+                }
+                // 先移除被删除与重新发送的记录，再合并
+                var removed = new Set(data.tombstones);
+                for (const c of data.challenges) {
+                    removed.add(c.cid);
+                }
+                this.challenges = this.challenges.filter(c => !removed.has(c.cid)).concat(data.challenges);
+                this.challenges.sort((a, b) => a.cid - b.cid);
+            }
+            this.last_cid = data.last_cid;
+            this.sync_token = data.sync_token;
+            this.refresh(this.challenges.slice());
+        },
         refresh: function (challenges) {
             challenges.sort((a, b) => a.qqid - b.qqid);
             this.progressData = [...this.members];
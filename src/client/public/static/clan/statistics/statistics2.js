@@ -145,21 +145,59 @@ var vm = new Vue({
         },
         formatTo2: (num) => { return (num >= 10) ?  num.toString() : '0' + num.toString() },
 
+        // 解码列式编码的出刀记录
+        decodeColumnar: function(data) {
+            const columns = data.columns;
+            const keys = Object.keys(columns);
+            const previous = {};
+            data.delta.forEach(key => previous[key] = 0);
+            const challenges = new Array(data.count);
+            for (let i = 0; i < data.count; i++) {
+                const c = {};
+                for (const key of keys) {
+                    let value = columns[key][i];
+                    if (key in previous) {
+                        value = previous[key] += value;
+                    } else if (key == 'qqid') {
+                        value = data.qqids[value];
+                    } else if (key == 'is_continue') {
+                        value = Boolean(value);
+                    }
+                    c[key] = value;
+                }
+                challenges[i] = c;
+            }
+            return challenges;
+        },
+
         fetchData: function() {
             const that = this;
-            axios.get('../api/').then(res=> {
-                if (res.data.code != 0) {
-                    that.$alert(res.data.message, '获取记录失败');
-                    that.isLoading = false;
-                    return;
-                }
-                that.allChallenges = res.data.challenges;
-                that.members = res.data.members;
-                if (that.members.filter((elem) => {return elem.qqid == that.selectingQQid}).length == 0) {
-                    that.selectingQQid = that.members[0].qqid;
-                }
-                that.refreshData();
-            }).catch(function (error) {
+            let challenges = [];
+            // 列式编码的记录分页获取  直到没有下一页(next_cid为null)
+            const fetchPage = function(afterCid) {
+                return axios.get('../api/?format=columnar&after_cid=' + afterCid).then(res=> {
+                    if (res.data.code != 0) {
+                        that.$alert(res.data.message, '获取记录失败');
+                        that.isLoading = false;
+                        return;
+                    }
+                    if (res.data.format == 'columnar') {
+                        challenges = challenges.concat(that.decodeColumnar(res.data.challenges));
+                    } else {
+                        challenges = challenges.concat(res.data.challenges);
+                    }
+                    if (res.data.next_cid != null) {
+                        return fetchPage(res.data.next_cid);
+                    }
+                    that.allChallenges = challenges;
+                    that.members = res.data.members;
+                    if (that.members.filter((elem) => {return elem.qqid == that.selectingQQid}).length == 0) {
+                        that.selectingQQid = that.members[0].qqid;
+                    }
+                    that.refreshData();
+                });
+            };
+            fetchPage(0).catch(function (error) {
                 that.$alert(error, '获取数据失败，请联系维护人员');
                 that.isLoading = false;
                 console.error(error);
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 与 main.py 相同  以 src/client 为根导入 ybplugins
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
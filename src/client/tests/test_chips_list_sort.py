@@ -0,0 +1,156 @@
+import random
+from typing import List, Optional
+
+import pytest
+
+from ybplugins.clan_battle.components.image_engine import chips_list_sort
+
+CHIPS_LIST_WIDTH = 400 - 10 - 29  # 与 chips_list 中的行宽一致
+CHIPS_INTERVAL = 5
+
+
+def _baseline_smaller_search(array: List[int], key, seek_map_array: Optional[List[int]] = None) -> Optional[int]:
+    """
+    原排版算法使用的二分查找  array降序  返回小于key的最大值下标
+    """
+    if array[-1] > key:
+        return None
+    length = len(array)
+    if not seek_map_array:
+        seek_map_array = [i for i in range(length)]
+    if length == 1:
+        return seek_map_array[0]
+    if length == 2:
+        return seek_map_array[0] if array[0] < key else seek_map_array[1]
+
+    half_seek = int(length / 2)
+
+    if array[half_seek] < key:
+        return _baseline_smaller_search(array[: half_seek + 1], key, seek_map_array[: half_seek + 1])
+    else:
+        return _baseline_smaller_search(array[half_seek + 1 :], key, seek_map_array[half_seek + 1 :])
+
+
+def _baseline_chips_list_sort(source_list: List[int], target_num: int, interval: int) -> List[List[int]]:
+    """
+    原排版算法(贪心)  source_list需要降序  会被修改
+    """
+    result_seek_list: List[List[int]] = []
+    address_map_list: List[int] = [i for i in range(len(source_list))]
+
+    while source_list:
+        result_seek_list.append([])
+        result_seek_list[-1].append(address_map_list[0])
+        current_width = source_list[0] + interval
+
+        source_list.pop(0)
+        address_map_list.pop(0)
+
+        if not source_list:
+            break
+        if current_width + source_list[-1] > target_num:
+            continue
+
+        while (current_width < target_num) and source_list:
+            target_seek = _baseline_smaller_search(source_list, target_num - current_width)
+            if target_seek is None:
+                break
+            result_seek_list[-1].append(address_map_list[target_seek])
+            current_width += source_list[target_seek] + interval
+
+            source_list.pop(target_seek)
+            address_map_list.pop(target_seek)
+
+            if not source_list:
+                break
+            if current_width + source_list[-1] > target_num:
+                break
+    return result_seek_list
+
+
+def _row_widths(widths: List[int], rows: List[List[int]]) -> List[List[int]]:
+    return [[widths[i] for i in row] for row in rows]
+
+
+def _check_layout(widths: List[int], rows: List[List[int]], target_num: int, interval: int) -> None:
+    # 每个chip恰好出现一次
+    assert sorted(i for row in rows for i in row) == list(range(len(widths)))
+    for row in rows:
+        assert row
+        # 只有超过行宽的chip会独占一行
+        if len(row) > 1:
+            assert sum(widths[i] for i in row) + interval * (len(row) - 1) <= target_num
+
+
+def _chips(rng: random.Random, count: int, low: int = 60, high: int = 200) -> List[int]:
+    """
+    降序的chip宽度  与 chips_list 传入的顺序一致
+    """
+    return sorted((rng.randint(low, high) for _ in range(count)), reverse=True)
+
+
+def test_empty():
+    assert chips_list_sort([], CHIPS_LIST_WIDTH, CHIPS_INTERVAL) == []
+
+
+def test_chip_wider_than_row():
+    assert chips_list_sort([CHIPS_LIST_WIDTH + 40], CHIPS_LIST_WIDTH, CHIPS_INTERVAL) == [[0]]
+
+    widths = [CHIPS_LIST_WIDTH + 40, 120, 100, 80]
+    rows = chips_list_sort(widths, CHIPS_LIST_WIDTH, CHIPS_INTERVAL)
+    assert rows[0] == [0]
+    _check_layout(widths, rows, CHIPS_LIST_WIDTH, CHIPS_INTERVAL)
+    assert len(rows) == 2
+
+
+def test_all_exact_fits():
+    # 100 + 5 + 100 + 5 + 100 == 310  每行恰好放满三个
+    widths = [100] * 6
+    rows = chips_list_sort(widths, 310, 5)
+    assert rows == [[0, 1, 2], [3, 4, 5]]
+
+    # 150 + 5 + 150 == 305  原算法放不下恰好填满的chip  多出一行
+    widths = [150, 150, 100, 100, 50]
+    rows = chips_list_sort(widths, 305, 5)
+    assert _row_widths(widths, rows) == [[150, 150], [100, 100, 50]]
+    assert len(_baseline_chips_list_sort(list(widths), 305, 5)) == 3
+
+    widths = [200, 200, 150, 150]
+    rows = chips_list_sort(widths, 355, 5)
+    assert _row_widths(widths, rows) == [[200, 150], [200, 150]]
+
+
+def test_source_list_not_mutated():
+    widths = [180, 150, 120, 90, 60]
+    chips_list_sort(widths, CHIPS_LIST_WIDTH, CHIPS_INTERVAL)
+    assert widths == [180, 150, 120, 90, 60]
+
+
+def test_equal_widths_keep_index_order():
+    assert chips_list_sort([100, 100, 100, 100], 210, 5) == [[0, 1], [2, 3]]
+
+
+@pytest.mark.parametrize("count", [1, 2, 5, 12, 30, 80])
+def test_same_layout_as_baseline_without_exact_fits(count):
+    """
+    宽度和间距都是偶数而行宽是奇数时不会出现恰好放满的行  此时两种算法的排版相同
+    """
+    rng = random.Random(count)
+    target_num = CHIPS_LIST_WIDTH if CHIPS_LIST_WIDTH % 2 else CHIPS_LIST_WIDTH + 1
+    for _ in range(50):
+        widths = [w * 2 for w in _chips(rng, count, 30, 100)]
+        rows = chips_list_sort(widths, target_num, CHIPS_INTERVAL + 1)
+        baseline = _baseline_chips_list_sort(list(widths), target_num, CHIPS_INTERVAL + 1)
+        _check_layout(widths, rows, target_num, CHIPS_INTERVAL + 1)
+        assert _row_widths(widths, rows) == _row_widths(widths, baseline)
+
+
+@pytest.mark.parametrize("count", [1, 3, 8, 15, 30, 60])
+def test_never_more_rows_than_baseline(count):
+    rng = random.Random(1000 + count)
+    for _ in range(100):
+        widths = _chips(rng, count, 40, 250)
+        rows = chips_list_sort(widths, CHIPS_LIST_WIDTH, CHIPS_INTERVAL)
+        baseline = _baseline_chips_list_sort(list(widths), CHIPS_LIST_WIDTH, CHIPS_INTERVAL)
+        _check_layout(widths, rows, CHIPS_LIST_WIDTH, CHIPS_INTERVAL)
+        assert len(rows) <= len(baseline)
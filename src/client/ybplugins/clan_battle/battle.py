@@ -1,10 +1,9 @@
-import asyncio
 from typing import Any, Dict
 from aiocqhttp.api import Api
 
 from .components.web_operation import register_routes
-from .components.kernel import init, execute, jobs, match
-from .components.score import score_table
+from .components.kernel import init, execute, execute_async, execute_challenge, jobs, match
+from .components.score import get_score_table, get_score_table_async, score_table
 from .components.realize import *
 from .components.realize import (_level_by_cycle, _get_nickname_by_qqid,
 				_get_group_previous_challenge, _update_group_list_async, 
@@ -21,20 +20,22 @@ class ClanBattle:
 	#### 核心
 	init = init			#初始化
 	execute = execute	#执行
+	execute_async = execute_async	#串行执行
+	execute_challenge = execute_challenge	#报刀/撤销
 	jobs = jobs			#验证
 	match = match		#匹配
 	#### 核心
 
 	#构造函数/初始化
 	def __init__(self, glo_setting:Dict[str, Any], bot_api:Api, boss_id_name:Dict, *args, **kwargs):
-		# data initialize
-		self._boss_status:Dict[str, asyncio.Future] = {}
 		self.init(glo_setting, bot_api, boss_id_name, args, kwargs)
 		
 	
 	register_routes = register_routes #网页端操作
 
 	score_table = score_table	#业绩
+	get_score_table = get_score_table	#业绩数据
+	get_score_table_async = get_score_table_async	#在数据库线程中获取业绩数据
 	text_2_pic = text_2_pic		#文字转图片
 
 	_level_by_cycle = _level_by_cycle									##等级周目
@@ -52,6 +53,8 @@ class ClanBattle:
 	bind_group = bind_group									##加入公会
 	drop_member = drop_member								##删除成员
 	boss_status_summary = boss_status_summary				##当前的boss状态
+	get_status_tier = get_status_tier					##状态输出档位
+	set_status_tier = set_status_tier					##设置状态输出档位
 	challenge = challenge									##报刀
 	undo = undo												##撤销上一刀的伤害/删除上一刀的记录
 	modify = modify											##修改boss状态
@@ -69,6 +72,7 @@ class ClanBattle:
 	report_hurt = report_hurt								##报伤害/记录伤害
 	challenger_info = challenger_info						##当前出刀信息
 	challenger_info_small = challenger_info_small			##单个boss出刀信息
+	get_boss_icon_ids = get_boss_icon_ids				##boss头像id
 	check_blade = check_blade								##检查是否已申请出刀
 	put_on_the_tree = put_on_the_tree						##挂树
 	take_it_of_the_tree = take_it_of_the_tree				##下树
@@ -79,8 +83,22 @@ class ClanBattle:
 	challenge_record = challenge_record						##出刀记录
 
 	get_report = get_report										##获取报告
+	iter_report = iter_report									##分块获取报告
+	encode_report_columnar = encode_report_columnar				##列式编码报告
+	get_report_delta = get_report_delta							##增量获取报告
 	get_battle_member_list = get_battle_member_list				##从会战记录里获取成员列表
 	get_member_list = get_member_list							##获取所有成员列表
+	get_report_async = get_report_async							##在数据库线程中获取报告
+	iter_report_async = iter_report_async						##在数据库线程中分块获取报告
+	get_report_delta_async = get_report_delta_async				##在数据库线程中增量获取报告
+	get_battle_member_list_async = get_battle_member_list_async	##在数据库线程中从会战记录里获取成员列表
+	get_member_list_async = get_member_list_async					##在数据库线程中获取所有成员列表
 	
 	query_tree = query_tree                                     ##查树
-	get_clan_group = get_clan_group
\ No newline at end of file
+	get_clan_group = get_clan_group
+	get_clan_state = get_clan_state
+	get_boss_status_hub = get_boss_status_hub
+	publish_boss_status = publish_boss_status
+	get_challenge_tombstones = get_challenge_tombstones
+	forget_group = forget_group
+	refresh_setting = refresh_setting
\ No newline at end of file
@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+
+import httpx
+
+_logger = logging.getLogger(__name__)
+
+AVATAR_URL = "http://q1.qlogo.cn/g?b=qq&nk={}&s=1"
+AVATAR_CONCURRENCY = 8  # 同时下载的头像数量  也是连接池的连接数上限
+AVATAR_TIMEOUT = 15  # 单个头像的下载超时时间(秒)
+AVATAR_INDEX_FILE = "index.json"
+AVATAR_RETRY_INTERVAL = 3600  # 下载失败后首次重试的间隔(秒)  之后每次失败翻倍
+AVATAR_RETRY_MAX_INTERVAL = 7 * 24 * 3600  # 下载失败后重试间隔的上限(秒)
+
+
+class AvatarIndex:
+    """
+    头像元数据索引  保存在头像目录的index.json中
+    记录每个头像的获取时间  ETag  Last-Modified  内容摘要  用于判断头像是否过期以及条件请求
+    没有元数据的已有头像以文件修改时间作为获取时间
+    下载失败的头像记录失败时间和连续失败次数  重试间隔随失败次数翻倍  避免反复下载已失效的头像
+
+    字段结构:
+        {QQ号: {"fetched_at": 获取时间戳, "etag": ETag, "last_modified": Last-Modified, "sha1": 内容摘要,
+                "failed_at": 最近一次失败的时间戳, "failures": 连续失败次数}}
+
+    :param path: 头像目录
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._entries: Optional[Dict[int, Dict[str, Any]]] = None
+        self._dirty = False
+        self._save_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def entries(self) -> Dict[int, Dict[str, Any]]:
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def _load(self) -> Dict[int, Dict[str, Any]]:
+        entries: Dict[int, Dict[str, Any]] = {}
+        try:
+            with open(self.path.joinpath(AVATAR_INDEX_FILE), encoding="utf-8") as f:
+                entries = {int(qqid): meta for qqid, meta in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError) as e:
+            _logger.warning(f"头像索引损坏  将重新建立: {e!r}")
+        if self.path.is_dir():
+            for entry in os.scandir(self.path):
+                stem, ext = os.path.splitext(entry.name)
+                if ext == ".jpg" and stem.isdigit() and int(stem) not in entries:
+                    entries[int(stem)] = {"fetched_at": entry.stat().st_mtime}
+                    self._dirty = True
+        return entries
+
+    def get(self, qqid: int) -> Optional[Dict[str, Any]]:
+        return self.entries.get(qqid)
+
+    def update(self, qqid: int, **meta) -> None:
+        """
+        更新头像的元数据  获取时间自动设为当前时间  清除失败记录
+        """
+        entry = self.entries.setdefault(qqid, {})
+        entry.pop("failed_at", None)
+        entry.pop("failures", None)
+        entry.update(meta, fetched_at=time.time())
+        self._dirty = True
+
+    def update_failed(self, qqid: int) -> None:
+        """
+        记录一次下载失败  获取时间不变
+        """
+        entry = self.entries.setdefault(qqid, {})
+        entry["failed_at"] = time.time()
+        entry["failures"] = entry.get("failures", 0) + 1
+        self._dirty = True
+
+    @staticmethod
+    def _retry_at(meta: Dict[str, Any]) -> float:
+        failures = meta.get("failures", 0)
+        if not failures:
+            return 0
+        return meta.get("failed_at", 0) + min(AVATAR_RETRY_INTERVAL * 2 ** (failures - 1), AVATAR_RETRY_MAX_INTERVAL)
+
+    def stale(self, max_age: float, limit: int) -> List[int]:
+        """
+        获取过期的头像  最久未更新的在前  下载失败且未到重试时间的头像不包括在内
+
+        :param max_age: 头像有效期(秒)
+        :param limit: 最多返回的数量
+        """
+        now = time.time()
+        deadline = now - max_age
+        expired = [
+            (meta.get("fetched_at", 0), qqid)
+            for qqid, meta in self.entries.items()
+            if meta.get("fetched_at", 0) < deadline and self._retry_at(meta) <= now
+        ]
+        expired.sort()
+        return [qqid for _, qqid in expired[:limit]]
+
+    async def save(self) -> None:
+        """
+        有修改时写入索引文件
+        在事件循环中复制索引  在线程中序列化并写入  同一时刻只有一次写入
+        """
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            data = {str(qqid): dict(meta) for qqid, meta in self.entries.items()}
+            self._dirty = False
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._write, data)
+            except BaseException:
+                self._dirty = True
+                raise
+
+    def _write(self, data: Dict[str, Dict[str, Any]]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        index_path = self.path.joinpath(AVATAR_INDEX_FILE)
+        temp_path = index_path.with_name(AVATAR_INDEX_FILE + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, index_path)
+
+
+class AvatarFetcher:
+    """
+    头像下载服务
+    所有下载共用一个长期保持的HTTP连接池  同时进行的下载不超过并发上限  其余的排队等待
+    同一个QQ号的下载正在排队或进行时  重复的请求直接等待同一个结果
+    头像先写入临时文件  下载完成后再替换  渲染时不会读到写了一半的图片
+    已有头像使用条件请求重新验证  未变化(304或内容相同)时不替换文件
+
+    :param path: 头像保存目录
+    :param on_update: 头像文件被替换后以QQ号调用  用于丢弃缓存
+    :param concurrency: 并发上限
+    """
+
+    def __init__(self, path: Path, on_update: Optional[Callable[[int], None]] = None, concurrency: int = AVATAR_CONCURRENCY) -> None:
+        self.path = path
+        self.on_update = on_update
+        self.concurrency = concurrency
+        self._client: Optional[httpx.AsyncClient] = None
+        self._queue: Deque[int] = deque()
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._workers = 0
+        self.index = AvatarIndex(path)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # 连接池需要在事件循环中创建  因此在首次下载时创建
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=AVATAR_TIMEOUT,
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+            )
+        return self._client
+
+    def file_path(self, qqid: int) -> Path:
+        return self.path.joinpath(f"{qqid}.jpg")
+
+    def fetch(self, qqid: int) -> "asyncio.Future[Optional[Path]]":
+        """
+        下载一个头像
+
+        :param qqid: QQ号
+        :return: 下载完成后得到文件路径的Future  下载失败时为None
+        """
+        qqid = int(qqid)
+        future = self._pending.get(qqid)
+        if future is None:
+            future = self._pending[qqid] = asyncio.get_event_loop().create_future()
+            self._queue.append(qqid)
+            if self._workers < self.concurrency:
+                self._workers += 1
+                asyncio.ensure_future(self._worker())
+        return asyncio.shield(future)  # 一个调用者取消等待不影响其他等待同一头像的调用者
+
+    async def fetch_many(self, qqids: Iterable[int]) -> List[Optional[Path]]:
+        """
+        下载多个头像并等待全部完成
+
+        :param qqids: QQ号
+        :return: 每个头像的文件路径  下载失败时为None
+        """
+        return await asyncio.gather(*[self.fetch(qqid) for qqid in qqids])
+
+    @property
+    def pending(self) -> int:
+        """
+        排队或正在下载的头像数量
+        """
+        return len(self._pending)
+
+    async def refresh_stale(self, max_age: float, limit: int) -> int:
+        """
+        重新验证过期的头像  用于定时任务  每次最多处理limit个  避免集中下载
+
+        :param max_age: 头像有效期(秒)
+        :param limit: 本次最多验证的数量
+        :return: 本次验证的数量
+        """
+        stale = self.index.stale(max_age, limit)
+        if stale:
+            await self.fetch_many(stale)
+        return len(stale)
+
+    async def _worker(self) -> None:
+        try:
+            while self._queue:
+                qqid = self._queue.popleft()
+                try:
+                    result = await self._download(qqid)
+                except Exception as e:
+                    _logger.warning(f"头像下载失败 {qqid}: {e!r}")
+                    self.index.update_failed(qqid)
+                    result = None
+                future = self._pending.pop(qqid)
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._workers -= 1
+            if not self._workers:  # 一轮下载结束后统一写入索引
+                try:
+                    await self.index.save()
+                except OSError as e:
+                    _logger.warning(f"头像索引保存失败: {e!r}")
+
+    async def _download(self, qqid: int) -> Path:
+        image_path = self.file_path(qqid)
+        temp_path = image_path.with_name(image_path.name + ".tmp")
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        meta = self.index.get(qqid) if image_path.is_file() else None
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        digest = hashlib.sha1()
+        try:
+            async with self.client.stream("GET", AVATAR_URL.format(qqid), headers=headers) as response:
+                if response.status_code == 304 and meta is not None:
+                    self.index.update(qqid)
+                    return image_path
+                if response.status_code != 200:
+                    raise ValueError(f"Image respond status code error: {response.status_code}")
+                with open(temp_path, "wb") as f:
+                    async for chunk in response.aiter_bytes():
+                        digest.update(chunk)
+                        f.write(chunk)
+                validators = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "sha1": digest.hexdigest(),
+                }
+            if meta is not None and meta.get("sha1") == validators["sha1"]:  # 服务器不支持条件请求  但内容没有变化
+                self.index.update(qqid, **validators)
+                return image_path
+            os.replace(temp_path, image_path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+        self.index.update(qqid, **validators)
+        if self.on_update is not None:
+            self.on_update(qqid)
+        return image_path
+
+    async def close(self) -> None:
+        """
+        关闭连接池
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import os
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, FrozenSet, List, Optional, Tuple
+
+HISTORY_SIZE = 64  # 每个公会保留的历史事件数量  断线重连时可补发
+KEEPALIVE_INTERVAL = 20  # 无事件时发送心跳的间隔(秒)
+
+# 每次启动生成不同的纪元  重启后旧的事件编号将失效  客户端会重新获取完整数据
+_EPOCH = os.urandom(4).hex()
+
+
+class BossStatusHub:
+    """
+    单个公会的boss状态广播
+    每次状态变化生成一个序号递增的事件  事件只包含发生变化的boss数据
+    所有连接的面板共享同一份事件历史  不会因为两次请求之间的变化而丢失事件
+    事件编号同时作为状态版本号  客户端可以凭版本号只获取之后发生变化的boss数据
+
+    :param boss_data: 当前的boss数据  结构同 _boss_data_dict()
+    :param base_cycle: 当前周目
+    """
+
+    def __init__(self, boss_data: Dict[int, Dict[str, Any]], base_cycle: int) -> None:
+        self.seq = 0
+        self.base_cycle = base_cycle
+        self.notice: Optional[str] = None
+        self._encoded_boss_data: Dict[int, str] = {}
+        self._joined_boss_data: Optional[str] = None
+        self._history: Deque[Tuple[int, str, FrozenSet[int]]] = deque(maxlen=HISTORY_SIZE)
+        self._waiter: Optional[asyncio.Future] = None
+        self._encode(boss_data)
+
+    @property
+    def event_id(self) -> str:
+        """
+        当前状态的事件编号  格式为 纪元-序号
+        """
+        return f"{_EPOCH}-{self.seq}"
+
+    def _encode(self, boss_data: Dict[int, Dict[str, Any]]) -> Dict[int, str]:
+        """
+        序列化boss数据并与上一次的结果比较
+
+        :return: 发生变化的boss的序列化数据
+        """
+        changed = {}
+        for boss_num, data in boss_data.items():
+            encoded = json.dumps(data, ensure_ascii=False, sort_keys=True)
+            if self._encoded_boss_data.get(boss_num) != encoded:
+                changed[boss_num] = encoded
+        if changed:
+            self._encoded_boss_data.update(changed)
+            self._joined_boss_data = None
+        return changed
+
+    @staticmethod
+    def _join(encoded_boss_data: Dict[int, str]) -> str:
+        return "{" + ",".join(f'"{boss_num}":{encoded}' for boss_num, encoded in sorted(encoded_boss_data.items())) + "}"
+
+    def publish(self, boss_data: Dict[int, Dict[str, Any]], base_cycle: int, notice: Optional[str] = None) -> None:
+        """
+        发布一次状态变化  数据没有变化且没有通知信息时不产生事件
+
+        :param boss_data: 变化后的boss数据  结构同 _boss_data_dict()
+        :param base_cycle: 变化后的周目
+        :param notice: 面板通知信息
+        """
+        changed = self._encode(boss_data)
+        if not changed and notice is None and base_cycle == self.base_cycle:
+            return
+        self.seq += 1
+        self.base_cycle = base_cycle
+        self.notice = notice
+        event = '{{"seq":{},"base_cycle":{},"notice":{},"bossData":{}}}'.format(
+            self.seq,
+            json.dumps(base_cycle),
+            json.dumps(notice, ensure_ascii=False),
+            self._join(changed),
+        )
+        self._history.append((self.seq, event, frozenset(changed)))
+        if self._waiter is not None:
+            if not self._waiter.done():
+                self._waiter.set_result(None)
+            self._waiter = None
+
+    def boss_data_json(self) -> str:
+        """
+        获取完整的boss数据的序列化数据  同一版本只序列化一次
+        """
+        if self._joined_boss_data is None:
+            self._joined_boss_data = self._join(self._encoded_boss_data)
+        return self._joined_boss_data
+
+    def boss_data_json_since(self, event_id: Optional[str]) -> Optional[str]:
+        """
+        获取某个版本之后发生变化的boss数据的序列化数据
+
+        :param event_id: 客户端已有数据的版本号(事件编号)
+        :return: 只包含变化的boss的数据  无法计算差异时返回None
+        """
+        events = self.events_since(event_id)
+        if events is None:
+            return None
+        changed = set()
+        for _, _, boss_nums in events:
+            changed.update(boss_nums)
+        return self._join({boss_num: self._encoded_boss_data[boss_num] for boss_num in changed})
+
+    def snapshot(self) -> str:
+        """
+        获取完整状态的序列化数据
+        """
+        return '{{"seq":{},"base_cycle":{},"bossData":{}}}'.format(
+            self.seq,
+            json.dumps(self.base_cycle),
+            self.boss_data_json(),
+        )
+
+    def boss_data(self) -> Dict[int, Dict[str, Any]]:
+        """
+        获取完整的boss数据
+        """
+        return {boss_num: json.loads(encoded) for boss_num, encoded in self._encoded_boss_data.items()}
+
+    def events_since(self, event_id: Optional[str]) -> Optional[List[Tuple[int, str, FrozenSet[int]]]]:
+        """
+        获取某个事件之后的所有事件
+
+        :param event_id: 客户端最后收到的事件编号
+        :return: [(序号, 事件数据, 变化的boss编号)]  无法补发(编号无效或历史已被覆盖)时返回None
+        """
+        if not event_id:
+            return None
+        epoch, _, seq = event_id.partition("-")
+        if epoch != _EPOCH or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self._history or self._history[0][0] > seq + 1:
+            return None
+        return [i for i in self._history if i[0] > seq]
+
+    async def wait(self, seq: int, timeout: Optional[float] = None) -> bool:
+        """
+        等待序号为seq之后的事件
+
+        :param seq: 已知的最新序号
+        :param timeout: 超时时间(秒)
+        :return: 是否有新事件
+        """
+        if self.seq > seq:
+            return True
+        if self._waiter is None:
+            self._waiter = asyncio.get_event_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._waiter), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def listen(self, event_id: Optional[str] = None) -> AsyncIterator[Tuple[str, Optional[str], str]]:
+        """
+        持续获取事件  用于Server-Sent Events推送
+
+        :param event_id: 客户端最后收到的事件编号  为空或无法补发时先推送完整状态
+        :return: (事件类型, 事件编号, 数据)  事件类型为 sync/update/keepalive
+        """
+        events = self.events_since(event_id)
+        if events is None:
+            seq = self.seq
+            yield "sync", f"{_EPOCH}-{seq}", self.snapshot()
+        else:
+            seq = int(event_id.partition("-")[2])
+        while True:
+            if not await self.wait(seq, KEEPALIVE_INTERVAL):
+                yield "keepalive", None, ""
+                continue
+            events = self.events_since(f"{_EPOCH}-{seq}")
+            if events is None:  # 客户端过慢  历史已被覆盖
+                seq = self.seq
+                yield "sync", f"{_EPOCH}-{seq}", self.snapshot()
+                continue
+            for event_seq, data, _ in events:
+                seq = event_seq
+                yield "update", f"{_EPOCH}-{event_seq}", data
@@ -0,0 +1,133 @@
+from typing import Dict, Optional, Tuple
+
+from ...ybdata import Clan_challenge
+
+_DayKey = Tuple[int, int, int]  # (群号, 档案号, 日期)
+
+
+class MemberDailyBlade:
+    """
+    单个成员一天内的出刀计数
+
+    total: 出刀记录总数
+    finished: 完整刀数量(未击败boss的刀以及补偿刀)
+    tail: 收尾刀数量(击败boss且不是补偿刀)
+    cont: 已出补偿刀数量
+    """
+
+    __slots__ = ("total", "finished", "tail", "cont")
+
+    def __init__(self) -> None:
+        self.total = 0
+        self.finished = 0
+        self.tail = 0
+        self.cont = 0
+
+    def add(self, boss_health_remain: int, is_continue: bool, count: int = 1) -> None:
+        """
+        计入一条出刀记录  count为-1时为移除该记录
+
+        :param boss_health_remain: 出刀后boss剩余血量
+        :param is_continue: 是否是补偿刀
+        """
+        self.total += count
+        if boss_health_remain or is_continue:
+            self.finished += count
+        if boss_health_remain == 0 and not is_continue:
+            self.tail += count
+        if is_continue:
+            self.cont += count
+
+    @property
+    def cont_blade(self) -> int:
+        """
+        剩余补偿刀数量
+        """
+        return self.total - self.finished - self.cont
+
+
+class DailyBladeIndex:
+    """
+    成员每日出刀计数索引
+    按(群号, 档案号, 日期)整天从数据库加载一次  之后随报刀/撤销增量更新
+    未加载的日期会在首次查询时从数据库重建  因此重启或跨日后无需额外处理
+    """
+
+    def __init__(self) -> None:
+        self._days: Dict[_DayKey, Dict[int, MemberDailyBlade]] = {}
+
+    def _load_day(self, key: _DayKey) -> Dict[int, MemberDailyBlade]:
+        gid, bid, pcrdate = key
+        members: Dict[int, MemberDailyBlade] = {}
+        for qqid, boss_health_remain, is_continue in Clan_challenge.select(
+            Clan_challenge.qqid,
+            Clan_challenge.boss_health_remain,
+            Clan_challenge.is_continue,
+        ).where(
+            Clan_challenge.gid == gid,
+            Clan_challenge.bid == bid,
+            Clan_challenge.challenge_pcrdate == pcrdate,
+        ).tuples():
+            if qqid not in members:
+                members[qqid] = MemberDailyBlade()
+            members[qqid].add(boss_health_remain, is_continue)
+
+        # 只保留本群前一天及以后的计数  其余的日期已不会再被报刀
+        for old_key in [k for k in self._days if k[0] == gid and k[2] < pcrdate - 1]:
+            del self._days[old_key]
+        self._days[key] = members
+        return members
+
+    def get_day(self, gid: int, bid: int, pcrdate: int) -> Dict[int, MemberDailyBlade]:
+        """
+        获取一个公会一天内所有成员的出刀计数
+
+        :return: {QQ号: 出刀计数}  只包含当天有出刀记录的成员
+        """
+        key = (int(gid), bid, pcrdate)
+        members = self._days.get(key)
+        if members is None:
+            members = self._load_day(key)
+        return members
+
+    def get(self, gid: int, bid: int, pcrdate: int, qqid: int) -> MemberDailyBlade:
+        """
+        获取单个成员一天内的出刀计数
+        QQ号可以是字符串  与数据库查询一样按整数比较
+        """
+        return self.get_day(gid, bid, pcrdate).get(int(qqid)) or MemberDailyBlade()
+
+    def day_total(self, gid: int, bid: int, pcrdate: int) -> int:
+        """
+        获取一个公会一天内的出刀记录总数
+        """
+        return sum(c.total for c in self.get_day(gid, bid, pcrdate).values())
+
+    def record(self, challenge: Clan_challenge, count: int = 1) -> None:
+        """
+        增量计入一条新的出刀记录  count为-1时为撤销该记录
+        对应日期未加载时无需处理  下次查询时会从数据库重建
+        """
+        members = self._days.get((int(challenge.gid), challenge.bid, challenge.challenge_pcrdate))
+        if members is None:
+            return
+        qqid = int(challenge.qqid)
+        if qqid not in members:
+            members[qqid] = MemberDailyBlade()
+        members[qqid].add(challenge.boss_health_remain, challenge.is_continue, count)
+
+    def remove(self, challenge: Clan_challenge) -> None:
+        """
+        移除一条被撤销的出刀记录
+        """
+        self.record(challenge, -1)
+
+    def invalidate(self, gid: int, bid: Optional[int] = None) -> None:
+        """
+        丢弃一个公会的计数  在批量删除出刀记录后调用
+
+        :param bid: 档案号  为None时丢弃所有档案
+        """
+        gid = int(gid)
+        for key in [k for k in self._days if k[0] == gid and (bid is None or k[1] == bid)]:
+            del self._days[key]
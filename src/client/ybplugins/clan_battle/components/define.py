@@ -51,3 +51,10 @@ Server = {
 	'韩': 'kr',
 	'国': 'cn',
 }
+
+#状态输出档位，开销从高到低
+StatusTier = {
+	'完整': 'full',
+	'简略': 'reduced',
+	'文字': 'text',
+}
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ...db_executor import db_executor
+from .state import ClanState
+
+_logger = logging.getLogger(__name__)
+
+_Job = Tuple[Callable[..., Any], tuple, dict, asyncio.Future]
+
+
+class GroupCommandExecutor:
+    """
+    公会操作串行执行器
+    同一公会的修改操作按提交顺序依次执行  不同公会之间互不阻塞
+    每个公会在有待执行操作时才会持有一个工作协程  队列清空后自动退出
+
+    同一轮取出的操作会合并持久化  所有操作执行完毕后公会状态在数据库写线程中只写入一次
+    操作的结果在持久化完成后才会返回给调用者
+
+    操作可以是同步函数或协程函数
+    同步函数执行期间持有数据库写锁  其中零散的写入与写线程中的写入互斥
+    协程函数(如报刀、撤销)将写入交给写线程执行  自行在访问数据库的同步片段中持有写锁
+    写锁被写线程持有时让出事件循环等待  等待时间不超过一个写事务
+
+    :param state_getter: 通过群号获取公会运行时状态的函数  公会不存在时返回None
+    """
+
+    def __init__(self, state_getter: Callable[[int], Optional[ClanState]]) -> None:
+        self._state_getter = state_getter
+        self._queues: Dict[int, List[_Job]] = {}
+
+    async def submit(self, group_id: int, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        提交一个操作并等待其执行完毕
+
+        :param group_id: QQ群号
+        :param func: 需要执行的同步函数或协程函数
+        :return: 函数的返回值  函数抛出的异常会原样抛出
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        queue = self._queues.get(group_id)
+        if queue is None:
+            queue = self._queues[group_id] = []
+            queue.append((func, args, kwargs, future))
+            asyncio.ensure_future(self._worker(group_id))
+        else:
+            queue.append((func, args, kwargs, future))
+        return await future
+
+    def pending(self, group_id: int) -> int:
+        """
+        获取公会待执行的操作数量
+
+        :param group_id: QQ群号
+        """
+        return len(self._queues.get(group_id, ()))
+
+    def discard(self, group_id: int, error: Exception) -> None:
+        """
+        丢弃公会尚未执行的操作  等待中的调用者收到error
+        正在执行的一轮操作不受影响
+
+        :param group_id: QQ群号
+        :param error: 交给调用者的异常
+        """
+        queue = self._queues.get(group_id)
+        if not queue:
+            return
+        jobs = queue[:]
+        queue.clear()
+        for _, _, _, future in jobs:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _worker(self, group_id: int) -> None:
+        queue = self._queues[group_id]
+        try:
+            while queue:
+                batch = queue[:]
+                queue.clear()
+                await self._run_batch(group_id, batch)
+                await asyncio.sleep(0)  # 让出事件循环  以便积累下一轮操作
+        finally:
+            del self._queues[group_id]
+
+    async def _run_batch(self, group_id: int, batch: List[_Job]) -> None:
+        results = []
+        state = self._state_getter(group_id)
+        try:
+            if state is None:
+                for job in batch:
+                    results.append(await self._run_job(job))
+            else:
+                with state.batched(persist=False):
+                    for job in batch:
+                        results.append(await self._run_job(job))
+                await state.flush()
+        except Exception as e:
+            _logger.exception(e)
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, _, future), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    @staticmethod
+    async def _run_job(job: _Job) -> Tuple[bool, Any]:
+        func, args, kwargs, _ = job
+        try:
+            if asyncio.iscoroutinefunction(func):
+                return True, await func(*args, **kwargs)
+            async with db_executor.write_locked():
+                return True, func(*args, **kwargs)
+        except Exception as e:
+            return False, e
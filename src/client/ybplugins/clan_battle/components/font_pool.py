@@ -0,0 +1,82 @@
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from PIL import ImageFont
+
+FONTS_PATH = os.path.join(os.path.dirname(__file__), "fonts")
+DEFAULT_FONT = os.path.join(FONTS_PATH, "msyh.ttf")
+
+
+class FontPool:
+    """
+    字体对象池
+    字体对象按线程保存  不在线程之间共享
+    FreeType字体对象不能被多个线程同时使用  共享并加锁会让所有绘图串行
+    绘图都在渲染服务(RenderService)的渲染线程中执行  同一字号在每个渲染线程中各加载一次  之后在该线程内复用
+    内存中同一字号的字体对象最多有渲染线程数量份
+
+    备用字体只在字体文件不存在时使用  按顺序取第一个存在的文件
+    字体中缺少某个字符时不会逐字改用备用字体
+
+    :param path: 字体文件路径
+    :param fallbacks: 备用字体文件路径  字体文件不存在时依次尝试
+    """
+
+    def __init__(self, path: str, fallbacks: Iterable[str] = ()) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._generation = 0
+        self._font_path: Optional[str] = None
+        self.path = path
+        self.fallbacks: List[str] = []
+        self.set_fallbacks(fallbacks)
+
+    def set_fallbacks(self, fallbacks: Iterable[str]) -> None:
+        """
+        设置备用字体  已加载的字体会在下次使用时重新加载
+
+        :param fallbacks: 备用字体文件路径  相对路径以fonts文件夹为基准
+        """
+        with self._lock:
+            self.fallbacks = [os.path.join(FONTS_PATH, i) for i in fallbacks]
+            self._font_path = None
+            self._generation += 1
+
+    @property
+    def font_path(self) -> str:
+        """
+        实际使用的字体文件路径
+        """
+        with self._lock:
+            if self._font_path is None:
+                self._font_path = next((i for i in [self.path, *self.fallbacks] if os.path.isfile(i)), self.path)
+            return self._font_path
+
+    def get(self, size: int) -> ImageFont.FreeTypeFont:
+        """
+        获取当前线程中指定字号的字体  返回的对象不能交给其他线程使用
+
+        :param size: 字号
+        """
+        local = self._local
+        fonts: Optional[Dict[int, ImageFont.FreeTypeFont]] = getattr(local, "fonts", None)
+        if fonts is None or local.generation != self._generation:
+            fonts = local.fonts = {}
+            local.generation = self._generation
+        font = fonts.get(size)
+        if font is None:
+            font = fonts[size] = ImageFont.truetype(self.font_path, size)
+        return font
+
+
+font_pool = FontPool(DEFAULT_FONT)
+
+
+def get_font(size: int) -> ImageFont.FreeTypeFont:
+    """
+    从全局字体对象池获取指定字号的字体
+
+    :param size: 字号
+    """
+    return font_pool.get(size)
@@ -1,33 +1,18 @@
 from typing import Dict, List
-import json
 
-from ...ybdata import Clan_group
+from .state import ClanState
 
 
 class SubscribeHandler:
-    def __init__(self, group: Clan_group) -> None:
+    def __init__(self, state: ClanState) -> None:
         """
         预约系统处理核心
+        直接操作公会运行时状态中的预约表  修改后需调用save()方法持久化
 
-        :param group: Clan_group公会实例
+        :param state: ClanState公会运行时状态
         """
-        """
-        转换为方便处理内部的类型
-        原始类型: Dict[str, Dict[str, str]] = {Boss编号: {预约QQ号: 留言}}
-        目标类型: Dict[int, Dict[int, str]] = {Boss编号: {预约QQ号: 留言}}
-        """
-        if group.subscribe_list:
-            data: Dict[str, Dict[str, str]] = json.loads(group.subscribe_list)
-        else:
-            data = {}
-        new_data: Dict[int, Dict[int, str]] = {}
-        for boss_no, boss_subscribe_data in data.items():
-            new_boss_subscribe_data = {}
-            for subscribe_qq, subscribe_note in boss_subscribe_data.items():
-                new_boss_subscribe_data[int(subscribe_qq)] = subscribe_note
-                new_data[int(boss_no)] = new_boss_subscribe_data
-        self._data: Dict[int, Dict[int, str]] = new_data
-        self._clan_group: Clan_group = group
+        self._data: Dict[int, Dict[int, str]] = state.subscribe_list
+        self._state: ClanState = state
 
     def subscribe(self, user_id: int, boss_id: int, note: str = "") -> None:
         """
@@ -103,5 +88,4 @@ class SubscribeHandler:
         return dict(sorted(self._data.items(), key=lambda i: i[0]))
 
     def save(self) -> None:
-        self._clan_group.subscribe_list = json.dumps(self._data)
-        self._clan_group.save()
+        self._state.save()
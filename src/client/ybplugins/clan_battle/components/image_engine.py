@@ -1,20 +1,30 @@
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFilter
 import os
-from typing import Tuple, List, Optional, Dict, Set, Union, Any
+from typing import Tuple, List, Optional, Dict, Set, Union, Any, FrozenSet, Iterable
 from pathlib import Path
-import httpx
-import asyncio
 import logging
+import threading
 import time
+from bisect import bisect_right
+from collections import OrderedDict
+
+from .avatar import AvatarFetcher
+from .font_pool import get_font
 
 _logger = logging.getLogger(__name__)
 
 FILE_PATH = os.path.dirname(__file__)
-FONTS_PATH = os.path.join(FILE_PATH, "fonts")
-FONTS = os.path.join(FONTS_PATH, "msyh.ttf")
 USER_HEADERS_PATH = Path(__file__).parent.joinpath("../../../yobot_data/user_profile")
 BOSS_ICON_PATH = Path(__file__).parent.joinpath("../../../public/libs/yocool@final/princessadventure/boss_icon")
 
+TEXT_IMAGE_CACHE_SIZE = 512  # 文字图片缓存数量
+STATUS_IMAGE_CACHE_SIZE = 16  # 保留状态图渲染缓存的公会数量
+MASK_CACHE_SIZE = 128  # 圆角遮罩缓存数量
+SHADOW_CACHE_SIZE = 32  # 阴影层缓存数量  阴影层与模块一样大  数量不宜过多
+AVATAR_CACHE_SIZE = 256  # 头像缩略图缓存数量
+USER_PROFILE_SIZE = 20  # chip中头像的边长
+BOSS_HEADER_SIZE = 75  # boss面板中头像的边长
+
 glovar_missing_user_id: Set[int] = set()
 
 
@@ -125,10 +135,86 @@ class BackGroundGenerator:
         raise IndexError("Unknown operation type flag")
 
 
+class ImageLRUCache:
+    """
+    图片LRU缓存
+    缓存中的图片不会被交给调用者  每次获取都返回副本  调用者可以随意修改或关闭
+
+    :param maxsize: 最大缓存数量
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__cache: "OrderedDict[Any, Image.Image]" = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: Any, factory, *args) -> Image.Image:
+        """
+        获取缓存的图片  未命中时调用factory(*args)生成并缓存
+
+        :param key: 缓存键
+        :param factory: 生成图片的函数
+        :return: 图片副本
+        """
+        with self.__lock:
+            image = self.__cache.get(key)
+            if image is not None:
+                self.__cache.move_to_end(key)
+                self.hits += 1
+                return image.copy()
+            self.misses += 1
+        image = factory(*args)
+        result = image.copy()
+        with self.__lock:
+            self.__cache[key] = image
+            self.__cache.move_to_end(key)
+            while len(self.__cache) > self.maxsize:
+                self.__cache.popitem(last=False)[1].close()
+        return result
+
+    def discard(self, key: Any) -> None:
+        """
+        丢弃一项缓存  不存在时忽略
+        """
+        with self.__lock:
+            image = self.__cache.pop(key, None)
+        if image is not None:
+            image.close()
+
+    def clear(self) -> None:
+        with self.__lock:
+            for image in self.__cache.values():
+                image.close()
+            self.__cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.__cache)
+
+
+text_image_cache = ImageLRUCache(TEXT_IMAGE_CACHE_SIZE)
+# 圆角遮罩与阴影层只与大小和颜色有关  与图像内容无关
+mask_cache = ImageLRUCache(MASK_CACHE_SIZE)
+shadow_cache = ImageLRUCache(SHADOW_CACHE_SIZE)
+# 已缩放并切好圆角的头像  以QQ号为键  头像文件被重新下载时丢弃
+avatar_cache = ImageLRUCache(AVATAR_CACHE_SIZE)
+
+
 def get_font_image(text: str, size: int, color: Tuple[int, int, int] = (0, 0, 0)) -> Image.Image:
     if "\n" in text:
         return get_font_image_vertical(text, size, color)
-    image_font = ImageFont.truetype(FONTS, size)
+    return text_image_cache.get((text, size, tuple(color), False), _render_font_image, text, size, color)
+
+
+def get_font_image_vertical(text: str, size: int, color: Tuple[int, int, int] = (0, 0, 0)) -> Image.Image:
+    return text_image_cache.get((text, size, tuple(color), True), _render_font_image_vertical, text, size, color)
+
+
+def _render_font_image(text: str, size: int, color: Tuple[int, int, int]) -> Image.Image:
+    image_font = get_font(size)
     font_box = image_font.getbbox(text=text)
     background = Image.new("RGBA", (font_box[2] - font_box[0], font_box[3] - font_box[1]), (255, 255, 255, 0))
     background_draw = ImageDraw.Draw(background)
@@ -136,7 +222,7 @@ def get_font_image(text: str, size: int, color: Tuple[int, int, int] = (0, 0, 0)
     return background
 
 
-def get_font_image_vertical(text: str, size: int, color: Tuple[int, int, int] = (0, 0, 0)) -> Image.Image:
+def _render_font_image_vertical(text: str, size: int, color: Tuple[int, int, int]) -> Image.Image:
     VERTICAL_PIXEL = round(size / 3)
     background = BackGroundGenerator(color=(255, 255, 255, 0))
     current_height = 0
@@ -157,9 +243,9 @@ def center(source_image: Image.Image, target_image: Image.Image) -> Tuple[int, i
     return tuple(result)
 
 
-def round_corner(image: Image.Image, radius: Optional[int] = None) -> Image.Image:
+def _round_corner_mask(image_size: Tuple[int, int], radius: Optional[int]) -> Image.Image:
     if radius is None:
-        size = image.height
+        size = image_size[1]
     else:
         size = radius * 2
 
@@ -172,9 +258,9 @@ def round_corner(image: Image.Image, radius: Optional[int] = None) -> Image.Imag
         circle_split_cursor_x = round(circle_bg.size[0] / 2)
         circle_split = (circle_bg.crop((0, 0, circle_split_cursor_x, size)), circle_bg.crop((circle_split_cursor_x, 0, size, size)))
 
-        mask = Image.new("L", image.size, 255)  # 已确保关闭
+        mask = Image.new("L", image_size, 255)
         mask.paste(circle_split[0], (0, 0))
-        mask.paste(circle_split[1], (image.width - circle_split[1].width, 0))
+        mask.paste(circle_split[1], (image_size[0] - circle_split[1].width, 0))
     else:
         circle_split = (
             circle_bg.crop((0, 0, radius, radius)),
@@ -182,17 +268,23 @@ def round_corner(image: Image.Image, radius: Optional[int] = None) -> Image.Imag
             circle_bg.crop((0, radius, radius, radius * 2)),
             circle_bg.crop((radius, radius, radius * 2, radius * 2)),
         )
-        mask = Image.new("L", image.size, 255)  # 已确保关闭
+        mask = Image.new("L", image_size, 255)
         mask.paste(circle_split[0], (0, 0))
-        mask.paste(circle_split[1], (image.width - radius, 0))
-        mask.paste(circle_split[2], (0, image.height - radius))
-        mask.paste(circle_split[3], (image.width - radius, image.height - radius))
+        mask.paste(circle_split[1], (image_size[0] - radius, 0))
+        mask.paste(circle_split[2], (0, image_size[1] - radius))
+        mask.paste(circle_split[3], (image_size[0] - radius, image_size[1] - radius))
+
+    circle_bg.close()
+    return mask
+
+
+def round_corner(image: Image.Image, radius: Optional[int] = None) -> Image.Image:
+    mask = mask_cache.get((image.size, radius), _round_corner_mask, image.size, radius)  # 已确保关闭
 
     mask_paste_bg = Image.new("RGBA", image.size, (255, 255, 255, 0))  # 已确保关闭
 
     result = Image.composite(image, mask_paste_bg, mask)
 
-    circle_bg.close()
     mask_paste_bg.close()
     mask.close()
     image.close()
@@ -200,17 +292,35 @@ def round_corner(image: Image.Image, radius: Optional[int] = None) -> Image.Imag
     return result
 
 
+def _render_avatar_thumbnail(user_profile_path: Path) -> Image.Image:
+    with Image.open(user_profile_path, "r") as user_profile_image:
+        head_icon = user_profile_image.resize((USER_PROFILE_SIZE, USER_PROFILE_SIZE))
+    return round_corner(head_icon)
+
+
+def get_avatar_thumbnail(user_id: str) -> Image.Image:
+    """
+    获取已缩放并切好圆角的头像  头像文件不存在时返回透明图片并记录以便下载
+
+    :param user_id: QQ号
+    """
+    user_profile_path = USER_HEADERS_PATH.joinpath(user_id + ".jpg")
+    if not user_profile_path.is_file():
+        glovar_missing_user_id.add(int(user_id))
+        return Image.new("RGBA", (USER_PROFILE_SIZE, USER_PROFILE_SIZE), (255, 255, 255, 0))
+    return avatar_cache.get(user_id, _render_avatar_thumbnail, user_profile_path)
+
+
 def user_chips(head_icon: Image.Image, user_name: str, background_color: Tuple[int, int, int] = (189, 189, 189)) -> Image.Image:
+    """
+    :param head_icon: 已缩放并切好圆角的头像  见 get_avatar_thumbnail()
+    """
     OVERALL_CHIPS_LIST_WITH = 400 - 10  # 左右各5边距
     CHIPS_LIST_WIDTH = OVERALL_CHIPS_LIST_WITH - 29
     TEXT_MAXIMUM_WIDTH = CHIPS_LIST_WIDTH - 35  # 25为chip本身  10为chip自己外边距以及user_chips外边距
-    USER_PROFILE_SIZE = 20
     USER_NICKNAME_FONTSIZE = 20
     CHIPS_HEIGHT = 20
 
-    head_icon = head_icon.resize((USER_PROFILE_SIZE, USER_PROFILE_SIZE))
-    head_icon = round_corner(head_icon)
-
     text_color = (255, 255, 255) if ((background_color[0] * 0.299 + background_color[1] * 0.587 + background_color[2] * 0.114) / 255) < 0.5 else (0, 0, 0)
 
     user_name_image = get_font_image(user_name, USER_NICKNAME_FONTSIZE, text_color)
@@ -226,75 +336,55 @@ def user_chips(head_icon: Image.Image, user_name: str, background_color: Tuple[i
     return round_corner(background.generate())
 
 
-def smaller_search(array: List[int], key, seek_map_array: Optional[List[int]] = None) -> Optional[int]:
+def _take_largest(available: List[int], seek: int) -> int:
     """
-    使用二分查找法搜索目标对象的下标
-    二分查找法变种  因为查找的不是全等于key的值
+    查找不大于seek的最大的未放置位置并将其标记为已放置
+    available为并查集  available[i]指向不大于i的未放置位置  -1表示不存在
 
-    :param array: 输入列表(必须有序且降序)
-    :param key: 目标数值
-    :param seek_map_array: 用于递归时传递下标map列表
-    :result: array中小于key的最大值下标
+    :return: 位置  不存在时返回-1
     """
-    if array[-1] > key:
-        return None
-    length = len(array)
-    if not seek_map_array:
-        seek_map_array = [i for i in range(length)]
-    if length == 1:
-        return seek_map_array[0]
-    if length == 2:
-        return seek_map_array[0] if array[0] < key else seek_map_array[1]
-
-    half_seek = int(length / 2)
-
-    if array[half_seek] < key:
-        return smaller_search(array[: half_seek + 1], key, seek_map_array[: half_seek + 1])  # 中位数比key小  目标一定在左边  需要包含中位数本身
-    else:
-        return smaller_search(array[half_seek + 1 :], key, seek_map_array[half_seek + 1 :])  # 中位数比key大  目标一定在右边  不包含中位数本身
+    root = seek
+    while root >= 0 and available[root] != root:
+        root = available[root]
+    while seek >= 0 and available[seek] != seek:  # 路径压缩
+        available[seek], seek = root, available[seek]
+    if root >= 0:
+        available[root] = root - 1
+    return root
 
 
 def chips_list_sort(source_list: List[int], target_num: int, interval: int) -> List[List[int]]:
     """
-    用户 chips 排版算法
-    以从长到短chip为基础不断与短到长的chip匹配并添加  直至行宽超过最大值后换行
+    用户 chips 排版算法(降序首次适应 First Fit Decreasing)
+    以剩余最长的chip开始新的一行  不断加入放得下的最长的chip  直至没有chip能放入这一行后换行
+    剩余chip按宽度升序排列  二分查找放得下的最长chip  并查集跳过已放置的chip  复杂度O(n log n)
+
+    :param source_list: chip宽度列表
+    :param target_num: 行宽
+    :param interval: chip间距
+    :result: 每一行的chip在source_list中的下标 [行号][chips 列号]  宽度相同时下标小的优先
     """
-
-    result_seek_list: List[List[int]] = []  # 存储输出结果(下标) [行号][chips 列号]
-    __address_map_list: List[int] = [i for i in range(len(source_list))]  # 存储结果对应下标
-
-    while source_list:
-        result_seek_list.append([])
-        result_seek_list[-1].append(__address_map_list[0])  # 从长(前)到短(后)
-        current_width = source_list[0] + interval
-
-        source_list.pop(0)
-        __address_map_list.pop(0)
-
-        if not source_list:  # 没有待处理的chip了
+    order = sorted(range(len(source_list)), key=lambda i: (source_list[i], -i))  # 宽度升序  同宽时下标小的在后
+    widths = [source_list[i] for i in order]
+    available = list(range(len(order)))
+
+    result_seek_list: List[List[int]] = []
+    while True:
+        seek = _take_largest(available, len(order) - 1)  # 剩余最长的chip  即使超过行宽也独占一行
+        if seek < 0:
             break
-        if current_width + source_list[-1] > target_num:  # 这一行(当前待处理队列最长)的chip加上最短(索引最大)的chip已经超过行宽了  需要独占一行
-            continue
-
-        while (current_width < target_num) and source_list:  # 在待处理队列不为空且已使用的行宽不超过最大行宽前  不断从长到短添加chip
-            target_seek = smaller_search(source_list, target_num - current_width)
-            if target_seek is None:
-                break
-            result_seek_list[-1].append(__address_map_list[target_seek])
-            current_width += source_list[target_seek] + interval  # 记录这个chip宽及间距
-
-            source_list.pop(target_seek)
-            __address_map_list.pop(target_seek)
-
-            if not source_list:  # 没有待处理的chip了
-                break
-            if current_width + source_list[-1] > target_num:  # 这一行(当前待处理队列最长)的chip加上最短(索引最大)的chip已经超过行宽了  这一行已经完全没法放置新chip了
+        result_seek_list.append([order[seek]])
+        current_width = widths[seek] + interval
+        while True:
+            seek = _take_largest(available, bisect_right(widths, target_num - current_width) - 1)
+            if seek < 0:
                 break
+            result_seek_list[-1].append(order[seek])
+            current_width += widths[seek] + interval
     return result_seek_list
 
 
 def chips_list(chips_array: Dict[str, Any] = {}, text: str = "内容", background_color: Tuple[int, int, int] = (255, 255, 255)) -> Image.Image:
-    global glovar_missing_user_id
     OVERALL_CHIPS_LIST_WITH = 400 - 10  # 左右各5边距
     CHIPS_LIST_WIDTH = OVERALL_CHIPS_LIST_WITH - 29
     CHIPS_INTERVAL = 5
@@ -320,13 +410,7 @@ def chips_list(chips_array: Dict[str, Any] = {}, text: str = "内容", backgroun
             continue
         if not isinstance(user_nickname, str):
             continue
-        user_profile_path = USER_HEADERS_PATH.joinpath(user_id + ".jpg")
-        if not user_profile_path.is_file():
-            user_profile_image = Image.new("RGBA", (20, 20), (255, 255, 255, 0))  # 已确保关闭
-            glovar_missing_user_id.add(int(user_id))
-        else:
-            user_profile_image = Image.open(USER_HEADERS_PATH.joinpath(user_id + ".jpg"), "r")  # 已确保关闭
-        chips_image_list.append(user_chips(user_profile_image, user_nickname, chips_color))
+        chips_image_list.append(user_chips(get_avatar_thumbnail(user_id), user_nickname, chips_color))
 
     chips_image_list.sort(key=lambda i: i.width, reverse=True)
 
@@ -373,6 +457,47 @@ class GroupStateBlock:
         self.background_color = background_color
 
 
+def _chips_fingerprint(chips_array: Dict[str, Dict[str, Any]]) -> tuple:
+    """
+    chips列表的指纹  包含头像文件的修改时间  头像更新后会重新渲染
+    """
+    result = []
+    for title, chips in chips_array.items():
+        items = []
+        for key, value in chips.items():
+            avatar_mtime = None
+            if key.isdigit():
+                try:
+                    avatar_mtime = USER_HEADERS_PATH.joinpath(key + ".jpg").stat().st_mtime_ns
+                except OSError:
+                    pass
+            items.append((key, value, avatar_mtime))
+        result.append((title, tuple(items)))
+    return tuple(result)
+
+
+class ProcessImageCore:
+    """
+    公会状态图片(完整刀 阶段 补偿)  生成前可以计算指纹用于缓存
+
+    :param data: 状态块
+    :param chips_array: chips列表
+    """
+
+    def __init__(self, data: List[GroupStateBlock], chips_array: Dict[str, Dict[str, str]]) -> None:
+        self.data = data
+        self.chips_array = chips_array
+
+    def fingerprint(self) -> tuple:
+        return (
+            tuple((i.title_text, i.data_text, i.title_color, i.data_color, i.background_color) for i in self.data),
+            _chips_fingerprint(self.chips_array),
+        )
+
+    def generate(self) -> Image.Image:
+        return get_process_image(self.data, self.chips_array)
+
+
 def get_process_image(data: List[GroupStateBlock], chips_array: Dict[str, Dict[str, str]]):
     overall_image = BackGroundGenerator(color=(254, 251, 234), padding=(10, 10, 10, 10), override_size=(400, None))
     current_w, current_h = 0, 0
@@ -415,6 +540,16 @@ class BossStatusImageCore:
         self.boss_icon_id = boss_icon_id
         self.extra_chips_array = extra_chips_array
 
+    def fingerprint(self) -> tuple:
+        return (
+            self.round,
+            self.current_hp,
+            self.max_hp,
+            self.name,
+            self.boss_icon_id,
+            _chips_fingerprint(self.extra_chips_array),
+        )
+
     def hp_percent_image(self) -> Image.Image:
         HP_PERCENT_IMAGE_SIZE = (315, 24)
         background = Image.new("RGBA", HP_PERCENT_IMAGE_SIZE, (200, 200, 200))  # 已确保关闭
@@ -458,21 +593,13 @@ class BossStatusImageCore:
         return round_corner(background)
 
     def boss_panel_image(self) -> Image.Image:
-        BOSS_HEADER_SIZE = 75
         background = BackGroundGenerator(color=(255, 255, 255, 0))
         boss_name_image = get_font_image(self.name, 24)
         background.alpha_composite(boss_name_image, (BOSS_HEADER_SIZE + 10, round((26 - boss_name_image.height) / 2)))
         background.alpha_composite(self.cycle_round_image(), (BOSS_HEADER_SIZE + 20 + boss_name_image.width, 0))
         background.alpha_composite(self.hp_percent_image(), (BOSS_HEADER_SIZE + 10, 75 - 24))
 
-        if not BOSS_ICON_PATH.joinpath(self.boss_icon_id + ".webp").is_file():
-            boss_icon = Image.new("RGBA", (128, 128), (255, 255, 255, 0))  # 已确保关闭
-        else:
-            boss_icon = Image.open(BOSS_ICON_PATH.joinpath(self.boss_icon_id + ".webp"), "r")  # 已确保关闭
-
-        boss_icon = boss_icon.resize((BOSS_HEADER_SIZE, BOSS_HEADER_SIZE))
-        boss_icon = round_corner(boss_icon, 10)
-        background.alpha_composite(boss_icon, (0, 0))
+        background.alpha_composite(boss_icon_atlas.get(self.boss_icon_id), (0, 0))
         # background.debug()  ### boss面板调试 ###
         return background.generate()
 
@@ -488,33 +615,122 @@ class BossStatusImageCore:
         return background.generate()
 
 
-def makeShadow(image: Image.Image, iterations: int, border: int, offset: Tuple[int, int], backgroundColour, shadowColour):
-    # https://en.wikibooks.org/wiki/Python_Imaging_Library/Drop_Shadows
-    # image: base image to give a drop shadow
-    # iterations: number of times to apply the blur filter to the shadow
-    # border: border to give the image to leave space for the shadow
-    # offset: offset of the shadow as [x,y]
-    # backgroundCOlour: colour of the background
-    # shadowColour: colour of the drop shadow
+def _render_boss_icon(icon_id: str) -> Image.Image:
+    icon_path = BOSS_ICON_PATH.joinpath(icon_id + ".webp")
+    if not icon_path.is_file():
+        boss_icon = Image.new("RGBA", (BOSS_HEADER_SIZE, BOSS_HEADER_SIZE), (255, 255, 255, 0))
+    else:
+        with Image.open(icon_path, "r") as source_icon:
+            boss_icon = source_icon.resize((BOSS_HEADER_SIZE, BOSS_HEADER_SIZE))
+    return round_corner(boss_icon, 10)
 
+
+class BossIconAtlas:
+    """
+    boss头像图集
+    保存已缩放并切好圆角的boss头像  每个头像只解码一次  获取时返回副本
+    配置中的boss变化后调用load()  加载新增的头像并丢弃不再使用的头像
+    不在图集中的头像在首次使用时加载
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__load_lock = threading.Lock()
+        self.__icons: Dict[str, Image.Image] = {}
+        self.icon_ids: FrozenSet[str] = frozenset()
+
+    def load(self, icon_ids: Iterable[str]) -> None:
+        """
+        加载图集  与上一次加载的头像相同时不做任何操作
+
+        :param icon_ids: 需要的boss头像id
+        """
+        icon_ids = frozenset(icon_ids)
+        if icon_ids == self.icon_ids:
+            return
+        with self.__load_lock:
+            with self.__lock:
+                loaded = dict(self.__icons)
+            icons = {i: loaded.get(i) or _render_boss_icon(i) for i in icon_ids}
+            with self.__lock:
+                old_icons = self.__icons
+                self.__icons = icons
+                self.icon_ids = icon_ids
+            for icon_id, image in old_icons.items():
+                if icons.get(icon_id) is not image:
+                    image.close()
+
+    def get(self, icon_id: str) -> Image.Image:
+        """
+        获取boss头像
+
+        :param icon_id: boss头像id
+        :return: 头像副本
+        """
+        with self.__lock:
+            image = self.__icons.get(icon_id)
+            if image is not None:
+                return image.copy()
+        image = _render_boss_icon(icon_id)
+        result = image.copy()
+        with self.__lock:
+            if icon_id not in self.__icons:
+                self.__icons[icon_id] = image
+                image = None
+        if image is not None:
+            image.close()
+        return result
+
+    def __len__(self) -> int:
+        return len(self.__icons)
+
+
+boss_icon_atlas = BossIconAtlas()
+
+
+def _shadow_layer(mode: str, size: Tuple[int, int], iterations: int, border: int, offset: Tuple[int, int], backgroundColour, shadowColour) -> Image.Image:
     # Calculate the size of the shadow's image
-    fullWidth = image.size[0] + abs(offset[0]) + 2 * border
-    fullHeight = image.size[1] + abs(offset[1]) + 2 * border
+    fullWidth = size[0] + abs(offset[0]) + 2 * border
+    fullHeight = size[1] + abs(offset[1]) + 2 * border
 
     # Create the shadow's image. Match the parent image's mode.
-    shadow = Image.new(image.mode, (fullWidth, fullHeight), backgroundColour)
+    shadow = Image.new(mode, (fullWidth, fullHeight), backgroundColour)
 
     # Place the shadow, with the required offset
     shadowLeft = border + max(offset[0], 0)  # if <0, push the rest of the image right
     shadowTop = border + max(offset[1], 0)  # if <0, push the rest of the image down
     # Paste in the constant colour
-    shadow.paste(shadowColour, [shadowLeft, shadowTop, shadowLeft + image.size[0], shadowTop + image.size[1]])
+    shadow.paste(shadowColour, [shadowLeft, shadowTop, shadowLeft + size[0], shadowTop + size[1]])
 
     # Apply the BLUR filter repeatedly
     for i in range(iterations):
         shadow = shadow.filter(ImageFilter.BLUR)
 
     # shadow.show()
+    return shadow
+
+
+def makeShadow(image: Image.Image, iterations: int, border: int, offset: Tuple[int, int], backgroundColour, shadowColour):
+    # https://en.wikibooks.org/wiki/Python_Imaging_Library/Drop_Shadows
+    # image: base image to give a drop shadow
+    # iterations: number of times to apply the blur filter to the shadow
+    # border: border to give the image to leave space for the shadow
+    # offset: offset of the shadow as [x,y]
+    # backgroundCOlour: colour of the background
+    # shadowColour: colour of the drop shadow
+
+    # The blurred shadow layer only depends on the size and colours, reuse it
+    shadow = shadow_cache.get(
+        (image.mode, image.size, iterations, border, tuple(offset), backgroundColour, shadowColour),
+        _shadow_layer,
+        image.mode,
+        image.size,
+        iterations,
+        border,
+        offset,
+        backgroundColour,
+        shadowColour,
+    )
 
     # Paste the original image on top of the shadow
     imgLeft = border - min(offset[0], 0)  # if the shadow offset was <0, push right
@@ -526,67 +742,176 @@ def makeShadow(image: Image.Image, iterations: int, border: int, offset: Tuple[i
     return shadow
 
 
-def generate_combind_boss_state_image(image_list: List[Union[Image.Image, BossStatusImageCore]]) -> Image.Image:
-    INTERVAL = 20
-    SHADOW_BORDER = 5
+COMBINED_BACKGROUND_COLOR = (248, 239, 200)
+COMBINED_INTERVAL = 20
+COMBINED_SHADOW_BORDER = 5
+COMBINED_PADDING = (20, 20, 20 - COMBINED_SHADOW_BORDER, 20 - COMBINED_SHADOW_BORDER)
+REDUCED_INTERVAL = 8  # 精简状态图的模块间距
+REDUCED_PADDING = (8, 8, 8, 8)
+
 
-    background = BackGroundGenerator(color=(248, 239, 200), padding=(20, 20, 20 - SHADOW_BORDER, 20 - SHADOW_BORDER))
+def _generate_module_image(this_image: Union[Image.Image, BossStatusImageCore, ProcessImageCore]) -> Image.Image:
+    if isinstance(this_image, BossStatusImageCore):
+        return this_image.generate((254, 251, 234))
+    elif isinstance(this_image, ProcessImageCore):
+        return this_image.generate()
+    elif isinstance(this_image, Image.Image):
+        return this_image
+    raise ValueError(f"Unknown image type: {type(this_image)}")
+
+
+def _shadow_module_image(this_image: Image.Image) -> Image.Image:
+    bg = COMBINED_BACKGROUND_COLOR
+    return makeShadow(round_corner(this_image, 10), 1, COMBINED_SHADOW_BORDER, (5, 5), bg, (bg[0] - 20, bg[1] - 20, bg[2] - 20))
+
+
+def _combined_layout(sizes: List[Tuple[int, int]], interval: int = COMBINED_INTERVAL) -> List[Tuple[int, int]]:
+    """
+    计算每个模块在合成图中的位置  每列3个模块
+
+    :param sizes: 模块(不含阴影)的大小
+    :param interval: 模块间距
+    :return: 模块(含阴影)的位置  不含外部拓展边距
+    """
+    result = []
     current_y_cursor = 0
     current_x_cursor = 0
     module_count = 0
-    format_color_flag = False
-
-    for this_image in image_list:
-        if isinstance(this_image, BossStatusImageCore):
-            this_image = this_image.generate((254, 251, 234))
-        elif isinstance(this_image, Image.Image):
-            pass
-        else:
-            raise ValueError(f"Unknown image type: {type(this_image)}")
-
-        background.alpha_composite(
-            makeShadow(round_corner(this_image, 10), 1, SHADOW_BORDER, (5, 5), (248, 239, 200), (248 - 20, 239 - 20, 200 - 20)),
-            # round_corner(this_image, 10),
-            (current_x_cursor, current_y_cursor),
-        )
-        current_y_cursor += this_image.height + INTERVAL
-        format_color_flag = not format_color_flag
+    for width, height in sizes:
+        result.append((current_x_cursor, current_y_cursor))
+        current_y_cursor += height + interval
         module_count += 1
         if module_count == 3:
-            current_x_cursor += this_image.width + INTERVAL
+            current_x_cursor += width + interval
             current_y_cursor = 0
-            format_color_flag = True if format_color_flag else False
+    return result
+
+
+def generate_combind_boss_state_image(
+    image_list: List[Union[Image.Image, BossStatusImageCore, ProcessImageCore]],
+    cache: Optional["StatusImageCache"] = None,
+) -> Image.Image:
+    """
+    合成状态图
+
+    :param image_list: 模块列表
+    :param cache: 公会的状态图渲染缓存  为None时不使用缓存
+    """
+    if cache is not None:
+        return cache.render(image_list)
+
+    background = BackGroundGenerator(color=COMBINED_BACKGROUND_COLOR, padding=COMBINED_PADDING)
+    module_images = [_generate_module_image(i) for i in image_list]
+    positions = _combined_layout([i.size for i in module_images])
+    for this_image, position in zip(module_images, positions):
+        background.alpha_composite(_shadow_module_image(this_image), position)
+    return background.generate()
 
+
+def generate_reduced_boss_state_image(image_list: List[Union[Image.Image, BossStatusImageCore, ProcessImageCore]]) -> Image.Image:
+    """
+    合成精简状态图  不绘制阴影并缩小间距  绘制更快  图片更小
+
+    :param image_list: 模块列表
+    """
+    background = BackGroundGenerator(color=COMBINED_BACKGROUND_COLOR, padding=REDUCED_PADDING)
+    module_images = [round_corner(_generate_module_image(i), 10) for i in image_list]
+    positions = _combined_layout([i.size for i in module_images], REDUCED_INTERVAL)
+    for this_image, position in zip(module_images, positions):
+        background.alpha_composite(this_image, position)
     return background.generate()
 
 
-async def download_pic(url: str, proxies: Optional[str] = None, file_name="") -> Optional[Path]:
-    image_path = USER_HEADERS_PATH.joinpath(file_name)
-    client = httpx.AsyncClient(proxies=proxies, timeout=5)
-    try:
-        async with client.stream(method="GET", url=url, timeout=15) as response:  # type: ignore # params={"proxies": [proxies]}
-            if response.status_code != 200:
-                raise ValueError(f"Image respond status code error: {response.status_code}")
-            with open(image_path, "wb") as f:
-                async for chunk in response.aiter_bytes():
-                    f.write(chunk)
-    except Exception:
-        return None
-    finally:
-        await client.aclose()
-    return image_path
+class StatusImageCache:
+    """
+    单个公会的状态图渲染缓存
+    每个模块按输入的指纹缓存加上阴影后的图像  只重新渲染指纹发生变化的模块
+    所有模块的大小都没有变化时  直接在上一次的合成图上覆盖变化的模块  否则重新排版
+    模块之间的间距大于阴影范围  覆盖时不会影响相邻的模块
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__modules: List[Tuple[Any, Tuple[int, int], Image.Image]] = []  # (指纹, 模块大小, 带阴影的模块图像)
+        self.__canvas: Optional[Image.Image] = None
+        self.rendered = 0  # 重新渲染的模块数量
+        self.reused = 0  # 复用的模块数量
+
+    def render(self, image_list: List[Union[Image.Image, BossStatusImageCore, ProcessImageCore]]) -> Image.Image:
+        with self.__lock:
+            return self.__render(image_list)
+
+    def __render(self, image_list: List[Union[Image.Image, BossStatusImageCore, ProcessImageCore]]) -> Image.Image:
+        old_modules = self.__modules
+        modules = []
+        changed = []
+        for index, this_image in enumerate(image_list):
+            fingerprint = this_image.fingerprint() if hasattr(this_image, "fingerprint") else None
+            if fingerprint is not None and index < len(old_modules) and old_modules[index][0] == fingerprint:
+                modules.append(old_modules[index])
+                self.reused += 1
+                continue
+            module_image = _generate_module_image(this_image)
+            modules.append((fingerprint, module_image.size, _shadow_module_image(module_image)))
+            changed.append(index)
+            self.rendered += 1
+
+        sizes = [i[1] for i in modules]
+        positions = _combined_layout(sizes)
+        if self.__canvas is not None and sizes == [i[1] for i in old_modules]:
+            canvas = self.__canvas
+            for index in changed:
+                position = positions[index]
+                canvas.alpha_composite(modules[index][2], (position[0] + COMBINED_PADDING[0], position[1] + COMBINED_PADDING[1]))
+        else:
+            background = BackGroundGenerator(color=COMBINED_BACKGROUND_COLOR, padding=COMBINED_PADDING)
+            for module, position in zip(modules, positions):
+                background.alpha_composite(module[2].copy(), position)
+            if self.__canvas is not None:
+                self.__canvas.close()
+            canvas = background.generate()
+
+        for index in changed:
+            if index < len(old_modules):
+                old_modules[index][2].close()
+        for module in old_modules[len(modules):]:
+            module[2].close()
+        self.__modules = modules
+        self.__canvas = canvas
+        return canvas.copy()
+
+
+_status_image_caches: "OrderedDict[Any, StatusImageCache]" = OrderedDict()
+_status_image_caches_lock = threading.Lock()
+
+
+def get_status_image_cache(key: Any) -> StatusImageCache:
+    """
+    获取状态图渲染缓存  只保留最近使用的 STATUS_IMAGE_CACHE_SIZE 个
+
+    :param key: 缓存键  一般为群号
+    """
+    with _status_image_caches_lock:
+        cache = _status_image_caches.get(key)
+        if cache is None:
+            cache = _status_image_caches[key] = StatusImageCache()
+            while len(_status_image_caches) > STATUS_IMAGE_CACHE_SIZE:
+                _status_image_caches.popitem(last=False)
+        _status_image_caches.move_to_end(key)
+        return cache
+
+
+# 头像更新后丢弃对应的缩略图缓存
+avatar_fetcher = AvatarFetcher(USER_HEADERS_PATH, on_update=lambda qqid: avatar_cache.discard(str(qqid)))
 
 
 async def download_user_profile_image(user_id_list: List[int]) -> None:
-    task_list = []
-    for this_user_id in user_id_list:
-        task_list.append(download_pic(f"http://q1.qlogo.cn/g?b=qq&nk={this_user_id}&s=1", file_name=f"{this_user_id}.jpg"))
-    await asyncio.gather(*task_list)
+    await avatar_fetcher.fetch_many(user_id_list)
 
 
 async def download_missing_user_profile() -> None:
     global glovar_missing_user_id
     if not glovar_missing_user_id:
         return
-    await download_user_profile_image(list(glovar_missing_user_id))
-    glovar_missing_user_id = set()
+    missing_user_id, glovar_missing_user_id = glovar_missing_user_id, set()  # 下载期间新增的缺失头像留到下一次
+    await download_user_profile_image(list(missing_user_id))
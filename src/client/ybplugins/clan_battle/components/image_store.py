@@ -0,0 +1,145 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+
+IMAGE_STORE_MAX_BYTES = 64 * 1024 * 1024  # 图片输出目录的总大小上限
+
+# 格式名: (文件扩展名, PIL格式名)
+IMAGE_FORMATS: Dict[str, Tuple[str, str]] = {
+    "jpeg": ("jpg", "JPEG"),
+    "webp": ("webp", "WEBP"),
+    "png": ("png", "PNG"),  # 256色调色板PNG
+}
+
+
+def render_key(spec: Any) -> str:
+    """
+    计算渲染数据的摘要  作为输出文件名
+
+    :param spec: 由基本类型组成的渲染数据  如各模块的指纹
+    """
+    return hashlib.sha1(repr(spec).encode("utf-8")).hexdigest()
+
+
+class ImageStore:
+    """
+    按内容寻址的图片输出目录
+    文件名为渲染数据的摘要  相同的状态直接返回已有文件  不再绘制和编码
+    文件总大小超过上限时删除最久未使用的文件
+    文件先写入临时文件再替换  并发写入同一文件不会产生损坏的图片
+
+    :param path: 输出目录
+    :param max_bytes: 文件总大小上限
+    """
+
+    def __init__(self, path: Path, max_bytes: int = IMAGE_STORE_MAX_BYTES) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__files: Optional["OrderedDict[str, int]"] = None
+        self.__total = 0
+
+    def __load(self) -> "OrderedDict[str, int]":
+        # 首次使用时扫描已有文件  按修改时间排序作为使用顺序
+        if self.__files is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+            entries.sort()
+            self.__files = OrderedDict((name, size) for _, name, size in entries)
+            self.__total = sum(self.__files.values())
+        return self.__files
+
+    @staticmethod
+    def file_name(key: str, image_format: str) -> str:
+        return f"{key}.{IMAGE_FORMATS[image_format][0]}"
+
+    def get(self, key: str, image_format: str) -> Optional[Path]:
+        """
+        获取已有的输出文件
+
+        :param key: 渲染数据摘要  见 render_key()
+        :param image_format: 输出格式  见 IMAGE_FORMATS
+        :return: 文件路径  不存在时返回None
+        """
+        name = self.file_name(key, image_format)
+        with self.__lock:
+            files = self.__load()
+            if name in files:
+                file_path = self.path.joinpath(name)
+                if file_path.is_file():
+                    files.move_to_end(name)
+                    self.hits += 1
+                    return file_path
+                self.__total -= files.pop(name)
+            self.misses += 1
+        return None
+
+    def save(self, key: str, image: Image.Image, image_format: str, quality: int) -> Path:
+        """
+        编码并保存图片  超出总大小上限时删除最久未使用的文件
+
+        :param key: 渲染数据摘要  见 render_key()
+        :param image: 图片  调用者负责关闭
+        :param image_format: 输出格式  见 IMAGE_FORMATS
+        :param quality: 有损格式的编码质量
+        :return: 文件路径
+        """
+        name = self.file_name(key, image_format)
+        file_path = self.path.joinpath(name)
+        temp_path = self.path.joinpath(f"{name}.{threading.get_ident()}.tmp")
+        with self.__lock:
+            self.__load()
+        encode_image(image, temp_path, image_format, quality)
+        os.replace(temp_path, file_path)
+        size = file_path.stat().st_size
+        with self.__lock:
+            files = self.__load()
+            self.__total += size - files.pop(name, 0)
+            files[name] = size
+            while self.__total > self.max_bytes and len(files) > 1:
+                old_name, old_size = files.popitem(last=False)
+                self.__total -= old_size
+                try:
+                    os.remove(self.path.joinpath(old_name))
+                except OSError:
+                    pass
+        return file_path
+
+    @property
+    def total_bytes(self) -> int:
+        return self.__total
+
+
+def encode_image(image: Image.Image, path: Path, image_format: str, quality: int) -> None:
+    """
+    按指定格式编码图片
+
+    :param image_format: 输出格式  见 IMAGE_FORMATS
+    :param quality: 有损格式的编码质量
+    """
+    pil_format = IMAGE_FORMATS[image_format][1]
+    if pil_format == "PNG":
+        palette_image = image.convert("RGB").quantize(256)
+        try:
+            palette_image.save(path, format="PNG", optimize=True)
+        finally:
+            palette_image.close()
+    elif pil_format == "JPEG" and image.mode != "RGB":
+        rgb_image = image.convert("RGB")
+        try:
+            rgb_image.save(path, format="JPEG", quality=quality)
+        finally:
+            rgb_image.close()
+    else:
+        image.save(path, format=pil_format, quality=quality)
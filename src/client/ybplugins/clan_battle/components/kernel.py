@@ -2,18 +2,26 @@ import asyncio
 import logging
 import os
 import re
+import threading
+from pathlib import Path
 from typing import Any, Dict
 from urllib.parse import urljoin
 
 from aiocqhttp.api import Api
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 from ...ybdata import Clan_group, Clan_member, User
 from ..exception import ClanBattleError, InputError, GroupNotExist
 from ..util import atqq
-from .define import Commands, Server
-from .image_engine import download_missing_user_profile, image_engine_init
+from .define import Commands, Server, StatusTier
+from .counter import DailyBladeIndex
+from .executor import GroupCommandExecutor
+from .font_pool import font_pool
+from .image_engine import avatar_fetcher, boss_icon_atlas, download_missing_user_profile, image_engine_init
 from .multi_cq_utils import refresh
+from .render import RenderService, RenderTask
+from .image_store import ImageStore
 
 _logger = logging.getLogger(__name__)
 
@@ -30,11 +38,22 @@ def init(self,
 	self.level_by_cycle = glo_setting['level_by_cycle']
 	self.api = bot_api
 	self.group_data_list = {}
+	self.group_state_list = {}
+	self.boss_status_hubs = {}
+	self.command_executor = GroupCommandExecutor(self.get_clan_state)
+	self.blade_counter = DailyBladeIndex()
+	self.score_table_cache = {}
+	self.score_table_cache_lock = threading.Lock()  # 业绩缓存也在数据库读线程中读写
+	self.challenge_tombstones = {}
+	self.render_service = RenderService()
+	self.status_image_store = ImageStore(Path(os.path.dirname(__file__)).parents[2] / 'yobot_data' / 'cache' / 'state')
+	font_pool.set_fallbacks(glo_setting['font_fallbacks'])
 
 	# log
 	if not os.path.exists(os.path.join(glo_setting['dirname'], 'log')):
 		os.mkdir(os.path.join(glo_setting['dirname'], 'log'))
 	image_engine_init()
+	boss_icon_atlas.load(self.get_boss_icon_ids())
 
 	formater = logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s')
 	filehandler = logging.FileHandler(
@@ -48,9 +67,6 @@ def init(self,
 	_logger.addHandler(consolehandler)
 	_logger.setLevel(logging.INFO)
 
-	for group in Clan_group.select().where(Clan_group.deleted == False):
-		self._boss_status[group.group_id] = asyncio.get_event_loop().create_future()
-
 	# super-admin initialize
 	User.update({User.authority_group: 100}).where(
 		User.authority_group == 1
@@ -59,7 +75,6 @@ def init(self,
 		User.qqid.in_(self.setting['super-admin'])
 	).execute()
 
-	from pathlib import Path
 	inipath = Path(os.path.dirname(__file__)).parents[2] / 'yobot_data' / 'groups.ini'
 	if not inipath.exists():
 		if not (Path(os.path.dirname(__file__)).parents[2] / 'yobot_data').exists():
@@ -75,7 +90,14 @@ def jobs(self):
 	def ensure_future_update_all_group_members():
 		asyncio.ensure_future(self._update_group_list_async())
 
-	return ((trigger, ensure_future_update_all_group_members),)
+	#每分钟重新验证一部分过期的头像
+	async def refresh_stale_avatars():
+		rate = self.setting['avatar_refresh_rate']
+		if rate > 0:
+			await avatar_fetcher.refresh_stale(self.setting['avatar_max_age_hours'] * 3600, rate)
+
+	return ((trigger, ensure_future_update_all_group_members),
+			(IntervalTrigger(minutes=1), refresh_stale_avatars))
 
 #匹配
 def match(self, cmd):
@@ -86,73 +108,26 @@ def match(self, cmd):
 	return Commands.get(cmd[0:2], 0)
 
 
-#执行
-def execute(self, match_num, ctx):
+#执行，同一个群的指令按顺序串行执行，需要绘制的图片在渲染线程中生成
+async def execute_async(self, match_num, ctx):
 	if ctx['message_type'] != 'group': return None
-	cmd = ctx['raw_message']
-	group_id = ctx['group_id']
-	user_id = ctx['user_id']
-	url = urljoin(
-		self.setting['public_address'],
-		'{}clan/{}/'.format(self.setting['public_basepath'],
-		group_id))
-
-	if match_num == 1:  # 创建
-		match = re.match(r'^创建(?:([日台韩国])服)?[公工行]会$', cmd)
-		if not match: return
-		game_server = Server.get(match.group(1), 'cn')
+	execute = self.execute_challenge if match_num in (4, 5, 6) else self.execute
+	result = await self.command_executor.submit(ctx['group_id'], execute, match_num, ctx)
+	if isinstance(result, RenderTask):
 		try:
-			self.create_group(group_id, game_server)
+			result = await self.render_service.run(result)
 		except ClanBattleError as e:
-			_logger.info('群聊 失败 {} {} {}'.format(user_id, group_id, cmd))
 			return str(e)
-		_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
-		from pathlib import Path
-		import configparser
-		inipath = Path(os.path.dirname(__file__)).parents[2] / 'yobot_data' / 'groups.ini'
-		config=configparser.RawConfigParser()
-		config.read(str(inipath))
-		config.set('GROUPS', str(ctx['group_id']), str(ctx['self_id']))
-		with open(str(inipath),'w') as f:
-			config.write(f)
-		refresh()
-		return ('公会创建成功，请登录后台查看，公会战成员请发送“加入公会”，'
-				'或管理员发送“加入全部成员”'
-				'如果无法正常使用网页催刀功能，请发送“手动添加群记录”')
+	return result
 
 
-	elif match_num == 2:  # 加入
-		if cmd == '加入全部成员':
-			if ctx['sender']['role'] == 'member':
-				return '只有管理员才可以加入全部成员'
-			_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
-			asyncio.ensure_future(self._update_all_group_members_async(group_id))
-			return '本群所有成员已添加记录'
-		match = re.match(r'^加入[公工行]会 *(?:\[CQ:at,qq=(\d+)\])? *$', cmd)
-		if match:
-			if match.group(1):
-				if ctx['sender']['role'] == 'member':
-					return '只有管理员才可以加入其他成员'
-				user_id = int(match.group(1))
-				nickname = None
-			else:
-				nickname = (ctx['sender'].get('card') or ctx['sender'].get('nickname'))
-			asyncio.ensure_future(self.bind_group(group_id, user_id, nickname))
-			_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
-			return '{}已加入本公会'.format(atqq(user_id))
-
-
-	elif match_num == 3:  # 状态
-		if cmd != '状态': return
-		try: 
-			boss_summary = self.boss_status_summary(group_id)
-			asyncio.ensure_future(download_missing_user_profile())
-		except ClanBattleError as e:
-			return str(e)
-		return boss_summary
-
+#报刀、尾刀、撤销，出刀记录在数据库写线程中写入
+async def execute_challenge(self, match_num, ctx):
+	cmd = ctx['raw_message']
+	group_id = ctx['group_id']
+	user_id = ctx['user_id']
 
-	elif match_num == 4:  # 报刀
+	if match_num == 4:  # 报刀
 		match = re.match(r'^(?:报刀|刀) ?(?:[\-\=]([1-5]))? ?(\d+)?([Ww万Kk千])? *(补偿|补|b|bc)? *(?:\[CQ:at,qq=(\d+)\])? *(昨[日天])?$', cmd)
 		if not match:
 			# 尝试使用另外的匹配模式
@@ -173,7 +148,7 @@ def execute(self, match_num, ctx):
 		behalf = match.group(5) and int(match.group(5))
 		previous_day = bool(match.group(6))
 		try:
-			boss_status = self.challenge(group_id, user_id, False, damage, behalf, is_continue,
+			boss_status = await self.challenge(group_id, user_id, False, damage, behalf, is_continue,
 				boss_num = boss_num, previous_day = previous_day)
 			# if behalf:
 			# 	sender = self._get_nickname_by_qqid(user_id)
@@ -194,7 +169,7 @@ def execute(self, match_num, ctx):
 
 		previous_day = bool(match.group(4))
 		try:
-			boss_status = self.challenge(group_id, user_id, True, None, behalf, is_continue,
+			boss_status = await self.challenge(group_id, user_id, True, None, behalf, is_continue,
 				boss_num = boss_num, previous_day = previous_day)
 			# if behalf:
 			# 	sender = self._get_nickname_by_qqid(user_id)
@@ -208,13 +183,94 @@ def execute(self, match_num, ctx):
 	elif match_num == 6:  # 撤销
 		if cmd != '撤销': return
 		try:
-			boss_status = self.undo(group_id, user_id)
+			boss_status = await self.undo(group_id, user_id)
 		except ClanBattleError as e:
 			_logger.info('群聊 失败 {} {} {}'.format(user_id, group_id, cmd))
 			return str(e)
 		_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
 		return boss_status
 
+
+#执行
+def execute(self, match_num, ctx):
+	if ctx['message_type'] != 'group': return None
+	cmd = ctx['raw_message']
+	group_id = ctx['group_id']
+	user_id = ctx['user_id']
+	url = urljoin(
+		self.setting['public_address'],
+		'{}clan/{}/'.format(self.setting['public_basepath'],
+		group_id))
+
+	if match_num == 1:  # 创建
+		match = re.match(r'^创建(?:([日台韩国])服)?[公工行]会$', cmd)
+		if not match: return
+		game_server = Server.get(match.group(1), 'cn')
+		try:
+			self.create_group(group_id, game_server)
+		except ClanBattleError as e:
+			_logger.info('群聊 失败 {} {} {}'.format(user_id, group_id, cmd))
+			return str(e)
+		_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
+		from pathlib import Path
+		import configparser
+		inipath = Path(os.path.dirname(__file__)).parents[2] / 'yobot_data' / 'groups.ini'
+		config=configparser.RawConfigParser()
+		config.read(str(inipath))
+		config.set('GROUPS', str(ctx['group_id']), str(ctx['self_id']))
+		with open(str(inipath),'w') as f:
+			config.write(f)
+		refresh()
+		return ('公会创建成功，请登录后台查看，公会战成员请发送“加入公会”，'
+				'或管理员发送“加入全部成员”'
+				'如果无法正常使用网页催刀功能，请发送“手动添加群记录”')
+
+
+	elif match_num == 2:  # 加入
+		if cmd == '加入全部成员':
+			if ctx['sender']['role'] == 'member':
+				return '只有管理员才可以加入全部成员'
+			_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
+			asyncio.ensure_future(self._update_all_group_members_async(group_id))
+			return '本群所有成员已添加记录'
+		match = re.match(r'^加入[公工行]会 *(?:\[CQ:at,qq=(\d+)\])? *$', cmd)
+		if match:
+			if match.group(1):
+				if ctx['sender']['role'] == 'member':
+					return '只有管理员才可以加入其他成员'
+				user_id = int(match.group(1))
+				nickname = None
+			else:
+				nickname = (ctx['sender'].get('card') or ctx['sender'].get('nickname'))
+			asyncio.ensure_future(self.bind_group(group_id, user_id, nickname))
+			_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
+			return '{}已加入本公会'.format(atqq(user_id))
+
+
+	elif match_num == 3:  # 状态
+		match = re.match(r'^状态模式 *(完整|简略|文字|默认)? *$', cmd)
+		if match:
+			if not match.group(1):
+				tier = self.get_status_tier(group_id)
+				name = next(k for k, v in StatusTier.items() if v == tier)
+				return f'当前状态模式：{name}\n可选：{"/".join(StatusTier)}/默认'
+			if (ctx['sender']['role'] not in ['owner', 'admin']) and (ctx['user_id'] not in self.setting['super-admin']):
+				return '只有管理员或主人可更改状态模式'
+			try:
+				self.set_status_tier(group_id, StatusTier.get(match.group(1)))
+			except ClanBattleError as e:
+				return str(e)
+			_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
+			return f'状态模式已设置为{match.group(1)}'
+		if cmd != '状态': return
+		try: 
+			boss_summary = self.boss_status_summary(group_id)
+			asyncio.ensure_future(download_missing_user_profile())
+		except ClanBattleError as e:
+			return str(e)
+		return boss_summary
+
+
 	elif match_num == 7:  # 预约
 		match = re.match(r'^预约([1-5]|表) *(?:[:：](.*))? *(?:\[CQ:at,qq=(\d+)\])? *$', cmd)
 		if not match: return
@@ -7,33 +7,39 @@ import random
 import string
 import asyncio
 import logging
-from pathlib import Path
 from io import BytesIO
-from PIL import Image, ImageFont, ImageDraw
-from typing import Any, Dict, List, Optional, Union, Tuple
+from PIL import Image, ImageDraw
+from typing import Any, AsyncIterator, Dict, FrozenSet, Iterator, List, Optional, Union, Tuple
 
 from .handler import SubscribeHandler
+from .state import ClanState
+from .broadcast import BossStatusHub
+from .tombstone import ChallengeTombstones
+from .font_pool import get_font
+from .render import RenderTask
+from .image_store import IMAGE_FORMATS, ImageStore, render_key
 
 from ..typing import ClanBattleReport, Groupid, Pcr_date, QQid
 from ...web_util import async_cached_func
+from ...db_executor import db_executor
 from ..util import atqq, pcr_datetime, pcr_timestamp, timed_cached_func
 
 from ...ybdata import Clan_challenge, Clan_group, Clan_member, User, Clan_group_backups
 from ..exception import GroupError, GroupNotExist, InputError, UserError, UserNotInGroup
 from .multi_cq_utils import who_am_i
-from .image_engine import download_user_profile_image, generate_combind_boss_state_image, BossStatusImageCore, get_process_image, GroupStateBlock
+from .image_engine import download_user_profile_image, generate_combind_boss_state_image, generate_reduced_boss_state_image, get_status_image_cache, boss_icon_atlas, BossStatusImageCore, ProcessImageCore, GroupStateBlock
 
 _logger = logging.getLogger(__name__)
 FILE_PATH = os.path.dirname(__file__)
+REPORT_CHUNK_SIZE = 500	#分块获取出刀记录时每块的记录数量
+STATUS_TIERS = ('full', 'reduced', 'text')	#状态输出档位，开销从高到低
+STATUS_REDUCED_LOAD = 0.5	#渲染队列占用达到此比例时，完整图片降级为精简图片
+STATUS_TEXT_LOAD = 0.75	#渲染队列占用达到此比例时，图片降级为文字
 
-def safe_load_json(text, back = None):
-	return text and json.loads(text) or back
 def text_2_pic(self, text:string, weight:int, height:int, bg_color:Tuple, text_color:string, font_size:int, text_offset:Tuple):
 	im = Image.new("RGB", (weight, height), bg_color)
 	dr = ImageDraw.Draw(im)
-	FONTS_PATH = os.path.join(FILE_PATH,'fonts')
-	FONTS = os.path.join(FONTS_PATH,'msyh.ttf')
-	font = ImageFont.truetype(FONTS, font_size)
+	font = get_font(font_size)
 	dr.text(text_offset, text, font=font, fill=text_color)
 	bio = BytesIO()
 	im.save(bio, format='PNG')
@@ -50,6 +56,58 @@ def get_clan_group(self, group_id):
 			self.group_data_list[group_id] = group
 		return group
 
+#获取公会运行时状态，与缓存的公会数据实例一一对应
+def get_clan_state(self, group_id) -> Optional[ClanState]:
+	if group_id in self.group_state_list:
+		return self.group_state_list[group_id]
+	group:Clan_group = get_clan_group(self, group_id)
+	if group is None: return None
+	state = ClanState(group)
+	self.group_state_list[group_id] = state
+	return state
+
+#获取公会boss状态广播
+def get_boss_status_hub(self, group_id) -> Optional[BossStatusHub]:
+	if group_id in self.boss_status_hubs:
+		return self.boss_status_hubs[group_id]
+	group:Clan_group = get_clan_group(self, group_id)
+	if group is None: return None
+	hub = BossStatusHub(self._boss_data_dict(group), group.boss_cycle)
+	self.boss_status_hubs[group_id] = hub
+	return hub
+
+#获取公会被删除的出刀记录
+def get_challenge_tombstones(self, group_id) -> ChallengeTombstones:
+	if group_id not in self.challenge_tombstones:
+		self.challenge_tombstones[group_id] = ChallengeTombstones()
+	return self.challenge_tombstones[group_id]
+
+#公会被删除后丢弃它的缓存与待执行的操作，之后的访问重新从数据库读取
+def forget_group(self, group_id):
+	group_id = int(group_id)
+	self.group_data_list.pop(group_id, None)
+	self.group_state_list.pop(group_id, None)
+	self.boss_status_hubs.pop(group_id, None)
+	self.challenge_tombstones.pop(group_id, None)
+	with self.score_table_cache_lock:
+		for key in [key for key in self.score_table_cache if key[0] == group_id]:
+			self.score_table_cache.pop(key, None)
+	self.command_executor.discard(group_id, GroupNotExist())
+
+#设置被修改后刷新boss信息，向所有打开的面板推送新的boss图标和血量
+def refresh_setting(self):
+	self.bossinfo = self.setting['boss']
+	self.level_by_cycle = self.setting['level_by_cycle']
+	for group_id in list(self.boss_status_hubs):
+		group:Clan_group = get_clan_group(self, group_id)
+		if group is None: continue
+		publish_boss_status(self, group)
+
+#向所有打开的面板推送boss状态变化
+def publish_boss_status(self, group: Clan_group, notice = None):
+	hub = get_boss_status_hub(self, group.group_id)
+	hub.publish(self._boss_data_dict(group), group.boss_cycle, notice)
+
 #阶段周目
 def _level_by_cycle(self, cycle, game_server=None):
 	level = 0
@@ -61,11 +119,11 @@ def _level_by_cycle(self, cycle, game_server=None):
 #通过qq号获取名字
 @timed_cached_func(128, 3600, ignore_self=True)
 def _get_nickname_by_qqid(self, qqid) -> Union[str, None]:
-	user = User.get_or_create(qqid=qqid)[0]
-	if user.nickname is None:
+	user = User.get_or_none(qqid=qqid)
+	if user is None or user.nickname is None:	#用户记录在更新名字时创建
 		asyncio.ensure_future(self._update_user_nickname_async(
 			qqid = qqid, group_id = None))
-	return user.nickname or str(qqid)
+	return user and user.nickname or str(qqid)
 
 #获取上一个出刀记录
 def _get_group_previous_challenge(self, group: Clan_group):
@@ -88,13 +146,19 @@ async def _update_group_list_async(self):
 		_logger.exception('获取群列表错误'+str(e))
 		return False
 
+	group_names = {}
 	for group_info in group_list:
 		group:Clan_group = get_clan_group(self, group_info['group_id'],)
 		if group is None : continue
 		group.group_name = group_info['group_name']
-		group.save()
+		group_names[group.group_id] = group.group_name
+	await db_executor.write(_save_group_names, group_names)
 	return True
 
+def _save_group_names(group_names:Dict[Groupid, str]):
+	for group_id, group_name in group_names.items():
+		Clan_group.update(group_name=group_name).where(Clan_group.group_id == group_id).execute()
+
 #获取群成员列表
 @async_cached_func(16)
 async def _fetch_member_list_async(self, group_id):
@@ -111,6 +175,12 @@ async def _fetch_member_list_async(self, group_id):
 #更新所有群成员
 async def _update_all_group_members_async(self, group_id):
 	group_member_list = await self._fetch_member_list_async(group_id)
+	await db_executor.write(_save_group_members, group_id, group_member_list)
+
+	# refresh member list
+	self.get_member_list(group_id, nocache = True)
+
+def _save_group_members(group_id:Groupid, group_member_list:List[Dict[str, Any]]):
 	for member in group_member_list:
 		user = User.get_or_create(qqid=member['user_id'])[0]
 		membership = Clan_member.get_or_create(group_id = group_id, qqid = member['user_id'])[0]
@@ -122,25 +192,26 @@ async def _update_all_group_members_async(self, group_id):
 		user.save()
 		membership.save()
 
-	# refresh member list
-	self.get_member_list(group_id, nocache = True)
-
 #更新成员名字
 async def _update_user_nickname_async(self, qqid, group_id = None):
 	try:
-		user = User.get_or_create(qqid=qqid)[0]
 		if group_id is None:
 			userinfo = await self.api.get_stranger_info(user_id=qqid)
-			user.nickname = userinfo['nickname']
+			nickname = userinfo['nickname']
 		else:
 			userinfo = await self.api.get_group_member_info(group_id=group_id, user_id=qqid)
-			user.nickname = userinfo['card'] or userinfo['nickname']
-		user.save()
+			nickname = userinfo['card'] or userinfo['nickname']
+		await db_executor.write(_save_user_nickname, qqid, nickname)
 
 		# refresh
-		if user.nickname is not None : self._get_nickname_by_qqid(qqid, nocache=True)
+		if nickname is not None : self._get_nickname_by_qqid(qqid, nocache=True)
 	except Exception as e : _logger.exception(e)
 
+def _save_user_nickname(qqid:QQid, nickname:Optional[str]):
+	user = User.get_or_create(qqid=qqid)[0]
+	user.nickname = nickname
+	user.save()
+
 def _update_user_profile_image(self, user_id: Optional[Union[int,List[int]]] = None, group_id: Optional[int] = None) -> None:
 	update_qqid_list = set()
 	if not (group_id and user_id):
@@ -159,17 +230,19 @@ def _update_user_profile_image(self, user_id: Optional[Union[int,List[int]]] = N
 
 #获取boss当前数据
 def _boss_data_dict(self, group: Clan_group) -> Dict[str, Any]:
+	state = get_clan_state(self, group.group_id)
+	group = state.group
 	cycle = group.boss_cycle
-	now_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_health = safe_load_json(group.next_cycle_boss_health, {})
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	now_health = state.now_cycle_boss_health
+	next_health = state.next_cycle_boss_health
+	challenging_member_list = state.challenging_member_list
 
 	back_data = {}
+	level = self._level_by_cycle(cycle, group.game_server)
 	for i in range(5):
 		str_boss_num = str(i + 1)
 		num_boss_num = i + 1
 		next_flag = now_health[str_boss_num] == 0
-		level = self._level_by_cycle(cycle, group.game_server)
 		icon_id = self.setting['boss_id'][group.game_server][i]
 		back_data[num_boss_num] = {
 			'is_next': next_flag,
@@ -216,7 +289,6 @@ def create_group(self, group_id: Groupid, game_server, group_name=None) -> None:
 		group.game_server = game_server
 		group.save()
 	else : raise GroupError('群已经存在')
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
 
 	# refresh group list
 	asyncio.ensure_future(self._update_group_list_async())
@@ -229,21 +301,13 @@ async def bind_group(self, group_id:Groupid, qqid:QQid, nickname:str):
 		qqid: 加入公会的成员QQ号
 		nickname: 用来显示的名字
 	"""
-	user = User.get_or_create(qqid=qqid)[0]
-	user.clan_group_id = group_id
-	user.nickname = nickname
-	user.deleted = False
 	try:
 		groupmember = await self.api.get_group_member_info(group_id = group_id, user_id = qqid)
 		role = 100 if groupmember['role'] == 'member' else 10
 	except Exception as e:
 		_logger.exception(e)
 		role = 100
-	membership = Clan_member.get_or_create(
-		group_id = group_id,
-		qqid = qqid,
-		defaults = {'role': role})[0]
-	user.save()
+	membership = await db_executor.write(_save_membership, group_id, qqid, nickname, role)
 
 	# refresh
 	self.get_member_list(group_id, nocache=True)
@@ -251,6 +315,18 @@ async def bind_group(self, group_id:Groupid, qqid:QQid, nickname:str):
 		asyncio.ensure_future(self._update_user_nickname_async(qqid = qqid, group_id = group_id))
 	return membership
 
+def _save_membership(group_id:Groupid, qqid:QQid, nickname:str, role:int) -> Clan_member:
+	user = User.get_or_create(qqid=qqid)[0]
+	user.clan_group_id = group_id
+	user.nickname = nickname
+	user.deleted = False
+	membership = Clan_member.get_or_create(
+		group_id = group_id,
+		qqid = qqid,
+		defaults = {'role': role})[0]
+	user.save()
+	return membership
+
 #删除成员
 def drop_member(self, group_id: Groupid, member_list: List[QQid]):
 	"""
@@ -289,14 +365,17 @@ def modify(self, group_id: Groupid, cycle=None, bossData=None):
 	if cycle and cycle < 1:
 		raise InputError('周目数不能为负')
 
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
 
 	next_cycle_level = self._level_by_cycle(cycle and cycle+1 or group.boss_cycle+1, group.game_server)
-	now_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_health = safe_load_json(group.next_cycle_boss_health, {})
+	#先在副本上计算，全部成功后再替换公会状态，输入有误时状态保持不变
+	now_health = dict(state.now_cycle_boss_health)
+	next_health = dict(state.next_cycle_boss_health)
 
 	for boss_num, data in bossData.items():
+		boss_num = str(boss_num)
 		next_cycle_full_boss_health = self.setting['boss'][group.game_server][next_cycle_level][int(boss_num)-1]
 		if data["is_next"]:
 			now_health[boss_num] = 0
@@ -304,16 +383,14 @@ def modify(self, group_id: Groupid, cycle=None, bossData=None):
 		else:
 			now_health[boss_num] = data["health"]
 			next_health[boss_num] = next_cycle_full_boss_health
-	
-	group.now_cycle_boss_health = json.dumps(now_health)
-	group.next_cycle_boss_health = json.dumps(next_health)
-	group.boss_cycle = cycle
 
-	group.save()
+	state.now_cycle_boss_health = now_health
+	state.next_cycle_boss_health = next_health
+	group.boss_cycle = cycle
+	state.save()
 
 	msg = 'boss状态已修改'
-	self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, msg))
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+	publish_boss_status(self, group, msg)
 	return msg
 
 #修改服务器
@@ -327,10 +404,13 @@ def change_game_server(self, group_id: Groupid, game_server):
 	"""
 	if game_server not in ("jp", "tw", "cn", "kr"):
 		raise InputError(f'不存在{game_server}游戏服务器')
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
 	group.game_server = game_server
-	group.save()
+	#通过状态持久化，合并持久化期间不会用未写回的json文本字段覆盖数据库
+	state.save()
+	publish_boss_status(self, group)
 
 #获取当期会战数据记录档案的编号
 def get_data_slot_record_count(self, group_id: Groupid):
@@ -363,9 +443,10 @@ def clear_data_slot(self, group_id: Groupid, battle_id: Optional[int] = None):
 		group_id: QQ群号
 		battle_id: 选择的档案号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None:
+	state = get_clan_state(self, group_id)
+	if state is None:
 		raise GroupNotExist
+	group = state.group
 
 	now_cycle_boss_health = {}
 	level = self._level_by_cycle(1, group.game_server)
@@ -384,8 +465,12 @@ def clear_data_slot(self, group_id: Groupid, battle_id: Optional[int] = None):
 	group.challenging_start_time = 0
 
 	group.save()
+	state.load()
+	publish_boss_status(self, group)
 	if battle_id is None: battle_id = group.battle_id
 	Clan_challenge.delete().where(Clan_challenge.gid == group_id, Clan_challenge.bid == battle_id).execute()
+	self.blade_counter.invalidate(group_id, battle_id)
+	get_challenge_tombstones(self, group_id).reset()
 	_logger.info(f'群{group_id}的{battle_id}号存档已清空')
 
 #切换会战数据记录档案
@@ -399,8 +484,11 @@ def switch_data_slot(self, group_id: Groupid, battle_id: int):
 		group_id: QQ群号
 		battle_id：选择的档案号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
+	#合并持久化期间状态尚未写回json文本字段，备份前先写回
+	state.dump()
 	backups:Clan_group_backups = Clan_group_backups.get_or_create(
 		group_id = group_id, 
 		battle_id = group.battle_id)[0]
@@ -458,6 +546,9 @@ def switch_data_slot(self, group_id: Groupid, battle_id: int):
 		group.challenging_start_time = 0
 
 	group.save()
+	state.load()
+	publish_boss_status(self, group)
+	get_challenge_tombstones(self, group_id).reset()
 	_logger.info(f'群{group_id}切换至{battle_id}号存档')
 
 def _get_available_empty_battle_id(self, group_id: int) -> int:
@@ -529,14 +620,37 @@ def send_remind(self,
 def behelf_remind(self, member_id, msg):
 	asyncio.ensure_future(self.send_private_remind(member_id = member_id,content = msg))
 #当前的boss状态
-def boss_status_summary(self, group_id:Groupid) -> str:
-	boss_summary = self.challenger_info(group_id)
+def boss_status_summary(self, group_id:Groupid) -> Union[str, RenderTask]:
+	boss_summary = self.challenger_info(group_id, self.get_status_tier(group_id))
 
 	return boss_summary
 
+#获取公会的状态输出档位
+def get_status_tier(self, group_id:Groupid) -> str:
+	group = get_clan_group(self, group_id)
+	tier = group and group.status_tier or self.setting['status_output_tier']
+	return tier if tier in STATUS_TIERS else 'full'
+
+#设置公会的状态输出档位，为None时使用全局设置
+def set_status_tier(self, group_id:Groupid, tier:Optional[str]):
+	if tier is not None and tier not in STATUS_TIERS: raise InputError('未知的状态输出档位')
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	state.group.status_tier = tier
+	state.save()
+
+#渲染队列积压时降级为开销更低的档位
+def _degraded_status_tier(self, tier:str) -> str:
+	load = self.render_service.pending / self.render_service.max_pending
+	if load >= STATUS_TEXT_LOAD:
+		return 'text'
+	if load >= STATUS_REDUCED_LOAD and tier == 'full':
+		return 'reduced'
+	return tier
+
 
 #报刀
-def challenge(self,
+async def challenge(self,
 				group_id: Groupid,
 				qqid: QQid,
 				defeat: bool,
@@ -572,141 +686,132 @@ def challenge(self,
 	membership = Clan_member.get_or_none(group_id=group_id, qqid=qqid)
 	if membership is None: raise UserNotInGroup
 
-	#若已申请出刀且指定报刀boss，优先选择指定报刀boss
-	if boss_num and self.check_blade(group_id, qqid):
-		self.cancel_blade(group_id, qqid, send_web = False)
-	#若已申请出刀未指定报刀boss，自动选择申请出刀的boss
-	if not boss_num and self.check_blade(group_id, qqid):
-		boss_num = self.get_in_boss_num(group_id, qqid)
-
-	if not boss_num:
-		raise GroupError('直接报刀伤害需在申请出刀后使用\n或使用“报刀[boss编号] 伤害”格式报刀')
-	if not self.check_blade(group_id, qqid):
-		if behalf:
-			self.apply_for_challenge(is_continue, group_id, behalf, boss_num, qqid, False)
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+
+	#自动申请/取消出刀会先修改出刀申请列表，写入出刀记录前失败时恢复
+	with state.restore_on_error():
+		#访问数据库的同步片段持有写锁，出刀记录在数据库写线程中写入
+		async with db_executor.write_locked():
+			#若已申请出刀且指定报刀boss，优先选择指定报刀boss
+			if boss_num and self.check_blade(group_id, qqid):
+				self.cancel_blade(group_id, qqid, send_web = False)
+			#若已申请出刀未指定报刀boss，自动选择申请出刀的boss
+			if not boss_num and self.check_blade(group_id, qqid):
+				boss_num = self.get_in_boss_num(group_id, qqid)
+
+			if not boss_num:
+				raise GroupError('直接报刀伤害需在申请出刀后使用\n或使用“报刀[boss编号] 伤害”格式报刀')
+			if not self.check_blade(group_id, qqid):
+				if behalf:
+					self.apply_for_challenge(is_continue, group_id, behalf, boss_num, qqid, False)
+				else:
+					self.apply_for_challenge(is_continue, group_id, qqid, boss_num, behalf, False)
+
+			group = state.group
+
+			boss_num = str(boss_num)
+			boss_cycle = group.boss_cycle
+			challenging_member_list = state.challenging_member_list
+			now_cycle_boss_health = state.now_cycle_boss_health
+			next_cycle_boss_health = state.next_cycle_boss_health
+			real_cycle_boss_health = now_cycle_boss_health
+			is_continue = is_continue or (boss_num in challenging_member_list and challenging_member_list[boss_num][str(qqid)]['is_continue'] or False)
+			if now_cycle_boss_health[boss_num] == 0 and next_cycle_boss_health[boss_num] != 0:
+				boss_cycle += 1
+				real_cycle_boss_health = next_cycle_boss_health
+			elif now_cycle_boss_health[boss_num] == 0 and next_cycle_boss_health[boss_num] == 0: 
+				raise InputError('只能挑战2个周目内的同个boss')
+			if (not defeat) and (damage >= real_cycle_boss_health[boss_num]):
+				raise InputError('伤害超出剩余血量，如击败请使用尾刀')
+			# if damage == 0:
+			# 	damage = challenging_member_list[boss_num][str(qqid)]['damage']
+
+			d, t = pcr_datetime(area = group.game_server)
+			if previous_day:
+				today_count = self.blade_counter.day_total(group_id, group.battle_id, d)
+
+				if today_count != 0: raise GroupError('今日报刀记录不为空，无法将记录添加到昨日')
+				d -= 1
+				t += 86400
+
+			blade = self.blade_counter.get(group_id, group.battle_id, d, qqid)
+			finished = blade.finished
+			if finished >= 3:
+				if previous_day: raise InputError('昨日上报次数已达到3次')
+				raise InputError('今日上报次数已达到3次')
+			#剩余多少刀补偿
+			cont_blade = blade.cont_blade
+			if is_continue and cont_blade == 0:
+				raise GroupError('您没有补偿刀')
+
+			if defeat:
+				boss_health_remain = 0
+				challenge_damage = real_cycle_boss_health[boss_num]
+			else:
+				boss_health_remain = real_cycle_boss_health[boss_num] - damage
+				challenge_damage = damage
+
+		#先写入出刀记录，成功后再修改公会状态，写入失败时状态保持不变
+		challenge:Clan_challenge = await db_executor.write(Clan_challenge.create,
+			gid=group_id,
+			qqid=qqid,
+			bid=group.battle_id,
+			challenge_pcrdate=d,
+			challenge_pcrtime=t,
+			boss_cycle=boss_cycle,
+			boss_num=boss_num,
+			boss_health_remain=boss_health_remain,
+			challenge_damage=challenge_damage,
+			is_continue=is_continue,
+			behalf=behalf,
+		)
+	async with db_executor.write_locked():
+		self.blade_counter.record(challenge)
+		real_cycle_boss_health[boss_num] = boss_health_remain
+
+		if defeat:
+			all_clear = 0
+			for _, _health in now_cycle_boss_health.items():
+				if _health == 0: all_clear += 1
+			if all_clear == 5:			# 检查当前周目的boss是否已经全部击杀
+				group.boss_cycle += 1	# 进入下一周目
+				next_cycle_level = self._level_by_cycle(group.boss_cycle+1, group.game_server)
+				for _boss_num, _health in next_cycle_boss_health.items():# 血量数据挪移
+					now_cycle_boss_health[_boss_num] = _health
+					if _health == 0: subscribe_remind(self, group_id, _boss_num)# 如果挪过来的血量为0，则发送预约提醒
+				for boss_num_, health_ in enumerate(self.bossinfo[group.game_server][next_cycle_level]):# 获取新血量数据放到下周目
+					next_cycle_boss_health[str(boss_num_+1)] = health_
+			else: real_cycle_boss_health[boss_num] = 0
+
+		state.save()
+
+		# 取消申请出刀
+		if defeat: 
+			self.take_it_of_the_tree(group_id, qqid, boss_num, 1, send_web = False)#只是通知下树而已
+			self.cancel_blade(group_id, qqid, boss_num, 2, False)
+			if check_next_boss(self, group_id, boss_num):
+				subscribe_remind(self, group_id, boss_num)
 		else:
-			self.apply_for_challenge(is_continue, group_id, qqid, boss_num, behalf, False)
-
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
-
-	boss_num = str(boss_num)
-	boss_cycle = group.boss_cycle
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
-	now_cycle_boss_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_cycle_boss_health = safe_load_json(group.next_cycle_boss_health, {})
-	real_cycle_boss_health = now_cycle_boss_health
-	is_continue = is_continue or (boss_num in challenging_member_list and challenging_member_list[boss_num][str(qqid)]['is_continue'] or False)
-	if now_cycle_boss_health[boss_num] == 0 and next_cycle_boss_health[boss_num] != 0:
-		boss_cycle += 1
-		real_cycle_boss_health = next_cycle_boss_health
-	elif now_cycle_boss_health[boss_num] == 0 and next_cycle_boss_health[boss_num] == 0: 
-		raise InputError('只能挑战2个周目内的同个boss')
-	if (not defeat) and (damage >= real_cycle_boss_health[boss_num]):
-		raise InputError('伤害超出剩余血量，如击败请使用尾刀')
-	# if damage == 0:
-	# 	damage = challenging_member_list[boss_num][str(qqid)]['damage']
-
-	d, t = pcr_datetime(area = group.game_server)
-	if previous_day:
-		today_count = Clan_challenge.select().where(
-			Clan_challenge.gid == group_id,
-			Clan_challenge.bid == group.battle_id,
-			Clan_challenge.challenge_pcrdate == d,
-		).count()
-
-		if today_count != 0: raise GroupError('今日报刀记录不为空，无法将记录添加到昨日')
-		d -= 1
-		t += 86400
-
-	challenges = Clan_challenge.select().where(
-		Clan_challenge.gid == group_id,
-		Clan_challenge.qqid == qqid,
-		Clan_challenge.bid == group.battle_id,
-		Clan_challenge.challenge_pcrdate == d,
-	).order_by(Clan_challenge.cid)
-
-	challenges = list(challenges)
-	finished = sum(bool(c.boss_health_remain or c.is_continue) for c in challenges)
-	if finished >= 3:
-		if previous_day: raise InputError('昨日上报次数已达到3次')
-		raise InputError('今日上报次数已达到3次')
-	#出了多少刀补偿
-	all_cont_blade = sum(bool(c.is_continue) for c in challenges)
-	#剩余多少刀补偿
-	cont_blade = len(challenges) - finished - all_cont_blade
-	if is_continue and cont_blade == 0:
-		raise GroupError('您没有补偿刀')
-
-	if defeat:
-		boss_health_remain = 0
-		challenge_damage = real_cycle_boss_health[boss_num]
-		real_cycle_boss_health[boss_num] = 0
-	else:
-		boss_health_remain = real_cycle_boss_health[boss_num] - damage
-		challenge_damage = damage
-		real_cycle_boss_health[boss_num] -= damage
-
-	challenge:Clan_challenge = Clan_challenge.create(
-		gid=group_id,
-		qqid=qqid,
-		bid=group.battle_id,
-		challenge_pcrdate=d,
-		challenge_pcrtime=t,
-		boss_cycle=boss_cycle,
-		boss_num=boss_num,
-		boss_health_remain=boss_health_remain,
-		challenge_damage=challenge_damage,
-		is_continue=is_continue,
-		behalf=behalf,
-	)
-
-	if defeat:
-		all_clear = 0
-		for _, _health in now_cycle_boss_health.items():
-			if _health == 0: all_clear += 1
-		if all_clear == 5:			# 检查当前周目的boss是否已经全部击杀
-			group.boss_cycle += 1	# 进入下一周目
-			next_cycle_level = self._level_by_cycle(group.boss_cycle+1, group.game_server)
-			for _boss_num, _health in next_cycle_boss_health.items():# 血量数据挪移
-				now_cycle_boss_health[_boss_num] = _health
-				if _health == 0: subscribe_remind(self, group_id, _boss_num)# 如果挪过来的血量为0，则发送预约提醒
-			for boss_num_, health_ in enumerate(self.bossinfo[group.game_server][next_cycle_level]):# 获取新血量数据放到下周目
-				next_cycle_boss_health[str(boss_num_+1)] = health_
-		else: real_cycle_boss_health[boss_num] = 0
-
-	group.now_cycle_boss_health = json.dumps(now_cycle_boss_health)
-	group.next_cycle_boss_health = json.dumps(next_cycle_boss_health)
-	challenge.save()
-	group.save()
-
-	# 取消申请出刀
-	if defeat: 
-		self.take_it_of_the_tree(group_id, qqid, boss_num, 1, send_web = False)#只是通知下树而已
-		self.cancel_blade(group_id, qqid, boss_num, 2, False)
-		if check_next_boss(self, group_id, boss_num):
-			subscribe_remind(self, group_id, boss_num)
-	else:
-		try:self.cancel_blade(group_id, qqid, send_web = False)
-		except:pass
-
-	nik = self._get_nickname_by_qqid(qqid)
-	behalf_nik = behalf and f'（{self._get_nickname_by_qqid(behalf)}代）' or ''
-	if defeat:
-		msg = '{}{}对{}号boss造成了{:,}点伤害，击败了boss\n（今日第{}刀，{}）\n'.format(
-			nik, behalf_nik, boss_num, challenge_damage, finished+1, '尾余刀' if is_continue else '收尾刀')
-	else:
-		msg = '{}{}对{}号boss造成了{:,}点伤害\n（今日第{}刀，{}）\n'.format(
-			nik, behalf_nik, boss_num, challenge_damage, finished+1, '剩余刀' if is_continue else '完整刀')
-	msg += '\n'.join(self.challenger_info_small(group, boss_num))
+			try:self.cancel_blade(group_id, qqid, send_web = False)
+			except:pass
+
+		nik = self._get_nickname_by_qqid(qqid)
+		behalf_nik = behalf and f'（{self._get_nickname_by_qqid(behalf)}代）' or ''
+		if defeat:
+			msg = '{}{}对{}号boss造成了{:,}点伤害，击败了boss\n（今日第{}刀，{}）\n'.format(
+				nik, behalf_nik, boss_num, challenge_damage, finished+1, '尾余刀' if is_continue else '收尾刀')
+		else:
+			msg = '{}{}对{}号boss造成了{:,}点伤害\n（今日第{}刀，{}）\n'.format(
+				nik, behalf_nik, boss_num, challenge_damage, finished+1, '剩余刀' if is_continue else '完整刀')
+		msg += '\n'.join(self.challenger_info_small(group, boss_num))
 
-	self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, msg))
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+		publish_boss_status(self, group, msg)
 
-	return msg
+		return msg
 
 #撤销上一刀的伤害
-def undo(self, group_id: Groupid, qqid: QQid) :
+async def undo(self, group_id: Groupid, qqid: QQid) :
 	"""
 	删除上一刀的记录
 
@@ -714,9 +819,11 @@ def undo(self, group_id: Groupid, qqid: QQid) :
 		group_id: QQ群号
 		qqid: 发起撤销请求的成员QQ号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
-	user:User = User.get_or_create(qqid = qqid, defaults = {'clan_group_id': group_id})[0]
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
+	async with db_executor.write_locked():
+		user:User = User.get_or_create(qqid = qqid, defaults = {'clan_group_id': group_id})[0]
 	last_challenge:Clan_challenge = self._get_group_previous_challenge(group)
 
 	if last_challenge is None: raise GroupError('本群无出刀记录')
@@ -726,32 +833,37 @@ def undo(self, group_id: Groupid, qqid: QQid) :
 	last_cycle = last_challenge.boss_cycle	#上一刀的周目数
 	level = self._level_by_cycle(last_cycle, group.game_server)#阶段
 
-	now_cycle_boss_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_cycle_boss_health = safe_load_json(group.next_cycle_boss_health, {})
+	#先在副本上计算，删除出刀记录成功后再替换公会状态
+	now_cycle_boss_health = dict(state.now_cycle_boss_health)
+	next_cycle_boss_health = dict(state.next_cycle_boss_health)
 	real_cycle_boss_health = now_cycle_boss_health #用来记录上一刀打的是哪个周目的boss
+	boss_cycle = group.boss_cycle
 
 	if last_cycle < group.boss_cycle:	# 判断被撤销的一刀是否是切换周目的一刀
 		for boss_num, health in now_cycle_boss_health.items():
 			next_cycle_boss_health[boss_num] = health
 			now_cycle_boss_health[boss_num] = 0
 		now_cycle_boss_health[last_num] = last_challenge.challenge_damage
-		group.boss_cycle = last_cycle
+		boss_cycle = last_cycle
 	else:
 		if last_cycle != group.boss_cycle: real_cycle_boss_health = next_cycle_boss_health
 		real_cycle_boss_health[last_num] += last_challenge.challenge_damage
 		full_health = self.bossinfo[group.game_server][level][int(last_num)-1]
 		if real_cycle_boss_health[last_num] > full_health: real_cycle_boss_health[last_num] = full_health
 
-	last_challenge.delete_instance()
-	group.now_cycle_boss_health = json.dumps(now_cycle_boss_health)
-	group.next_cycle_boss_health = json.dumps(next_cycle_boss_health)
-	group.save()
-
-	nik = self._get_nickname_by_qqid(last_challenge.qqid)
-	msg = f'{nik}的出刀记录已被撤销'
-	self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, msg))
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
-	return msg
+	await db_executor.write(last_challenge.delete_instance)
+	async with db_executor.write_locked():
+		state.now_cycle_boss_health = now_cycle_boss_health
+		state.next_cycle_boss_health = next_cycle_boss_health
+		group.boss_cycle = boss_cycle
+		self.blade_counter.remove(last_challenge)
+		get_challenge_tombstones(self, group_id).delete(last_challenge.cid)
+		state.save()
+
+		nik = self._get_nickname_by_qqid(last_challenge.qqid)
+		msg = f'{nik}的出刀记录已被撤销'
+		publish_boss_status(self, group, msg)
+		return msg
 
 #预约x/预约表
 def subscribe(self, group_id:Groupid, qqid:QQid, msg, note):
@@ -761,10 +873,10 @@ def subscribe(self, group_id:Groupid, qqid:QQid, msg, note):
 	Args:
 		msg: 第几个王 or '表'
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
 	if not msg: GroupError('您预约了一个空气')
-	subscribe_handler = SubscribeHandler(group=group)
+	subscribe_handler = SubscribeHandler(state)
 	if msg == '表':
 		back_msg = []
 		if not subscribe_handler.have_subscribe:
@@ -786,8 +898,7 @@ def subscribe(self, group_id:Groupid, qqid:QQid, msg, note):
 
 #预约提醒
 def subscribe_remind(self, group_id:Groupid, boss_num):
-	group:Clan_group = get_clan_group(self, group_id)
-	subscribe_handler = SubscribeHandler(group=group)
+	subscribe_handler = SubscribeHandler(get_clan_state(self, group_id))
 	boss_num = int(boss_num)
 	if not subscribe_handler.get_subscribe_list(boss_num):
 		return
@@ -814,9 +925,8 @@ def subscribe_cancel(self, group_id:Groupid, boss_num, qqid = None):
 		boss_num: 几王
 		qqid: 不填为删除特定boss的整个预约记录，填则删除特定用户的单个预约记录
 	'''
-	group:Clan_group = get_clan_group(self, group_id)
 	if not boss_num: raise GroupError('您取消了个寂寞')
-	subscribe_handler = SubscribeHandler(group=group)
+	subscribe_handler = SubscribeHandler(get_clan_state(self, group_id))
 	boss_num = int(boss_num)
 	if not qqid:
 		subscribe_handler.unsubscribe_all(boss_num)
@@ -835,8 +945,7 @@ def get_subscribe_list(self, group_id: Groupid):
 	Args:
 		group_id: QQ群号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	subscribe_handler = SubscribeHandler(group=group)
+	subscribe_handler = SubscribeHandler(get_clan_state(self, group_id))
 	back_info = []
 	for boss_num, qqid_list in subscribe_handler.data.items():
 		for qqid, msg in qqid_list.items():
@@ -857,26 +966,22 @@ def put_on_the_tree(self, group_id: Groupid, qqid: QQid, message=None):
 		qqid: 挂树的霉b/菜b的QQ号
 		message: 留言
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
 	user = User.get_or_none(qqid=qqid)
 	if user is None: raise GroupError('请先加入公会')
-	if not self.check_blade(group_id, qqid):
-		raise GroupError('挂树指令需在申请出刀后使用')
 
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
-	boss_num = self.get_in_boss_num(group_id, qqid)
-	if not boss_num :
+	challenger = state.get_challenger(qqid)
+	if challenger is None:
 		raise GroupError('挂树指令需在申请出刀后使用')
-	if challenging_member_list[boss_num][str(qqid)]['tree']:
+	if challenger['tree']:
 		raise GroupError('您已经在树上了')
 	
-	challenging_member_list[boss_num][str(qqid)]['tree'] = True
-	challenging_member_list[boss_num][str(qqid)]['msg'] = message
-	group.challenging_member_list = json.dumps(challenging_member_list)
-	group.save()
-	self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, '挂树惹~ (っ °Д °;)っ'))
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+	challenger['tree'] = True
+	challenger['msg'] = message
+	state.save()
+	publish_boss_status(self, group, '挂树惹~ (っ °Д °;)っ')
 	return '已挂树'
 
 
@@ -888,11 +993,11 @@ def query_tree(self, group_id: Groupid, user_id: QQid, boss_id=0) -> dict:
 		{"1":[(10000, "消息：马化腾一号挂树")], "2":[($QID, $MSG)], "3":[], "4":[], "5":[]}
 	"""
 	qid = str(user_id)
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
 	user = User.get_or_none(qqid=user_id)
 	if user is None: raise GroupError('请先加入公会')
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	challenging_member_list = state.challenging_member_list
 	result = {"1": [], "2": [], "3": [], "4": [], "5": []}
 	if boss_id == 0:
 		for i in range(1, 6):
@@ -923,23 +1028,22 @@ def take_it_of_the_tree(self, group_id: Groupid, qqid: QQid, boss_num=0, take_it
 		take_it_type: 0下一个人 1下一棵树
 		send_web:是否更新web面板数据
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
 	
 	user = User.get_or_none(qqid=qqid)
 	if user is None: raise GroupError('请先加入公会')
 
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	challenging_member_list = state.challenging_member_list
 
 	if take_it_type == 0:
-		boss_num = self.get_in_boss_num(group_id, qqid)
-		if not boss_num :
+		challenger = state.get_challenger(qqid)
+		if challenger is None:
 			raise GroupError('下树指令需在申请出刀后使用')
-		qqid = str(qqid)
-		challenging_member_list[boss_num][qqid]['tree'] = False
-		challenging_member_list[boss_num][qqid]['msg'] = None
-		group.challenging_member_list = json.dumps(challenging_member_list)
-		group.save()
+		challenger['tree'] = False
+		challenger['msg'] = None
+		state.save()
 	elif take_it_type == 1:
 		notice = []
 		for challenger, info in challenging_member_list[boss_num].items():
@@ -951,16 +1055,16 @@ def take_it_of_the_tree(self, group_id: Groupid, qqid: QQid, boss_num=0, take_it
 				message = 'Boss已被击败'+'\n'.join(notice),
 			))
 	if send_web:
-		self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, 'Boss已被击败'))
-		self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+		publish_boss_status(self, group, 'Boss已被击败')
 	return 'Boss已被击败'
 
 #检查能否继续挑战下个boss
 def check_next_boss(self, group_id:Groupid, boss_num):
-	group:Clan_group = get_clan_group(self, group_id)
+	state = get_clan_state(self, group_id)
+	group = state.group
 	boss_cycle = group.boss_cycle
-	now_cycle_boss_health = safe_load_json(group.now_cycle_boss_health, {})
-	next_cycle_boss_health = safe_load_json(group.next_cycle_boss_health, {})
+	now_cycle_boss_health = state.now_cycle_boss_health
+	next_cycle_boss_health = state.next_cycle_boss_health
 	if now_cycle_boss_health[boss_num] == 0 and next_cycle_boss_health[boss_num] == 0:
 		return False
 	if self._level_by_cycle(boss_cycle, group.game_server) != self._level_by_cycle(boss_cycle+1, group.game_server):
@@ -977,9 +1081,11 @@ def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num
 		boss_num: 几王
 		behalfed: 被代刀人的qq号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None:raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None:raise GroupNotExist
+	group = state.group
 
+	boss_num = str(boss_num)
 	behalf = None
 	challenger = behalfed and behalfed or qqid
 	if behalfed : behalf = qqid
@@ -989,27 +1095,20 @@ def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num
 	if self.check_blade(group_id, challenger):
 		raise GroupError('你已经申请过了')
 
-	now_cycle_boss_health = safe_load_json(group.now_cycle_boss_health, {})
 	if (not check_next_boss(self, group_id, boss_num) 
-		and now_cycle_boss_health[boss_num] == 0):
+		and state.now_cycle_boss_health[boss_num] == 0):
 		raise GroupError('只能挑战2个周目内且不跨阶段的同个boss，请等待该周目的boss全部击杀完毕')
 
 	d, _ = pcr_datetime(area = group.game_server)
-	challenges:List[Clan_challenge] = Clan_challenge.select().where(
-		Clan_challenge.gid == group_id,
-		Clan_challenge.qqid == challenger,
-		Clan_challenge.bid == group.battle_id,
-		Clan_challenge.challenge_pcrdate == d,
-	).order_by(Clan_challenge.cid)
-	challenges = list(challenges)
-	finished = sum(bool(c.boss_health_remain or c.is_continue) for c in challenges)
+	blade = self.blade_counter.get(group_id, group.battle_id, d, challenger)
+	finished = blade.finished
 	if finished >= 3: raise GroupError('今日已出了3次完整刀')
 	#收尾且不是补偿
-	tail_blade = sum(bool(c.boss_health_remain == 0 and (not c.is_continue)) for c in challenges)
+	tail_blade = blade.tail
 	#出了多少刀补偿
-	all_cont_blade = sum(bool(c.is_continue) for c in challenges)
+	all_cont_blade = blade.cont
 	#剩余多少刀补偿
-	cont_blade = len(challenges) - finished - all_cont_blade
+	cont_blade = blade.cont_blade
 	if is_continue and cont_blade == 0:
 		raise GroupError('您没有补偿刀')
 	if finished + tail_blade - all_cont_blade >= 3 and cont_blade != 0:
@@ -1017,10 +1116,10 @@ def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num
 	
 	nik = self._get_nickname_by_qqid(challenger)
 	info = [f'{nik}已开始挑战boss\n']
-	challenging_list = safe_load_json(group.challenging_member_list, {})
+	challenging_list = state.challenging_member_list
 	if boss_num not in challenging_list:
 		challenging_list[boss_num] = {}
-	challenging_list[boss_num][challenger] = {
+	challenging_list[boss_num][str(challenger)] = {
 		'is_continue' : is_continue, 
 		'behalf' : behalf, 
 		's' : 0,
@@ -1028,14 +1127,12 @@ def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num
 		'tree' : False,
 		'msg' : None,
 	}
-	group.challenging_member_list = json.dumps(challenging_list)
-	group.save()
+	state.save()
 
 	self.challenger_info_small(group, boss_num, info)
 	info = '\n'.join(info)
 	if send_web:
-		self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, f'申请挑战{boss_num}王成功'))
-		self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+		publish_boss_status(self, group, f'申请挑战{boss_num}王成功')
 	return info
 
 #取消申请出刀
@@ -1047,33 +1144,29 @@ def cancel_blade(self, group_id: Groupid, qqid: QQid, boss_num=0, cancel_type=1,
 		cancel_type: 取消类型：0取消全部 1取消特定qq号 2取消特定boss
 		send_web:是否更新web面板数据
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	group = state.group
 	ret = 0
-	if group.challenging_member_list == None:
+	challenging_list = state.challenging_member_list
+	if not challenging_list:
 		raise GroupError('目前没有人正在挑战这个boss')
 	if cancel_type == 0 :
-		group.challenging_member_list = None
+		challenging_list.clear()
 		ret = '已取消所有'
 	elif cancel_type == 1 :
-		_boss_num = self.get_in_boss_num(group_id, qqid)
+		_boss_num = state.get_in_boss_num(qqid)
 		if not _boss_num : raise GroupError('取消申请指令需在申请出刀后使用')
-		challenging_list = safe_load_json(group.challenging_member_list, {})
 		del challenging_list[_boss_num][str(qqid)]
 		if len(challenging_list[_boss_num]) == 0: del challenging_list[_boss_num]
-		if len(challenging_list) == 0: group.challenging_member_list = None
-		else: group.challenging_member_list = json.dumps(challenging_list)
 		ret = '取消申请出刀成功'
 	elif boss_num != 0 and cancel_type == 2:
-		challenging_list = safe_load_json(group.challenging_member_list, {})
 		if boss_num not in challenging_list: return
 		del challenging_list[boss_num]
-		group.challenging_member_list = json.dumps(challenging_list)
 
 	if send_web:
-		self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, ret))
-		self._boss_status[group_id] = asyncio.get_event_loop().create_future()
-	group.save()
+		publish_boss_status(self, group, ret)
+	state.save()
 	return ret
 
 #检查是否已申请出刀
@@ -1084,13 +1177,9 @@ def check_blade(self, group_id: Groupid, qqid: QQid):
 		group_id: QQ群号
 		qqid: 需要进行操作的QQ号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
-	challenging_list = safe_load_json(group.challenging_member_list, {})
-	for _, infos in challenging_list.items():
-		for challenger in infos.keys():
-			if str(qqid) == challenger : return True
-	return False
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	return state.get_in_boss_num(qqid) is not None
 
 #获取boss_num
 def get_in_boss_num(self, group_id, qqid):
@@ -1100,12 +1189,7 @@ def get_in_boss_num(self, group_id, qqid):
 		group: 公会群对象
 		qqid: 需要进行操作的QQ号
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	challenging_list = safe_load_json(group.challenging_member_list, {})
-	for boss_num, infos in challenging_list.items():
-		for challenger in infos.keys():
-			if str(qqid) == challenger : return boss_num
-	return False
+	return get_clan_state(self, group_id).get_in_boss_num(qqid) or False
 
 
 #SL
@@ -1155,14 +1239,14 @@ def report_hurt(self, s, hurt, group_id:Groupid, qqid:QQid, clean_type = 0):
 		qqid: 需要进行操作的QQ号
 		clean_type: 清理类型 0不清理(记录伤害) 1清特定玩家
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
-	boss_num = self.get_in_boss_num(group_id, qqid)
+	state = get_clan_state(self, group_id)
+	if state is None: raise GroupNotExist
+	boss_num = state.get_in_boss_num(qqid)
 	if clean_type != 2 and not boss_num:
 		raise GroupError('报伤害指令需在申请出刀后使用')
 
 	ret_msg = ''
-	challenging_member_list = safe_load_json(group.challenging_member_list, {})
+	challenging_member_list = state.challenging_member_list
 
 	str_qqid = str(qqid)
 	if clean_type == 0:
@@ -1177,8 +1261,8 @@ def report_hurt(self, s, hurt, group_id:Groupid, qqid:QQid, clean_type = 0):
 			challenging_member_list[boss_num][str_qqid]['damage'] = 0
 			ret_msg = '取消成功'
 
-	group.challenging_member_list = json.dumps(challenging_member_list)
-	group.save()
+	state.save()
+	publish_boss_status(self, state.group)
 	return ret_msg
 
 #单个boss信息
@@ -1188,10 +1272,12 @@ def challenger_info_small(self, group:Clan_group, boss_num, msg:List = None):
 		group: 公会信息对象
 		boss_num: 几王
 	"""
-	now_health = safe_load_json(group.now_cycle_boss_health)[boss_num]
-	next_health = safe_load_json(group.next_cycle_boss_health)[boss_num]
+	state = get_clan_state(self, group.group_id)
+	group = state.group
+	now_health = state.now_cycle_boss_health[boss_num]
+	next_health = state.next_cycle_boss_health[boss_num]
 
-	challenging_list = safe_load_json(group.challenging_member_list)
+	challenging_list = state.challenging_member_list
 	if challenging_list and (boss_num in challenging_list): 
 		challenging_list = challenging_list[boss_num]
 	else:
@@ -1229,14 +1315,28 @@ def challenger_info_small(self, group:Clan_group, boss_num, msg:List = None):
 
 	return msg
 
+#配置中所有可能用到的boss头像id，用于加载boss头像图集
+def get_boss_icon_ids(self) -> FrozenSet[str]:
+	icon_ids = set()
+	for server_icon_ids in self.setting['boss_id'].values():
+		icon_ids.update(server_icon_ids)
+	for boss_icon_names in self.boss_id_name.values():
+		icon_ids.update(boss_icon_names)
+	return frozenset(icon_ids)
+
 #总出刀信息
-def challenger_info(self, group_id):
+def challenger_info(self, group_id, tier:str = 'full'):
 	"""
 	Args:
 		group: 公会信息对象
+		tier: 输出档位 full/reduced/text，渲染队列积压时会自动降级
+
+	Returns:
+		文字档位或图片已存在时直接返回消息，否则返回绘制总出刀信息图片的渲染任务，绘制所需的数据在调用时就已整理好
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None : raise GroupNotExist
+	state = get_clan_state(self, group_id)
+	if state is None : raise GroupNotExist
+	group = state.group
 	date, _ = pcr_datetime(area = group.game_server)
 	challenges:List[Clan_challenge] = Clan_challenge.select().where(
 		Clan_challenge.gid == group_id,
@@ -1263,10 +1363,10 @@ def challenger_info(self, group_id):
 			continue
 		half_challenge_list[str(qqid)] = f'{self._get_nickname_by_qqid(qqid)[:4]}'+ (f' x {num}' if num else '')
 
-	challenging_list = safe_load_json(group.challenging_member_list)
+	challenging_list = state.challenging_member_list
 	group_boss_data = self._boss_data_dict(group)
 	boss_state_image_list:List[Union[Image.Image, BossStatusImageCore]] = []
-	subscribe_handler = SubscribeHandler(group=group)
+	subscribe_handler = SubscribeHandler(state)
 	
 	for boss_num in range(1,6):
 		this_boss_data = group_boss_data[boss_num]
@@ -1307,7 +1407,8 @@ def challenger_info(self, group_id):
 			this_boss_data["icon_id"],
 			extra_info
 		))
-	process_image = get_process_image(
+	level = chr(65+self._level_by_cycle(group.boss_cycle, group.game_server))
+	process_image = ProcessImageCore(
 		[
 			GroupStateBlock(
 				title_text="完整刀",
@@ -1318,7 +1419,7 @@ def challenger_info(self, group_id):
 			),
 			GroupStateBlock(
 				title_text="阶段",
-				data_text=chr(65+self._level_by_cycle(group.boss_cycle, group.game_server)),
+				data_text=level,
 				title_color=(255, 255, 255),
 				data_color=(255, 255, 255),
 				background_color=(3, 169, 244),
@@ -1326,58 +1427,90 @@ def challenger_info(self, group_id):
 		],
 		{"补偿": half_challenge_list}
 	)
-	result_image = generate_combind_boss_state_image([process_image, *boss_state_image_list])
-	if result_image.mode != "RGB":
-		result_image = result_image.convert("RGB")
-	USER_HEADERS_PATH = Path(__file__).parent.joinpath("../../../yobot_data/cache/state/")
-	if not USER_HEADERS_PATH.is_dir():
-		USER_HEADERS_PATH.mkdir(parents=True, exist_ok=True)
-	file_name = str(group_id) + ".jpg"
-	result_image.save(USER_HEADERS_PATH.joinpath(file_name), format='JPEG', quality=95)
-	result_image.close()
-	return f"[CQ:image,file=file:///{str(USER_HEADERS_PATH.joinpath(file_name))}]"
+	image_list = [process_image, *boss_state_image_list]
+	fingerprints = [i.fingerprint() for i in image_list]
+	while tier != 'text':
+		if tier == 'full':
+			image_format = self.setting['status_image_format']
+			if image_format not in IMAGE_FORMATS: image_format = 'jpeg'
+			quality = self.setting['status_image_quality']
+		else:
+			image_format, quality = 'png', 0
+		#状态没有变化时直接使用已有的图片
+		key = render_key((fingerprints, tier, image_format, quality))
+		file_path = self.status_image_store.get(key, image_format)
+		if file_path is not None:
+			return f"[CQ:image,file=file:///{str(file_path)}]"
+		degraded_tier = _degraded_status_tier(self, tier)
+		if degraded_tier == tier:
+			return RenderTask(_render_status_image, group_id, image_list, tier, get_boss_icon_ids(self),
+				self.status_image_store, key, image_format, quality)
+		tier = degraded_tier
+
+	#文字档位
+	msg = [f'完整刀：{finish_challenge_count}  阶段：{level}']
+	half_names = [name for qqid, name in half_challenge_list.items() if qqid.isdigit()]
+	if half_names:
+		msg.append('补偿：' + '，'.join(half_names))
+	msg.append('====================')
+	for boss_num in range(1, 6):
+		self.challenger_info_small(group, str(boss_num), msg)
+	return '\n'.join(msg)
+
+#绘制总出刀信息图片，在渲染线程中执行，只能使用传入的数据
+def _render_status_image(group_id,
+		image_list:List[Union[Image.Image, BossStatusImageCore, ProcessImageCore]],
+		tier:str, icon_ids:FrozenSet[str],
+		store:ImageStore, key:str, image_format:str, quality:int):
+	boss_icon_atlas.load(icon_ids)
+	if tier == 'reduced':
+		result_image = generate_reduced_boss_state_image(image_list)
+	else:
+		result_image = generate_combind_boss_state_image(image_list, get_status_image_cache(group_id))
+	try:
+		file_path = store.save(key, result_image, image_format, quality)
+	finally:
+		result_image.close()
+	return f"[CQ:image,file=file:///{str(file_path)}]"
 
 #出刀记录
 def challenge_record(self, group_id):
 	group:Clan_group = get_clan_group(self, group_id)
 	if group is None : raise GroupNotExist
 	date, _ = pcr_datetime(area = group.game_server)
-	members:List[Clan_member] = Clan_member.select().where(Clan_member.group_id == group_id)
+	members:List[int] = [qqid for qqid, in Clan_member.select(Clan_member.qqid).where(
+		Clan_member.group_id == group_id).tuples()]
+	day_blades = self.blade_counter.get_day(group_id, group.battle_id, date)
 
 	total_blade_num = 0				#总出刀数
 	total_continue_blade_num = 0	#总补偿刀数量
 	zero_blade_members = []			#一刀没出的成员
 	blade_list = {}
-	for member in members:
-		challenge_records:List[Clan_challenge] = Clan_challenge.select().where(
-			Clan_challenge.gid == group_id,
-			Clan_challenge.bid == group.battle_id,
-			Clan_challenge.challenge_pcrdate == date,
-			Clan_challenge.qqid == member.qqid
-		).order_by(Clan_challenge.cid)
-		if len(challenge_records) != 0:
-			member_num = 0			#单个成员出刀数
-			continue_blade_num = 0	#单个成员剩余补偿刀数量
-			for c in challenge_records:
-				if c.boss_health_remain == 0 and not c.is_continue:	#完整刀收尾算0.5刀
-					member_num += 0.5
-					continue_blade_num += 1
-				elif c.is_continue:	#补偿刀算0.5刀
-					member_num += 0.5
-					continue_blade_num -= 1
-				else: member_num += 1
+	for qqid in members:
+		blade = day_blades.get(qqid)
+		if blade is not None and blade.total:
+			#完整刀收尾与补偿刀各算0.5刀
+			half_blade_num = blade.tail + blade.cont
+			member_num = blade.finished - blade.cont	#单个成员出刀数
+			if half_blade_num: member_num += half_blade_num * 0.5
+			continue_blade_num = blade.tail - blade.cont	#单个成员剩余补偿刀数量
 			total_blade_num += member_num
 			total_continue_blade_num += continue_blade_num
 			if member_num not in blade_list: blade_list[member_num] = 1
 			else: blade_list[member_num] += 1
 		else:
-			zero_blade_members.append(member.qqid)
+			zero_blade_members.append(qqid)
+
+	nicknames = {}
+	if zero_blade_members:
+		nicknames = dict(User.select(User.qqid, User.nickname).where(
+			User.qqid.in_(zero_blade_members)).tuples())
 
 	back_msg = []
 	back_msg.append(f"待出补偿刀数量：{total_continue_blade_num}")
 	back_msg.append(f"已出0刀的成员数量：{len(zero_blade_members)}")
 	for i in range(len(zero_blade_members)):
-		name = self._get_nickname_by_qqid(zero_blade_members[i])
+		name = nicknames.get(zero_blade_members[i]) or self._get_nickname_by_qqid(zero_blade_members[i])
 		back_msg.append(f"{i == len(zero_blade_members)-1 and '┖' or '┣'}{name}")
 	for blade_num in blade_list.keys():
 		back_msg.append(f"已出{blade_num}刀：{blade_list[blade_num]}")
@@ -1385,6 +1518,195 @@ def challenge_record(self, group_id):
 	return '\n'.join(back_msg)
 
 
+#出刀记录的查询条件
+def _report_expressions(self,
+						group: Clan_group,
+						battle_id: Union[str, int, None],
+						qqid: Optional[QQid] = None,
+						pcrdate: Optional[Pcr_date] = None
+						) -> list:
+	expressions = [
+		Clan_challenge.gid == group.group_id,
+	]
+	if battle_id is None:
+		battle_id = group.battle_id
+	if isinstance(battle_id, str):
+		if battle_id == 'all':
+			pass
+		else:
+			raise InputError(
+				f'unexceptd value "{battle_id}" for battle_id')
+	else:
+		expressions.append(Clan_challenge.bid == battle_id)
+	if qqid is not None:
+		expressions.append(Clan_challenge.qqid == qqid)
+	if pcrdate is not None:
+		expressions.append(Clan_challenge.challenge_pcrdate == pcrdate)
+	return expressions
+
+##分块获取报告
+def iter_report(self,
+				group_id: Groupid,
+				battle_id: Union[str, int, None],
+				qqid: Optional[QQid] = None,
+				pcrdate: Optional[Pcr_date] = None,
+				after_cid: int = 0,
+				chunk_size: int = REPORT_CHUNK_SIZE,
+				) -> Iterator[ClanBattleReport]:
+	"""
+	按出刀记录id顺序分块获取记录  每块只查询id大于上一块最后一条记录的部分
+	内存占用只与chunk_size有关  与记录总数无关
+
+	Args:
+		group_id: QQ群号
+		qqid: user id of report
+		pcrdate: pcrdate of report
+		after_cid: 只获取id大于此值的记录
+		chunk_size: 每块的记录数量
+	"""
+	group:Clan_group = get_clan_group(self, group_id)
+	if group is None: raise GroupNotExist
+	expressions = _report_expressions(self, group, battle_id, qqid, pcrdate)
+	while True:
+		chunk = []
+		for c in Clan_challenge.select().where(
+			*expressions,
+			Clan_challenge.cid > after_cid,
+		).order_by(Clan_challenge.cid).limit(chunk_size):
+			chunk.append({
+				'cid': c.cid,
+				'battle_id': c.bid,
+				'qqid': c.qqid,
+				'challenge_time': pcr_timestamp(
+					c.challenge_pcrdate,
+					c.challenge_pcrtime,
+					group.game_server,
+				),
+				'challenge_pcrdate': c.challenge_pcrdate,
+				'challenge_pcrtime': c.challenge_pcrtime,
+				'cycle': c.boss_cycle,
+				'boss_num': c.boss_num,
+				'health_remain': c.boss_health_remain,
+				'damage': c.challenge_damage,
+				'is_continue': c.is_continue,
+				'message': c.message,
+				'behalf': c.behalf,
+			})
+		if chunk:
+			yield chunk
+		if len(chunk) < chunk_size:
+			return
+		after_cid = chunk[-1]['cid']
+
+##增量获取报告
+def get_report_delta(self,
+					group_id: Groupid,
+					battle_id: Union[str, int, None],
+					pcrdate: Optional[Pcr_date] = None,
+					since_cid: Optional[int] = None,
+					since_token: Optional[str] = None,
+					) -> Dict[str, Any]:
+	"""
+	获取上次同步之后新增与被删除的出刀记录
+	出刀记录id在撤销后可能被重新使用  因此从被删除的最小id开始重新发送记录
+	客户端应先移除 tombstones 中的记录  再按id合并 challenges 中的记录
+
+	Args:
+		group_id: QQ群号
+		battle_id: 会战记录编号
+		pcrdate: pcrdate of report
+		since_cid: 客户端上次同步时获得的 last_cid
+		since_token: 客户端上次同步时获得的 sync_token
+	"""
+	group:Clan_group = get_clan_group(self, group_id)
+	if group is None: raise GroupNotExist
+	deleted, after_cid, sync_token = _report_delta_cursor(self, group_id, since_cid, since_token)
+	challenges, last_cid = _query_report_since(self, group, battle_id, pcrdate, after_cid)
+	return {
+		'full': deleted is None,
+		'challenges': challenges,
+		'tombstones': deleted or [],
+		'last_cid': last_cid,
+		'sync_token': sync_token,
+	}
+
+#增量同步的起点
+def _report_delta_cursor(self,
+						group_id: Groupid,
+						since_cid: Optional[int],
+						since_token: Optional[str],
+						) -> Tuple[Optional[List[int]], int, str]:
+	"""
+	根据客户端的同步标记计算需要重新发送的起点
+	同步标记在查询之前获取  查询期间发生的删除会在下次同步时补发
+
+	Returns:
+		(被删除的出刀记录id  无法增量同步时为None, 起始出刀记录id, 当前的同步标记)
+	"""
+	tombstones = get_challenge_tombstones(self, group_id)
+	sync_token = tombstones.token
+	deleted = None if since_cid is None else tombstones.since(since_token)
+	if deleted is None:
+		after_cid = 0
+	else:
+		after_cid = min([since_cid] + [cid - 1 for cid in deleted])
+	return deleted, after_cid, sync_token
+
+#获取某条记录之后的出刀记录与最后一条记录的id
+def _query_report_since(self,
+						group: Clan_group,
+						battle_id: Union[str, int, None],
+						pcrdate: Optional[Pcr_date],
+						after_cid: int,
+						) -> Tuple[ClanBattleReport, int]:
+	challenges = []
+	for chunk in iter_report(self, group.group_id, battle_id, None, pcrdate, after_cid):
+		challenges.extend(chunk)
+	last_cid = Clan_challenge.select(peewee.fn.MAX(Clan_challenge.cid)).where(
+		*_report_expressions(self, group, battle_id, None, pcrdate)).scalar()
+	return challenges, last_cid or 0
+
+#出刀记录的列式编码
+REPORT_DELTA_COLUMNS = ('cid', 'challenge_time', 'challenge_pcrdate')
+def encode_report_columnar(self, chunks) -> Dict[str, Any]:
+	"""
+	将出刀记录编码为列式结构  每个字段一个数组
+	cid/challenge_time/challenge_pcrdate 记录与上一条的差值  qqid 记录在 qqids 中的下标
+
+	Args:
+		chunks: 出刀记录的分块  如 iter_report() 的返回值
+	"""
+	columns = {key: [] for key in (
+		'cid', 'battle_id', 'qqid', 'challenge_time', 'challenge_pcrdate',
+		'challenge_pcrtime', 'cycle', 'boss_num', 'health_remain', 'damage',
+		'is_continue', 'message', 'behalf',
+	)}
+	qqids = []
+	qqid_index = {}
+	previous = dict.fromkeys(REPORT_DELTA_COLUMNS, 0)
+	count = 0
+	for chunk in chunks:
+		for record in chunk:
+			count += 1
+			for key, column in columns.items():
+				value = record[key]
+				if key in previous:
+					value, previous[key] = value - previous[key], value
+				elif key == 'qqid':
+					if value not in qqid_index:
+						qqid_index[value] = len(qqids)
+						qqids.append(value)
+					value = qqid_index[value]
+				elif key == 'is_continue':
+					value = int(value)
+				column.append(value)
+	return {
+		'count': count,
+		'qqids': qqids,
+		'delta': REPORT_DELTA_COLUMNS,
+		'columns': columns,
+	}
+
 ##获取报告
 @timed_cached_func(max_len=64, max_age_seconds=10, ignore_self=True)
 def get_report(self,
@@ -1401,47 +1723,9 @@ def get_report(self,
 		qqid: user id of report
 		pcrdate: pcrdate of report
 	"""
-	group:Clan_group = get_clan_group(self, group_id)
-	if group is None: raise GroupNotExist
 	report = []
-	expressions = [
-		Clan_challenge.gid == group_id,
-	]
-	if battle_id is None:
-		battle_id = group.battle_id
-	if isinstance(battle_id, str):
-		if battle_id == 'all':
-			pass
-		else:
-			raise InputError(
-				f'unexceptd value "{battle_id}" for battle_id')
-	else:
-		expressions.append(Clan_challenge.bid == battle_id)
-	if qqid is not None:
-		expressions.append(Clan_challenge.qqid == qqid)
-	if pcrdate is not None:
-		expressions.append(Clan_challenge.challenge_pcrdate == pcrdate)
-	for c in Clan_challenge.select().where(
-		*expressions
-	):
-		report.append({
-			'battle_id': c.bid,
-			'qqid': c.qqid,
-			'challenge_time': pcr_timestamp(
-				c.challenge_pcrdate,
-				c.challenge_pcrtime,
-				group.game_server,
-			),
-			'challenge_pcrdate': c.challenge_pcrdate,
-			'challenge_pcrtime': c.challenge_pcrtime,
-			'cycle': c.boss_cycle,
-			'boss_num': c.boss_num,
-			'health_remain': c.boss_health_remain,
-			'damage': c.challenge_damage,
-			'is_continue': c.is_continue,
-			'message': c.message,
-			'behalf': c.behalf,
-		})
+	for chunk in iter_report(self, group_id, battle_id, qqid, pcrdate):
+		report.extend(chunk)
 	return report
 
 #从会战记录里获取成员列表
@@ -1457,19 +1741,7 @@ def get_battle_member_list(self,
 	"""
 	group:Clan_group = get_clan_group(self, group_id)
 	if group is None: raise GroupNotExist
-	expressions = [
-		Clan_challenge.gid == group_id,
-	]
-	if battle_id is None:
-		battle_id = group.battle_id
-	if isinstance(battle_id, str):
-		if battle_id == 'all':
-			pass
-		else:
-			raise InputError(
-				f'unexceptd value "{battle_id}" for battle_id')
-	else:
-		expressions.append(Clan_challenge.bid == battle_id)
+	expressions = _report_expressions(self, group, battle_id)
 	member_list = []
 	for u in Clan_challenge.select(
 		Clan_challenge.qqid,
@@ -1514,6 +1786,68 @@ def get_member_list(self, group_id: Groupid) -> List[Dict[str, Any]]:
 		})
 	return member_list
 
+#以下为在数据库线程中执行的查询，供网页等异步的调用方使用
+#公会实例在事件循环中加载，数据库线程只读取已缓存的实例
+
+##在数据库线程中获取报告
+async def get_report_async(self,
+						group_id: Groupid,
+						battle_id: Union[str, int, None],
+						qqid: Optional[QQid] = None,
+						pcrdate: Optional[Pcr_date] = None
+						) -> ClanBattleReport:
+	if get_clan_group(self, group_id) is None: raise GroupNotExist
+	return await db_executor.read(get_report, self, group_id, battle_id, qqid, pcrdate)
+
+##在数据库线程中分块获取报告
+async def iter_report_async(self,
+						group_id: Groupid,
+						battle_id: Union[str, int, None],
+						qqid: Optional[QQid] = None,
+						pcrdate: Optional[Pcr_date] = None,
+						after_cid: int = 0,
+						chunk_size: int = REPORT_CHUNK_SIZE,
+						) -> AsyncIterator[ClanBattleReport]:
+	"""
+	与 iter_report() 相同  每块在数据库线程中查询  查询之间让出事件循环
+	"""
+	if get_clan_group(self, group_id) is None: raise GroupNotExist
+	async for chunk in db_executor.iterate(
+		iter_report(self, group_id, battle_id, qqid, pcrdate, after_cid, chunk_size)):
+		yield chunk
+
+##在数据库线程中增量获取报告
+async def get_report_delta_async(self,
+						group_id: Groupid,
+						battle_id: Union[str, int, None],
+						pcrdate: Optional[Pcr_date] = None,
+						since_cid: Optional[int] = None,
+						since_token: Optional[str] = None,
+						) -> Dict[str, Any]:
+	"""
+	与 get_report_delta() 相同  删除记录在事件循环中读取  出刀记录在数据库线程中查询
+	"""
+	group:Clan_group = get_clan_group(self, group_id)
+	if group is None: raise GroupNotExist
+	deleted, after_cid, sync_token = _report_delta_cursor(self, group_id, since_cid, since_token)
+	challenges, last_cid = await db_executor.read(
+		_query_report_since, self, group, battle_id, pcrdate, after_cid)
+	return {
+		'full': deleted is None,
+		'challenges': challenges,
+		'tombstones': deleted or [],
+		'last_cid': last_cid,
+		'sync_token': sync_token,
+	}
 
-
-
+##在数据库线程中从会战记录里获取成员列表
+async def get_battle_member_list_async(self,
+						group_id: Groupid,
+						battle_id: Union[str, int, None],
+						):
+	if get_clan_group(self, group_id) is None: raise GroupNotExist
+	return await db_executor.read(get_battle_member_list, self, group_id, battle_id)
+
+##在数据库线程中获取所有成员列表
+async def get_member_list_async(self, group_id: Groupid) -> List[Dict[str, Any]]:
+	return await db_executor.read(get_member_list, self, group_id)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from ..exception import ClanBattleError
+
+_logger = logging.getLogger(__name__)
+
+RENDER_WORKERS = 2  # 渲染线程数量  PIL在绘制和编码时会释放GIL
+RENDER_QUEUE_SIZE = 16  # 同时等待或正在渲染的任务上限
+RENDER_TIMEOUT = 30  # 等待单个渲染任务的超时时间(秒)
+
+
+class RenderBusy(ClanBattleError):
+    def __init__(self, msg='图片生成繁忙，请稍后再试', *args):
+        super().__init__(msg, *args)
+
+
+class RenderTask:
+    """
+    延迟执行的渲染任务
+    同步的指令处理函数在公会状态下整理好绘制所需的数据  返回此对象
+    由异步的调用方交给渲染服务在事件循环之外执行
+
+    :param func: 渲染函数  只能使用传入的参数  不能访问公会状态和数据库
+    :param then: 渲染完成后在事件循环中以渲染结果调用的函数  返回值作为最终结果
+    """
+
+    __slots__ = ("func", "args", "then")
+
+    def __init__(self, func: Callable[..., Any], *args, then: Optional[Callable[[Any], Any]] = None) -> None:
+        self.func = func
+        self.args = args
+        self.then = then
+
+
+class RenderService:
+    """
+    图片渲染服务
+    在线程池中执行渲染任务  避免绘图阻塞事件循环
+    同时等待或正在执行的任务超过上限时直接拒绝  超时的任务会继续执行完毕  但调用方不再等待
+
+    :param max_workers: 渲染线程数量
+    :param max_pending: 同时等待或正在渲染的任务上限
+    :param timeout: 等待单个渲染任务的超时时间(秒)
+    """
+
+    def __init__(self,
+                 max_workers: int = RENDER_WORKERS,
+                 max_pending: int = RENDER_QUEUE_SIZE,
+                 timeout: float = RENDER_TIMEOUT) -> None:
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="yobot-render")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """
+        等待或正在渲染的任务数量  包括调用方已超时但尚未执行完毕的任务
+        """
+        return self._pending
+
+    def _release(self, _) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    async def render(self, func: Callable[..., Any], *args) -> Any:
+        """
+        在渲染线程中执行一个渲染函数并等待结果
+
+        :param func: 渲染函数
+        :return: 函数的返回值  函数抛出的异常会原样抛出
+        :raise RenderBusy: 任务数量已达上限或等待超时
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise RenderBusy
+            self._pending += 1
+        try:
+            future = self._pool.submit(func, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            _logger.warning('图片渲染超时 {}'.format(getattr(func, '__name__', func)))
+            raise RenderBusy('图片生成超时，请稍后再试')
+
+    async def run(self, task: RenderTask) -> Any:
+        """
+        执行一个延迟渲染任务
+        """
+        result = await self.render(task.func, *task.args)
+        if task.then is not None:
+            result = task.then(result)
+        return result
+
+    def shutdown(self) -> None:
+        """
+        关闭渲染线程池  不等待未完成的任务
+        """
+        self._pool.shutdown(wait=False)
@@ -1,8 +1,11 @@
 import os
 import string
+from typing import Any, Dict, List
 
 from ..exception import GroupNotExist
+from .render import RenderTask
 from ...ybdata import Clan_challenge, Clan_group, Clan_member
+from ...db_executor import db_executor
 
 
 FILE_PATH = os.path.dirname(__file__)
@@ -11,66 +14,124 @@ def is_Chinese(word):
 	for ch in word:
 		if '\u4e00' <= ch <= '\u9fff': return True
 
-#业绩表
-def score_table(self, group_id):
+def _score_cache_key(group_id, battle_id, threshold, members:List[int]) -> tuple:
+	'''
+	业绩表缓存的校验键
+	出刀记录的自增id在撤销后可能被重新使用  因此同时比较最后一条记录的时间
+	'''
+	last = Clan_challenge.select(
+		Clan_challenge.cid,
+		Clan_challenge.challenge_pcrdate,
+		Clan_challenge.challenge_pcrtime,
+	).where(
+		Clan_challenge.gid == group_id,
+		Clan_challenge.bid == battle_id,
+	).order_by(Clan_challenge.cid.desc()).limit(1).tuples().first()
+	return (last, threshold, tuple(members))
+
+#获取业绩数据
+def get_score_table(self, group_id) -> List[Dict[str, Any]]:
 	'''
 	通过当期数据给成员打分
+	结果按(群号, 档案号, 最后一条出刀记录)缓存  有新的出刀记录前重复获取不再查询出刀记录
+
+	Returns:
+		按分数从高到低排列的 [{qqid, score, full_blade, end_blade, small_end_blade}]
 	'''
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self.get_clan_group(group_id)
 	if group is None:raise GroupNotExist
+	return _get_score_table(self, group_id, group.battle_id, group.threshold)
 
-	members = Clan_member.select().where(
+def _get_score_table(self, group_id, battle_id, threshold) -> List[Dict[str, Any]]:
+	'''
+	get_score_table() 的查询与计分部分
+	只访问数据库和业绩缓存  公会数据由调用方在事件循环中取出后传入  可以在数据库线程中执行
+	'''
+	members = [qqid for qqid, in Clan_member.select(Clan_member.qqid).where(
 		Clan_member.group_id == group_id,
-	)
+	).tuples()]
+	cache_key = _score_cache_key(group_id, battle_id, threshold, members)
+	with self.score_table_cache_lock:
+		cached = self.score_table_cache.get((group_id, battle_id))
+	if cached is not None and cached[0] == cache_key:
+		return cached[1]
+
+	#一次取出本期所有出刀记录  再按成员分组
+	member_challenges = {qqid: [] for qqid in members}
+	for record in Clan_challenge.select(
+		Clan_challenge.qqid,
+		Clan_challenge.behalf,
+		Clan_challenge.boss_health_remain,
+		Clan_challenge.challenge_damage,
+		Clan_challenge.is_continue,
+	).where(
+		Clan_challenge.gid == group_id,
+		Clan_challenge.bid == battle_id,
+	).order_by(Clan_challenge.challenge_pcrdate, Clan_challenge.cid).tuples():
+		if record[0] in member_challenges:
+			member_challenges[record[0]].append(record)
 
 	member_score_dict = {}
-	for member in members:
-		challenges = Clan_challenge.select().where(
-			Clan_challenge.gid == group_id,
-			Clan_challenge.bid == group.battle_id,
-			Clan_challenge.qqid == member.qqid
-		).order_by(Clan_challenge.challenge_pcrdate)
-		challenges = list(challenges)
-		if member.qqid not in member_score_dict:
-			member_score_dict[member.qqid] = {
+	for qqid, challenges in member_challenges.items():
+		if qqid not in member_score_dict:
+			member_score_dict[qqid] = {
 				'score' : 0,
 				'full_blade' : 0,
 				'end_blade' : 0,
 				'small_end_blade' : 0,
 			}
-
-		full_blade = sum(bool(c.boss_health_remain and not c.is_continue) for c in challenges)
-		for info in challenges:
-			score, full_blade, end_blade, small_end_blade = 0, 0, 0, 0
-			if info.boss_health_remain > 0 and not info.is_continue: 
-				full_blade += 1
-				score += 1
-			elif info.boss_health_remain == 0 and not info.is_continue: 
-				end_blade += 1
-				if info.challenge_damage >= group.threshold: score += 1
-				else: score += 0.5
-			elif info.is_continue:
-				small_end_blade += 1
-				if info.challenge_damage >= group.threshold: score += 1
-				else: score += 0.5
-			score_member = info.behalf and info.behalf or member.qqid
+		for _, behalf, boss_health_remain, challenge_damage, is_continue in challenges:
+			score_member = behalf or qqid
 			if score_member not in member_score_dict:
 				member_score_dict[score_member] = {
-					'score' : score, 
-					'full_blade' : full_blade,
-					'end_blade' : end_blade,
-					'small_end_blade' : small_end_blade,
+					'score' : 0,
+					'full_blade' : 0,
+					'end_blade' : 0,
+					'small_end_blade' : 0,
 				}
+			info = member_score_dict[score_member]
+			if boss_health_remain > 0 and not is_continue:
+				info['full_blade'] += 1
+				info['score'] += 1
 			else:
-				member_score_dict[score_member]['score'] += score
-				member_score_dict[score_member]['full_blade'] += full_blade
-				member_score_dict[score_member]['end_blade'] += end_blade
-				member_score_dict[score_member]['small_end_blade'] += small_end_blade
+				if is_continue: info['small_end_blade'] += 1
+				else: info['end_blade'] += 1
+				if challenge_damage >= threshold: info['score'] += 1
+				else: info['score'] += 0.5
+
+	table = [dict(qqid=qqid, **info) for qqid, info in sorted(
+		member_score_dict.items(), key=lambda item: item[1]['score'], reverse=True)]
+	with self.score_table_cache_lock:
+		#并发计算时保留已绘制的图片  避免较早的结果覆盖
+		cached = self.score_table_cache.get((group_id, battle_id))
+		if cached is None or cached[0] != cache_key:
+			self.score_table_cache[(group_id, battle_id)] = (cache_key, table, None)
+	return table
+
+#在数据库线程中获取业绩数据
+async def get_score_table_async(self, group_id) -> List[Dict[str, Any]]:
+	'''
+	与 get_score_table() 相同  查询与计分在数据库线程中执行
+	'''
+	group:Clan_group = self.get_clan_group(group_id)
+	if group is None:raise GroupNotExist
+	return await db_executor.read(_get_score_table, self, group_id, group.battle_id, group.threshold)
+
+#业绩表
+def score_table(self, group_id):
+	'''
+	通过当期数据给成员打分  返回业绩表图片
+	图片按绘制的文字缓存  成员改名后文字不同  会重新绘制
+	图片未缓存时返回绘制图片的渲染任务  绘制完成后写入缓存
+	'''
+	group:Clan_group = self.get_clan_group(group_id)
+	if group is None:raise GroupNotExist
+	table = get_score_table(self, group_id)
+	key = (group_id, group.battle_id)
 
-	member_score_dict = dict(sorted(member_score_dict.items(), key=lambda item: item[1]['score'], reverse=True))
 	back_msg = []
-	for qqid, info in member_score_dict.items():
-		name:string = list(self._get_nickname_by_qqid(qqid))
+	for info in table:
+		name:string = list(self._get_nickname_by_qqid(info['qqid']))
 		while len(name) > 5:name.pop()
 		a = ''
 		if len(name) < 5:
@@ -85,4 +146,18 @@ def score_table(self, group_id):
 尾刀：{info['end_blade']}     \
 小尾刀：{info['small_end_blade']}")
 
-	return self.text_2_pic('\n'.join(back_msg), 450, len(back_msg)*20 + 10, (255, 255, 255), "#000000", 15, (10, 5))
+	text = '\n'.join(back_msg)
+	with self.score_table_cache_lock:
+		cached = self.score_table_cache.get(key)
+	if cached is not None and cached[2] is not None and cached[2][0] == text:
+		return cached[2][1]
+
+	def save_image(image):
+		#图片与文字一同保存  绘制期间业绩或昵称有变化时  文字不同的图片不会被使用
+		with self.score_table_cache_lock:
+			cached = self.score_table_cache.get(key)
+			if cached is not None:
+				self.score_table_cache[key] = cached[:2] + ((text, image),)
+		return image
+
+	return RenderTask(self.text_2_pic, text, 450, len(back_msg)*20 + 10, (255, 255, 255), "#000000", 15, (10, 5), then=save_image)
@@ -0,0 +1,155 @@
+import copy
+import json
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from playhouse.shortcuts import model_to_dict
+
+from ...db_executor import db_executor
+from ...ybdata import Clan_group
+
+
+class ClanState:
+    """
+    公会运行时状态
+    Clan_group 中以json文本存储的字段只在加载时解析一次  之后直接在内存中修改
+    仅在持久化(save()方法)时重新序列化写回 Clan_group 实例
+
+    字段结构:
+        now_cycle_boss_health: Dict[str, int] = {Boss编号: 血量}
+        next_cycle_boss_health: Dict[str, int] = {Boss编号: 血量}
+        challenging_member_list: Dict[str, Dict[str, Dict[str, Any]]] = {Boss编号: {出刀QQ号: 出刀信息}}
+        subscribe_list: Dict[int, Dict[int, str]] = {Boss编号: {预约QQ号: 留言}}
+
+    :param group: Clan_group公会实例
+    """
+
+    __slots__ = (
+        "group",
+        "now_cycle_boss_health",
+        "next_cycle_boss_health",
+        "challenging_member_list",
+        "subscribe_list",
+        "_batch_depth",
+        "_dirty",
+    )
+
+    def __init__(self, group: Clan_group) -> None:
+        self.group: Clan_group = group
+        self._batch_depth = 0
+        self._dirty = False
+        self.load()
+
+    def load(self) -> None:
+        """
+        从 Clan_group 实例的json文本字段重新加载状态
+        在直接修改了 Clan_group 的json文本字段后(如切换/清空档案)需要调用
+        """
+        group = self.group
+        self.now_cycle_boss_health: Dict[str, int] = _load_json(group.now_cycle_boss_health)
+        self.next_cycle_boss_health: Dict[str, int] = _load_json(group.next_cycle_boss_health)
+        self.challenging_member_list: Dict[str, Dict[str, Dict[str, Any]]] = _load_json(group.challenging_member_list)
+
+        subscribe_list: Dict[int, Dict[int, str]] = {}
+        for boss_no, boss_subscribe_data in _load_json(group.subscribe_list).items():
+            subscribe_list[int(boss_no)] = {int(qqid): note for qqid, note in boss_subscribe_data.items()}
+        self.subscribe_list = subscribe_list
+
+    def dump(self) -> None:
+        """
+        将状态序列化写回 Clan_group 实例  不写入数据库
+        """
+        group = self.group
+        group.now_cycle_boss_health = json.dumps(self.now_cycle_boss_health)
+        group.next_cycle_boss_health = json.dumps(self.next_cycle_boss_health)
+        group.challenging_member_list = json.dumps(self.challenging_member_list) if self.challenging_member_list else None
+        group.subscribe_list = json.dumps(self.subscribe_list) if self.subscribe_list else None
+
+    def save(self) -> None:
+        """
+        持久化状态
+        处于合并持久化期间时只做标记  在合并结束时统一写入
+        """
+        if self._batch_depth:
+            self._dirty = True
+            return
+        self.dump()
+        self.group.save()
+
+    async def flush(self) -> None:
+        """
+        在数据库写线程中写入合并持久化期间标记的修改  没有修改时不写入
+        序列化在事件循环中完成  写线程只写入调用时的快照
+        """
+        if not self._dirty:
+            return
+        self._dirty = False
+        self.dump()
+        await db_executor.write(_save_group, model_to_dict(self.group, recurse=False))
+
+    @contextmanager
+    def batched(self, persist: bool = True) -> Iterator["ClanState"]:
+        """
+        合并持久化
+        期间所有的save()调用会合并为退出时的一次写入
+
+        :param persist: 为False时退出时不写入  由调用方之后通过flush()写入
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        if persist and not self._batch_depth and self._dirty:
+            self._dirty = False
+            self.save()
+
+    @contextmanager
+    def restore_on_error(self) -> Iterator["ClanState"]:
+        """
+        期间抛出异常时将出刀申请列表恢复为进入时的内容
+        用于先修改申请列表再写入数据库的操作  写入失败时不会留下修改了一半的状态
+        期间处于合并持久化(batched())中  save()只做标记  退出时也不写入  修改由之后的save()或flush()写入
+        因此恢复后的内存状态与数据库保持一致  不依赖调用方是否已处于合并持久化期间
+        期间可以await写线程中的写入  退出时不会在事件循环中写入数据库
+        """
+        snapshot = copy.deepcopy(self.challenging_member_list)
+        try:
+            with self.batched(persist=False):
+                yield self
+        except BaseException:
+            self.challenging_member_list = snapshot
+            raise
+
+    def get_in_boss_num(self, qqid) -> Optional[str]:
+        """
+        获取正在出刀的成员所在的Boss编号
+
+        :param qqid: QQ号
+        :return: Boss编号  未申请出刀返回None
+        """
+        str_qqid = str(qqid)
+        for boss_num, infos in self.challenging_member_list.items():
+            if str_qqid in infos:
+                return boss_num
+        return None
+
+    def get_challenger(self, qqid) -> Optional[Dict[str, Any]]:
+        """
+        获取正在出刀的成员的出刀信息
+
+        :param qqid: QQ号
+        :return: 出刀信息  未申请出刀返回None
+        """
+        boss_num = self.get_in_boss_num(qqid)
+        if boss_num is None:
+            return None
+        return self.challenging_member_list[boss_num][str(qqid)]
+
+
+def _save_group(data: Dict[str, Any]) -> None:
+    Clan_group(**data).save()
+
+
+def _load_json(text: Optional[str]) -> Dict:
+    return text and json.loads(text) or {}
@@ -0,0 +1,64 @@
+import os
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+TOMBSTONE_SIZE = 256  # 每个公会保留的删除记录数量
+
+# 每次启动生成不同的纪元  重启后旧的同步标记将失效  客户端会重新获取完整记录
+_EPOCH = os.urandom(4).hex()
+
+
+class ChallengeTombstones:
+    """
+    单个公会被删除的出刀记录  用于出刀记录的增量同步
+    每次删除生成一个序号递增的删除记录  客户端凭同步标记获取之后被删除的出刀记录id
+    批量删除(清空/切换档案)不逐条记录  之前的同步标记全部失效
+    """
+
+    def __init__(self) -> None:
+        self.seq = 0
+        self._floor = 0  # 序号不大于此值的删除记录已无法获取
+        self._log: Deque[Tuple[int, int]] = deque()
+
+    @property
+    def token(self) -> str:
+        """
+        当前的同步标记  格式为 纪元-序号
+        """
+        return f"{_EPOCH}-{self.seq}"
+
+    def delete(self, cid: int) -> None:
+        """
+        记录一条被删除的出刀记录
+
+        :param cid: 出刀记录id
+        """
+        if len(self._log) >= TOMBSTONE_SIZE:
+            self._floor = self._log.popleft()[0]
+        self.seq += 1
+        self._log.append((self.seq, cid))
+
+    def reset(self) -> None:
+        """
+        批量删除了出刀记录  之前的同步标记全部失效
+        """
+        self.seq += 1
+        self._floor = self.seq
+        self._log.clear()
+
+    def since(self, token: Optional[str]) -> Optional[List[int]]:
+        """
+        获取某个同步标记之后被删除的出刀记录
+
+        :param token: 客户端上次同步时获得的同步标记
+        :return: 出刀记录id列表  无法增量同步(标记无效或删除记录已被丢弃)时返回None
+        """
+        if not token:
+            return None
+        epoch, _, seq = token.partition("-")
+        if epoch != _EPOCH or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq > self.seq or seq < self._floor:
+            return None
+        return [cid for i, cid in self._log if i > seq]
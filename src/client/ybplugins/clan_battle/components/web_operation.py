@@ -1,10 +1,12 @@
 import asyncio
+import json
 import logging
 from urllib.parse import urljoin
 
 import peewee
-from quart import Quart, jsonify, make_response, redirect, request, session, url_for
+from quart import Quart, Response, jsonify, make_response, redirect, request, session, url_for
 
+from ...db_executor import db_executor
 from ...templating import render_template
 from ...ybdata import Clan_group, Clan_member, User
 from ..exception import ClanBattleError
@@ -12,8 +14,31 @@ from ..util import pcr_datetime, atqq
 from .multi_cq_utils import who_am_i
 
 _logger = logging.getLogger(__name__)
+REPORT_PAGE_LIMIT = 5000	#分页获取出刀记录时每页的记录数量上限
 
 def register_routes(self, app: Quart):
+	def boss_status_response(group_id, since_version=None, **fields) -> Response:
+		"""
+		返回boss状态  bossData直接使用缓存的序列化数据
+
+		Args:
+			group_id: QQ群号
+			since_version: 客户端已有数据的版本号  有效时只返回之后发生变化的boss数据
+			fields: 其他需要返回的字段
+		"""
+		hub = self.get_boss_status_hub(group_id)
+		boss_data = hub.boss_data_json_since(since_version)
+		partial = boss_data is not None
+		if not partial:
+			boss_data = hub.boss_data_json()
+		fields.update(
+			version = hub.event_id,
+			base_cycle = hub.base_cycle,
+			partial = partial,
+		)
+		body = json.dumps(fields, ensure_ascii=False)
+		return Response(body[:-1] + ',"bossData":' + boss_data + '}', mimetype='application/json')
+
 	@app.route(
 		urljoin(self.setting['public_basepath'], 'clan/<int:group_id>/'),
 		methods=['GET'])
@@ -57,7 +82,7 @@ def register_routes(self, app: Quart):
 				'clan/<int:group_id>/api/'),
 		methods=['POST'])
 	async def yobot_clan_api(group_id):
-		group = Clan_group.get_or_none(group_id=group_id)
+		group = self.get_clan_group(group_id)
 		if group is None:
 			return jsonify(
 				code=20,
@@ -95,7 +120,7 @@ def register_routes(self, app: Quart):
 			action = payload['action']
 			if user_id == 0:
 				# 允许游客查看
-				if action not in ['get_member_list', 'get_challenge']:
+				if action not in ['get_member_list', 'get_challenge', 'get_score_table']:
 					return jsonify(
 						code=10,
 						message='Not logged in',
@@ -103,10 +128,12 @@ def register_routes(self, app: Quart):
 			if action == 'get_member_list':
 				return jsonify(
 					code=0,
-					members=self.get_member_list(group_id),
+					members=await self.get_member_list_async(group_id),
 				)
 			elif action == 'get_data':
-				return jsonify(
+				return boss_status_response(
+					group_id,
+					payload.get('since_version'),
 					code=0,
 					groupData={
 						'group_id': group.group_id,
@@ -114,22 +141,30 @@ def register_routes(self, app: Quart):
 						'game_server': group.game_server,
 						'cycle': group.boss_cycle,
 					},
-					bossData=self._boss_data_dict(group),
-					base_cycle = group.boss_cycle,
 					selfData={
 						'is_admin': (is_member and user.authority_group < 100),
 						'user_id': user_id,
 					}
 				)
 			elif action == 'update_boss_data':
-				return jsonify(
-					code = 0,
-					bossData = self._boss_data_dict(group),
-					base_cycle = group.boss_cycle,
-				)
+				return boss_status_response(group_id, payload.get('since_version'), code=0)
 			elif action == 'get_challenge':
 				d, _ = pcr_datetime(group.game_server)
-				report = self.get_report(
+				if payload.get('since_cid') is not None:
+					# 增量同步  只返回上次同步之后新增与被删除的记录
+					delta = await self.get_report_delta_async(
+						group_id,
+						None,
+						pcr_datetime(group.game_server, payload['ts'])[0],
+						int(payload['since_cid']),
+						payload.get('sync_token'),
+					)
+					return jsonify(
+						code=0,
+						today=d,
+						**delta,
+					)
+				report = await self.get_report_async(
 					group_id,
 					None,
 					None,
@@ -140,8 +175,15 @@ def register_routes(self, app: Quart):
 					challenges=report,
 					today=d,
 				)
+			elif action == 'get_score_table':
+				table = [dict(info, nickname=self._get_nickname_by_qqid(info['qqid']))
+						 for info in await self.get_score_table_async(group_id)]
+				return jsonify(
+					code=0,
+					table=table,
+				)
 			elif action == 'get_user_challenge':
-				report = self.get_report(
+				report = await self.get_report_async(
 					group_id,
 					None,
 					payload['qqid'],
@@ -161,30 +203,27 @@ def register_routes(self, app: Quart):
 					}
 				)
 			elif action == 'update_boss':
-				try:
-					bossData, base_cycle, notice = await asyncio.wait_for(
-						asyncio.shield(
-							self._boss_status[group_id]),
-							timeout=30
-						)
-					return jsonify(
-						code = 0,
-						bossData = bossData,
-						base_cycle = base_cycle,
-						notice = notice,
-					)
-				except asyncio.TimeoutError:
+				# 长轮询，仅为不支持 EventSource 的浏览器保留
+				hub = self.get_boss_status_hub(group_id)
+				if not await hub.wait(hub.seq, timeout=30):
 					return jsonify(
 						code=1,
 						message='not changed',
 					)
+				return jsonify(
+					code = 0,
+					bossData = hub.boss_data(),
+					base_cycle = hub.base_cycle,
+					notice = hub.notice,
+				)
 			elif action == 'addrecord':
 				try:
-					status = self.challenge(group_id, user_id,
-					payload['defeat'],
-					payload['damage'],
-					payload['behalf'],
-					boss_num = payload['boss_num'])
+					status = await self.command_executor.submit(
+						group_id, self.challenge, group_id, user_id,
+						payload['defeat'],
+						payload['damage'],
+						payload['behalf'],
+						boss_num = payload['boss_num'])
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(
 						user_id, group_id, action))
@@ -202,13 +241,11 @@ def register_routes(self, app: Quart):
 							message=str(status),
 						)
 					)
-				return jsonify(
-					code=0,
-					bossData=self._boss_data_dict(group),
-				)
+				return boss_status_response(group_id, payload.get('since_version'), code=0)
 			elif action == 'undo':
 				try:
-					status = self.undo(group_id, user_id)
+					status = await self.command_executor.submit(
+						group_id, self.undo, group_id, user_id)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(
 						user_id, group_id, action))
@@ -226,17 +263,15 @@ def register_routes(self, app: Quart):
 							message=str(status),
 						)
 					)
-				return jsonify(
-					code=0,
-					bossData=self._boss_data_dict(group),
-				)
+				return boss_status_response(group_id, payload.get('since_version'), code=0)
 			elif action == 'apply':
 				try:
 					is_continue = payload['is_continue']
-					behalf = payload['behalf']
+					behalf = payload['behalf'] and int(payload['behalf'])
 					boss_num = payload['boss_num']
 					if behalf == user_id: behalf = None
-					status = self.apply_for_challenge(is_continue, group_id, user_id, boss_num, behalf)
+					status = await self.command_executor.submit(
+						group_id, self.apply_for_challenge, is_continue, group_id, user_id, boss_num, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(
@@ -252,14 +287,12 @@ def register_routes(self, app: Quart):
 							message = atqq(behalf)+status,
 						)
 					)
-				return jsonify(
-					code = 0,
-					bossData = self._boss_data_dict(group),
-				)
+				return boss_status_response(group_id, payload.get('since_version'), code=0)
 			elif action == 'cancelapply':
 				try:
 					behalf = payload['behalf'] and int(payload['behalf']) or user_id
-					status = self.cancel_blade(group_id, behalf)
+					status = await self.command_executor.submit(
+						group_id, self.cancel_blade, group_id, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code=10, message=str(e))
@@ -272,14 +305,12 @@ def register_routes(self, app: Quart):
 							message = atqq(behalf)+status,
 						)
 					)
-				return jsonify(
-					code=0,
-					bossData=self._boss_data_dict(group),
-				)
+				return boss_status_response(group_id, payload.get('since_version'), code=0)
 			elif action == 'put_on_the_tree':
 				try:
 					behalf = payload['behalf'] and int(payload['behalf']) or user_id
-					status = self.put_on_the_tree(group_id, behalf)
+					status = await self.command_executor.submit(
+						group_id, self.put_on_the_tree, group_id, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code=10, message=str(e))
@@ -292,14 +323,12 @@ def register_routes(self, app: Quart):
 							message = atqq(behalf)+status,
 						)
 					)
-				return jsonify(
-					code=0,
-					bossData=self._boss_data_dict(group),
-				)
+				return boss_status_response(group_id, payload.get('since_version'), code=0)
 			elif action == 'take_it_of_the_tree':
 				try:
 					behalf = payload['behalf'] and int(payload['behalf']) or user_id
-					status = self.take_it_of_the_tree(group_id, behalf)
+					status = await self.command_executor.submit(
+						group_id, self.take_it_of_the_tree, group_id, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code=10, message=str(e))
@@ -312,15 +341,13 @@ def register_routes(self, app: Quart):
 							message = atqq(behalf)+status,
 						)
 					)
-				return jsonify(
-					code=0,
-					bossData=self._boss_data_dict(group),
-				)
+				return boss_status_response(group_id, payload.get('since_version'), code=0)
 			elif action == 'save_slot':
 				sl_member_qqid = payload['member']
 				status = payload['status']
 				try:
-					self.save_slot(group_id, sl_member_qqid, clean_flag = not status)
+					await self.command_executor.submit(
+						group_id, self.save_slot, group_id, sl_member_qqid, clean_flag = not status)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(
@@ -347,7 +374,8 @@ def register_routes(self, app: Quart):
 			elif action == 'add_subscribe':
 				boss_num = payload['boss_num']
 				message = payload.get('message')
-				try:self.subscribe(group_id, user_id, str(boss_num), message)
+				try:await self.command_executor.submit(
+					group_id, self.subscribe, group_id, user_id, str(boss_num), message)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code = 10, message = str(e))
@@ -369,7 +397,8 @@ def register_routes(self, app: Quart):
 				return jsonify(code=0, notice=notice)
 			elif action == 'cancel_subscribe':
 				boss_num = payload['boss_num']
-				try:self.subscribe_cancel(group_id, str(boss_num), user_id)
+				try:await self.command_executor.submit(
+					group_id, self.subscribe_cancel, group_id, str(boss_num), user_id)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code = 10, message = str(e))
@@ -388,7 +417,8 @@ def register_routes(self, app: Quart):
 				if user.authority_group >= 100:
 					return jsonify(code=11, message='Insufficient authority')
 				try:
-					status = self.modify(
+					status = await self.command_executor.submit(
+						group_id, self.modify,
 						group_id,
 						cycle=payload['cycle'],
 						bossData=payload['bossData'],
@@ -407,10 +437,7 @@ def register_routes(self, app: Quart):
 							message=str(status),
 						)
 					)
-				return jsonify(
-					code=0,
-					bossData=self._boss_data_dict(group),
-				)
+				return boss_status_response(group_id, payload.get('since_version'), code=0)
 			elif action == 'send_remind':
 				if user.authority_group >= 100:
 					return jsonify(code=11, message='Insufficient authority')
@@ -432,7 +459,8 @@ def register_routes(self, app: Quart):
 			elif action == 'drop_member':
 				if user.authority_group >= 100:
 					return jsonify(code=11, message='Insufficient authority')
-				count = self.drop_member(group_id, payload['memberlist'])
+				count = await self.command_executor.submit(
+					group_id, self.drop_member, group_id, payload['memberlist'])
 				return jsonify(
 					code=0,
 					notice=f'已删除{count}条记录',
@@ -448,6 +476,42 @@ def register_routes(self, app: Quart):
 			_logger.exception(e)
 			return jsonify(code=40, message=f'server error, info:\n{str(e)}')
 
+	@app.route(
+		urljoin(self.setting['public_basepath'],
+				'clan/<int:group_id>/api/stream/'),
+		methods=['GET'])
+	async def yobot_clan_api_stream(group_id):
+		group = self.get_clan_group(group_id)
+		if group is None:
+			return jsonify(code=20, message='Group not exists')
+		if 'yobot_user' not in session:
+			if not(group.privacy & 0x1):
+				return jsonify(code=10, message='Not logged in')
+		else:
+			user = User.get_by_id(session['yobot_user'])
+			is_member = Clan_member.get_or_none(
+				group_id=group_id, qqid=session['yobot_user'])
+			if (not is_member and user.authority_group >= 10):
+				return jsonify(code=11, message='Insufficient authority')
+		hub = self.get_boss_status_hub(group_id)
+		last_event_id = (request.headers.get('Last-Event-ID')
+						 or request.args.get('last_event_id'))
+
+		async def event_stream():
+			async for event, event_id, data in hub.listen(last_event_id):
+				if event == 'keepalive':
+					yield b': keepalive\n\n'
+					continue
+				yield f'event: {event}\nid: {event_id}\ndata: {data}\n\n'.encode()
+
+		response = await make_response(event_stream(), {
+			'Content-Type': 'text/event-stream',
+			'Cache-Control': 'no-cache',
+			'X-Accel-Buffering': 'no',
+		})
+		response.timeout = None
+		return response
+
 	@app.route(
 		urljoin(self.setting['public_basepath'],
 				'clan/<int:group_id>/my/'),
@@ -518,7 +582,7 @@ def register_routes(self, app: Quart):
 			)
 		user_id = session['yobot_user']
 		user = User.get_by_id(user_id)
-		group = Clan_group.get_or_none(group_id=group_id)
+		group = self.get_clan_group(group_id)
 		if group is None:
 			return jsonify(
 				code=20,
@@ -559,7 +623,12 @@ def register_routes(self, app: Quart):
 				group.game_server = payload['game_server']
 				group.notification = payload['notification']
 				group.privacy = payload['privacy']
-				group.save()
+				await db_executor.write(Clan_group.update(
+					game_server=group.game_server,
+					notification=group.notification,
+					privacy=group.privacy,
+				).where(Clan_group.group_id == group_id).execute)
+				self.publish_boss_status(group)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success')
@@ -570,13 +639,15 @@ def register_routes(self, app: Quart):
 				return jsonify(code=0, message='success', counts=counts)
 			elif action == 'clear_data_slot':
 				battle_id = payload.get('battle_id')
-				self.clear_data_slot(group_id, battle_id)
+				await self.command_executor.submit(
+					group_id, self.clear_data_slot, group_id, battle_id)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success')
 			elif action == 'switch_data_slot':
 				battle_id = payload['battle_id']
-				self.switch_data_slot(group_id, battle_id)
+				await self.command_executor.submit(
+					group_id, self.switch_data_slot, group_id, battle_id)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success')
@@ -665,22 +736,96 @@ def register_routes(self, app: Quart):
 				battle_id = None
 			else:
 				return jsonify(code=20, message=f'unexceptd value "{battle_id}" for battle_id')
-		report = self.get_report(group_id, battle_id, None, None)
-		member_list = self.get_battle_member_list(group_id, battle_id)
+		member_list = await self.get_battle_member_list_async(group_id, battle_id)
 		groupinfo = {
 			'group_id': group.group_id,
 			'group_name': group.group_name,
 			'game_server': group.game_server,
 			'battle_id': group.battle_id,
 		},
-		response = await make_response(jsonify(
-			code=0,
-			message='OK',
-			api_version=1,
-			challenges=report,
-			groupinfo=groupinfo,
-			members=member_list,
-		))
+		columnar = request.args.get('format') == 'columnar'
+		limit = request.args.get('limit')
+		since_cid = request.args.get('since_cid')
+		if since_cid is not None:
+			# 增量同步  只返回上次同步之后新增与被删除的记录
+			if not since_cid.isdigit():
+				return jsonify(code=20, message='invalid since_cid')
+			delta = await self.get_report_delta_async(
+				group_id, battle_id, None, int(since_cid), request.args.get('sync_token'))
+			if columnar:
+				delta['challenges'] = self.encode_report_columnar([delta['challenges']])
+			response = await make_response(jsonify(
+				code=0,
+				message='OK',
+				api_version=1,
+				format='columnar' if columnar else 'records',
+				groupinfo=groupinfo,
+				members=member_list,
+				**delta,
+			))
+		elif limit is not None or columnar:
+			# 分页获取  next_cid 为下一页的 after_cid  没有下一页时为 null
+			# 列式编码需要完整的列  无法分块输出  因此总是分页  未指定 limit 时每页取上限条数
+			after_cid = request.args.get('after_cid', '0')
+			if limit is None:
+				limit = str(REPORT_PAGE_LIMIT)
+			if not (limit.isdigit() and after_cid.isdigit() and int(limit) > 0):
+				return jsonify(code=20, message='invalid limit or after_cid')
+			limit = min(int(limit), REPORT_PAGE_LIMIT)
+			report = []
+			async for report in self.iter_report_async(
+				group_id, battle_id, after_cid=int(after_cid), chunk_size=limit):
+				break
+			response = await make_response(jsonify(
+				code=0,
+				message='OK',
+				api_version=1,
+				format='columnar' if columnar else 'records',
+				challenges=self.encode_report_columnar([report]) if columnar else report,
+				next_cid=report[-1]['cid'] if len(report) == limit else None,
+				groupinfo=groupinfo,
+				members=member_list,
+			))
+		else:
+			# 分块输出完整记录  不在内存中保留全部记录
+			report_chunks = self.iter_report_async(group_id, battle_id)
+			# 先取出第一块再开始输出  查询出错时仍可以返回错误码
+			try:
+				first_chunk = await report_chunks.__anext__()
+			except StopAsyncIteration:
+				first_chunk = []
+			except Exception as e:
+				_logger.exception(e)
+				return jsonify(code=40, message=f'server error, info:\n{str(e)}')
+
+			async def report_stream():
+				head = json.dumps(dict(
+					code=0,
+					message='OK',
+					api_version=1,
+					groupinfo=groupinfo,
+					members=member_list,
+				))
+				yield (head[:-1] + ',"challenges":[' + ','.join(json.dumps(record) for record in first_chunk)).encode()
+				separator = ',' if first_chunk else ''
+				error = None
+				try:
+					async for chunk in report_chunks:
+						if not chunk:
+							continue
+						yield (separator + ','.join(json.dumps(record) for record in chunk)).encode()
+						separator = ','
+				except Exception as e:
+					# 已经开始输出  无法再返回错误码  以error字段结束json  记录不完整
+					_logger.exception(e)
+					error = f'server error, info:\n{str(e)}'
+				if error is None:
+					yield b']}'
+				else:
+					yield (']' + ',"error":' + json.dumps(error) + '}').encode()
+
+			response = await make_response(report_stream(), {'Content-Type': 'application/json'})
+			response.timeout = None
 		if (group.privacy & 0x2):
 			response.headers['Access-Control-Allow-Origin'] = '*'
 		return response
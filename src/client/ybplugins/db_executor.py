@@ -0,0 +1,112 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Iterator, TypeVar, Union
+
+from peewee import Database, DatabaseProxy
+
+from .ybdata import _db, release_connection
+
+DB_READ_WORKERS = 4  # 读线程数量  每个线程持有一个数据库连接
+WRITE_LOCK_POLL_INTERVAL = 0.002  # 事件循环等待写锁时的轮询间隔(秒)
+
+_T = TypeVar("_T")
+_END = object()
+
+
+class DatabaseExecutor:
+    """
+    数据库执行器
+    在专用线程中执行阻塞的数据库操作  慢查询和磁盘同步不再阻塞事件循环
+    peewee的连接按线程保存  每个线程持有各自的连接  线程数量即连接数量上限
+    使用连接池的数据库在每个操作结束后归还连接
+
+    读操作在读线程池中并发执行  SQLite在WAL模式下读不阻塞写
+    写操作在唯一的写线程中按提交顺序依次执行  每个操作是一个事务
+    事件循环中零散的写入(如公会操作中按需创建用户)需要通过 write_locked() 持有同一把写锁  保证同一时刻只有一个写入者
+
+    传入的函数只能访问数据库和线程安全的缓存  不能访问公会运行时状态  不能创建协程
+
+    :param database: peewee数据库
+    :param max_readers: 读线程数量
+    """
+
+    def __init__(self, database: Union[Database, DatabaseProxy], max_readers: int = DB_READ_WORKERS) -> None:
+        self.database = database
+        self.write_lock = threading.RLock()
+        self._readers = ThreadPoolExecutor(max_workers=max_readers, thread_name_prefix="yobot-db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yobot-db-write")
+
+    async def read(self, func: Callable[..., _T], *args, **kwargs) -> _T:
+        """
+        在读线程中执行只读的数据库操作
+
+        :param func: 同步函数
+        :return: 函数的返回值  函数抛出的异常会原样抛出
+        """
+        future = self._readers.submit(self._read, func, args, kwargs)
+        return await asyncio.wrap_future(future)
+
+    async def write(self, func: Callable[..., _T], *args, **kwargs) -> _T:
+        """
+        在写线程中以事务执行数据库写入  函数抛出异常时回滚
+
+        :param func: 同步函数
+        :return: 函数的返回值  函数抛出的异常会原样抛出
+        """
+        future = self._writer.submit(self._write, func, args, kwargs)
+        return await asyncio.wrap_future(future)
+
+    @asynccontextmanager
+    async def write_locked(self) -> AsyncIterator[None]:
+        """
+        在事件循环中持有写锁  用于必须在事件循环中执行的写入
+        写锁被写线程持有时让出事件循环等待  不阻塞事件循环
+
+        写锁按线程归属  事件循环中的所有协程共用同一个线程
+        因此持有期间不能await  否则其他协程会重入写锁
+        """
+        while not self.write_lock.acquire(blocking=False):
+            await asyncio.sleep(WRITE_LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self.write_lock.release()
+
+    @staticmethod
+    def _read(func: Callable[..., _T], args: tuple, kwargs: dict) -> _T:
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release_connection()
+
+    def _write(self, func: Callable[..., _T], args: tuple, kwargs: dict) -> _T:
+        try:
+            with self.write_lock, self.database.atomic():
+                return func(*args, **kwargs)
+        finally:
+            release_connection()
+
+    async def iterate(self, iterator: Iterator[_T]) -> AsyncIterator[_T]:
+        """
+        在读线程中逐项推进同步迭代器  用于分块查询
+        每一项在读线程中取出  取出之间让出事件循环
+
+        :param iterator: 同步迭代器  如 iter_report() 的返回值
+        """
+        while True:
+            item = await self.read(next, iterator, _END)
+            if item is _END:
+                return
+            yield item
+
+    def shutdown(self) -> None:
+        """
+        关闭数据库线程  等待已提交的写入完成
+        """
+        self._readers.shutdown(wait=False)
+        self._writer.shutdown(wait=True)
+
+
+db_executor = DatabaseExecutor(_db)
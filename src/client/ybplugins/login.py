@@ -10,6 +10,7 @@ from apscheduler.triggers.cron import CronTrigger
 from quart import (Quart, Response, jsonify, make_response, redirect, request,
                    send_from_directory, session, url_for)
 
+from .db_executor import db_executor
 from .templating import render_template, template_folder
 from .web_util import rand_string
 from .ybdata import MAX_TRY_TIMES, Clan_group, Clan_member, User, User_login
@@ -48,9 +49,12 @@ class Login:
         trigger = CronTrigger(hour=5)
         return ((trigger, self.drop_expired_logins),)
 
-    def drop_expired_logins(self):
-        # 清理过期cookie
-        now = int(time.time())
+    async def drop_expired_logins(self):
+        # 清理过期cookie  批量删除在数据库写线程中执行
+        await db_executor.write(self._drop_expired_logins, int(time.time()))
+
+    @staticmethod
+    def _drop_expired_logins(now: int):
         User_login.delete().where(
             User_login.auth_cookie_expire_time < now,
         ).execute()
@@ -1,4 +1,3 @@
-import asyncio
 import json
 import os
 from urllib.parse import urljoin
@@ -6,6 +5,7 @@ from urllib.parse import urljoin
 from playhouse.shortcuts import model_to_dict
 from quart import Quart, jsonify, redirect, request, session, url_for
 
+from .db_executor import db_executor
 from .templating import render_template
 from .ybdata import Clan_group, User
 
@@ -28,9 +28,16 @@ class Setting:
                  glo_setting,
                  bot_api,
                  boss_id_name,
-                 *args, **kwargs):
+                 *args,
+                 group_dropped=None,
+                 setting_saved=None,
+                 **kwargs):
         self.setting = glo_setting
         self.boss_id_name = boss_id_name
+        # 删除公会后以群号调用  用于丢弃公会战插件中缓存的公会数据
+        self.group_dropped = group_dropped
+        # 保存设置后调用  用于刷新公会战插件中由设置计算出的缓存(如面板的boss数据)
+        self.setting_saved = setting_saved
 
     def _get_users_json(self, req_querys: dict):
         querys = []
@@ -65,6 +72,30 @@ class Setting:
             'data': [model_to_dict(u, only=_returned_query_fileds) for u in users],
         })
 
+    @staticmethod
+    def _get_groups():
+        groups = []
+        for group in Clan_group.select().where(
+            Clan_group.deleted == False,
+        ):
+            groups.append({
+                'group_id': group.group_id,
+                'group_name': group.group_name,
+                'game_server': group.game_server,
+            })
+        return groups
+
+    @staticmethod
+    def _drop_group(group_id):
+        User.update({
+            User.clan_group_id: None,
+        }).where(
+            User.clan_group_id == group_id,
+        ).execute()
+        Clan_group.delete().where(
+            Clan_group.group_id == group_id,
+        ).execute()
+
     def register_routes(self, app: Quart):
 
         @app.route(
@@ -138,6 +169,8 @@ class Setting:
                     self.setting['dirname'], 'yobot_config.json')
                 with open(config_path, 'w', encoding='utf-8') as f:
                     json.dump(save_setting, f, indent=4)
+                if self.setting_saved is not None:
+                    self.setting_saved()
                 return jsonify(
                     code=0,
                     message='success',
@@ -256,8 +289,7 @@ class Setting:
                     )
                 action = req['action']
                 if action == 'get_data':
-                    return await asyncio.get_event_loop().run_in_executor(
-                        None,
+                    return await db_executor.read(
                         self._get_users_json,
                         req['querys'],
                     )
@@ -346,25 +378,12 @@ class Setting:
                     )
                 action = req['action']
                 if action == 'get_data':
-                    groups = []
-                    for group in Clan_group.select().where(
-                        Clan_group.deleted == False,
-                    ):
-                        groups.append({
-                            'group_id': group.group_id,
-                            'group_name': group.group_name,
-                            'game_server': group.game_server,
-                        })
+                    groups = await db_executor.read(self._get_groups)
                     return jsonify(code=0, data=groups)
                 if action == 'drop_group':
-                    User.update({
-                        User.clan_group_id: None,
-                    }).where(
-                        User.clan_group_id == req['group_id'],
-                    ).execute()
-                    Clan_group.delete().where(
-                        Clan_group.group_id == req['group_id'],
-                    ).execute()
+                    await db_executor.write(self._drop_group, req['group_id'])
+                    if self.group_dropped is not None:
+                        self.group_dropped(req['group_id'])
                     return jsonify(code=0, message='ok')
                 else:
                     return jsonify(code=32, message='unknown action')
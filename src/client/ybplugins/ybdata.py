@@ -1,21 +1,23 @@
 from peewee import *
-from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.migrate import SchemaMigrator, migrate
+from playhouse.pool import PooledDatabase, PooledMySQLDatabase, PooledPostgresqlDatabase
 import json
 
 from .web_util import rand_string
 
-db_mode = True  # True为本地（原），Flase为为改为mysql（需要在第15行配置使用）
-
-_version = 2  # 目前版本
+_version = 3  # 目前版本
 MAX_TRY_TIMES = 5
 
-if db_mode:
-    _db = SqliteDatabase(None)
-else:
-    _db = MySQLDatabase(
-        "", host="", user="", passwd="", port=3306
-        # 第一个填写你的数据库名
-    )
+# 数据库类型: (连接池类, 默认端口)
+DB_BACKENDS = {
+    "mysql": (PooledMySQLDatabase, 3306),
+    "postgresql": (PooledPostgresqlDatabase, 5432),
+}
+DB_MAX_CONNECTIONS = 8  # 连接池的连接数上限  需要大于数据库线程数量(见db_executor)
+DB_STALE_TIMEOUT = 300  # 连接池中的连接超过此时间(秒)后重新建立  应小于数据库服务器的空闲超时
+DB_POOL_TIMEOUT = 10  # 连接全部被占用时等待空闲连接的时间(秒)
+
+_db = DatabaseProxy()  # 在init()中根据设置初始化
 
 
 class _BaseModel(Model):
@@ -24,10 +26,10 @@ class _BaseModel(Model):
 
 
 class Admin_key(_BaseModel):
-    key = CharField(primary_key=True)  # if db_mode else TextField(primary_key=True)
+    key = CharField(primary_key=True)
     valid = BooleanField()
     key_used = BooleanField()
-    cookie = CharField(index=True)  # if db_mode else TextField(primary_key=True)
+    cookie = CharField(index=True)
     create_time = TimestampField()
 
 
@@ -97,6 +99,7 @@ class Clan_group(_BaseModel):
 
     challenging_start_time = BigIntegerField(default=0)
     deleted = BooleanField(default=False)
+    status_tier = CharField(max_length=8, null=True)  # 状态输出档位 full/reduced/text，为空时使用全局设置
 
 
 class Clan_group_backups(_BaseModel):
@@ -159,15 +162,66 @@ class DB_schema(_BaseModel):
     value = TextField()
 
 
-def init(sqlite_filename):
-    if db_mode:
-        _db.init(
-            database=sqlite_filename,
+def _create_database(sqlite_filename, database_setting):
+    """
+    根据设置创建数据库
+
+    :param sqlite_filename: SQLite数据库文件路径
+    :param database_setting: 设置中的database项  为None时使用SQLite
+    """
+    setting = database_setting or {}
+    db_type = setting.get("type", "sqlite")
+    if db_type == "sqlite":
+        return SqliteDatabase(
+            sqlite_filename,
             pragmas={
                 "journal_mode": "wal",
                 "cache_size": -1024 * 64,
             },
         )
+    if db_type not in DB_BACKENDS:
+        raise ValueError(f"不支持的数据库类型: {db_type}  可选: sqlite, {', '.join(DB_BACKENDS)}")
+    pool_class, default_port = DB_BACKENDS[db_type]
+    options = {}
+    if db_type == "mysql":
+        options["charset"] = "utf8mb4"
+    return pool_class(
+        setting.get("name") or "yobot",
+        host=setting.get("host") or "127.0.0.1",
+        port=setting.get("port") or default_port,
+        user=setting.get("user") or None,
+        password=setting.get("password") or None,
+        max_connections=setting.get("max_connections") or DB_MAX_CONNECTIONS,
+        stale_timeout=setting.get("stale_timeout") or DB_STALE_TIMEOUT,
+        timeout=DB_POOL_TIMEOUT,
+        **options,
+    )
+
+
+def release_connection():
+    """
+    将当前线程的数据库连接归还连接池  下次查询时自动重新获取
+    用于每个请求  每条消息  每个后台操作结束时  SQLite不使用连接池  不做处理
+    """
+    if isinstance(_db.obj, PooledDatabase) and not _db.is_closed() and not _db.in_transaction():
+        _db.close()
+
+
+def init(sqlite_filename, database_setting=None):
+    """
+    初始化数据库  创建或升级数据表
+
+    :param sqlite_filename: SQLite数据库文件路径
+    :param database_setting: 设置中的database项  为None时使用SQLite
+    """
+    database = _create_database(sqlite_filename, database_setting)
+    _db.initialize(database)
+    if isinstance(database, PooledDatabase):
+        try:
+            database.connect()
+        except ImproperlyConfigured as e:
+            print(f"缺少数据库驱动: {e}  MySQL需要安装pymysql  PostgreSQL需要安装psycopg2")
+            raise SystemExit()
 
     old_version = 1
     if not DB_schema.table_exists():
@@ -193,10 +247,11 @@ def init(sqlite_filename):
         print("正在升级数据库")
         db_upgrade(old_version)
         print("数据库升级完毕")
+    release_connection()
 
 
 def db_upgrade(old_version):
-    migrator = SqliteMigrator(_db)
+    migrator = SchemaMigrator.from_database(_db)
     if old_version < 2:
         pass
     if old_version <= 1:
@@ -221,4 +276,8 @@ def db_upgrade(old_version):
             group.subscribe_list = new_subscribe_list
             group.save()
 
-    DB_schema.replace(key="version", value=str(_version)).execute()
+    if old_version < 3:
+        migrate(migrator.add_column("clan_group", "status_tier", Clan_group.status_tier))
+
+    # PostgreSQL不支持REPLACE  版本记录在读取旧版本时已经存在
+    DB_schema.update(value=str(_version)).where(DB_schema.key == "version").execute()
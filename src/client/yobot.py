@@ -17,6 +17,7 @@ from aiocqhttp.api import Api
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from opencc import OpenCC
 from quart import Quart, make_response, request, send_file
+from quart.wrappers.response import IterableBody
 
 if __package__:
     from .ybplugins import (clan_battle, homepage,
@@ -112,13 +113,22 @@ class Yobot:
             verinfo = get_version(self.Version, self.Version_id)
             print(verinfo['ver_name'])
         # initialize database
-        ybdata.init(os.path.join(dirname, 'yobotdata_new.db'))
+        ybdata.init(os.path.join(dirname, 'yobotdata_new.db'),
+                    self.glo_setting["database"])
+
+        # 使用连接池时每个请求结束后归还数据库连接
+        @quart_app.teardown_request
+        async def release_db_connection(exc):
+            ybdata.release_connection()
 
         # enable gzip
         if self.glo_setting["web_gzip"] > 0:
             gzipped_types = {'text/html', 'text/javascript', 'text/css', 'application/json'}
             @quart_app.after_request
             async def gzip_response(response):
+                if isinstance(response.response, IterableBody):
+                    # 流式响应不能等待读取完整内容
+                    return response
                 accept_encoding = request.headers.get('Accept-Encoding', '')
                 if (response.status_code < 200 or
                     response.status_code >= 300 or
@@ -256,15 +266,18 @@ class Yobot:
         }
 
         # load plugins
+        clan_battle_plugin = clan_battle.ClanBattle(**kwargs)
         plug_all = [
             switcher.Switcher(**kwargs),
             yobot_msg.Message(**kwargs),
             homepage.Index(**kwargs),
             marionette.Marionette(**kwargs),
             login.Login(**kwargs),
-            settings.Setting(**kwargs),
+            settings.Setting(**kwargs,
+                             group_dropped=clan_battle_plugin.forget_group,
+                             setting_saved=clan_battle_plugin.refresh_setting),
             web_util.WebUtil(**kwargs),
-            clan_battle.ClanBattle(**kwargs),
+            clan_battle_plugin,
         ]
         self.plug_passive = [p for p in plug_all if p.Passive]
         self.plug_active = [p for p in plug_all if p.Active]